@@ -1,12 +1,19 @@
+import json
+import math
 import time
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from datetime import datetime, timedelta
-from apify_client import ApifyClient
+from apify_client import ApifyClient, ApifyClientAsync
 import pandas as pd
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 import logging
 import os
+from quote_cache import quote_cache, make_key, QUOTE_CACHE_ENABLED
+from hotel_registry import hotel_registry
+from fx_rates import convert_price
+from rate_limiter import actor_run_bucket
+from circuit_breaker import apify_breaker, classify_error, ActorRunFailed, RATE_LIMIT, PERMANENT
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -16,103 +23,406 @@ logger = logging.getLogger(__name__)
 APIFY_API_TOKEN = os.environ.get("APIFY_API_TOKEN")
 if not APIFY_API_TOKEN:
     raise ValueError("APIFY_API_TOKEN no está definido en las variables de entorno. Por favor, configúralo antes de ejecutar el scraper.")
+# URL alternativa de la API (por ejemplo el servidor local de fake_apify.py para benchmarks)
+APIFY_API_URL = os.environ.get("APIFY_API_URL") or None
 
-# Función para lanzar una ejecución individual del actor con retry logic y backoff exponencial
-def fetch_price_for_night(client, base_url, hotel_name, checkin, checkout, currency="USD"):
-    run_input = {
-        "startUrls": [{"url": base_url}],
-        "checkIn": checkin,
-        "checkOut": checkout,
-        "maxRequestsPerCrawl": 1,
-        "maxConcurrency": 1,
-        "proxyConfiguration": {"useApifyProxy": True, "apifyProxyGroups": ["US"]},
-        "currency": currency,
-        "language": "es",
-        "maxPagesPerCrawl": 1,
-        "maxItems": 1,
-        "timeoutSecs": 60,
-        "requestHandlerTimeoutSecs": 30,
-        "maxRequestRetries": 3,
-    }
-    
+ACTOR_ID = "voyager/booking-scraper"
+
+# Motor de ejecución: "asyncio" (cliente async de Apify, concurrencia adaptativa AIMD) o "threads" (pool fijo)
+SCRAPER_ENGINE = os.environ.get("SCRAPER_ENGINE", "asyncio").lower()
+
+# --- MODO BATCH ---
+# En modo batch se envían varios rangos checkIn/checkOut de un mismo hotel en una sola ejecución
+# del actor (un startUrl por noche) en lugar de una ejecución por noche.
+# Supuesto sin verificar contra el actor real: voyager/booking-scraper respeta los parámetros
+# checkin/checkout de cada startUrl por encima del checkIn/checkOut de la ejecución (que queda en
+# la primera noche). El actor falso de fake_apify (benchmark) los respeta por construcción. Si el
+# actor los ignorara, todos los items vendrían con la primera fecha: batch_results_from_items asigna
+# los items por su checkIn, así que las demás noches quedarían sin precio (no con precios de otra
+# fecha). Verificar con una ejecución real antes de activar el modo en producción.
+SCRAPER_BATCH_MODE = os.environ.get("SCRAPER_BATCH_MODE", "false").lower() == "true"
+# Máximo de noches por ejecución del actor en modo batch
+APIFY_BATCH_SIZE = int(os.environ.get("APIFY_BATCH_SIZE", "30"))
+
+def check_run_status(run):
+    """Lanza ActorRunFailed si la ejecución terminó en FAILED (cuenta como fallo para el circuit breaker)."""
+    if run is not None and run.get("status") == "FAILED":
+        raise ActorRunFailed(run.get("id"), run.get("status"))
+
+def retry_delay(attempt, base_delay=1):
+    """Backoff exponencial con jitter para el reintento `attempt` (0 = primer reintento)."""
+    return min(base_delay * (2 ** attempt) + random.uniform(0, 1), 30)
+
+# Campos del dataset que usa el parser. Se piden solo estos al leer los items para no descargar
+# descripciones, imágenes, facilities, etc. (la API de Apify proyecta solo campos de primer nivel).
+DATASET_ITEM_FIELDS = ["url", "checkIn", "checkin", "rating", "reviews", "rooms"]
+
+def get_item_price(item):
+    """Devuelve el primer displayedPrice válido de un item (como string), o None."""
+    for room in item.get("rooms") or []:
+        for option in room.get("options") or []:
+            try:
+                return str(float(option["displayedPrice"]))
+            except (ValueError, TypeError, KeyError):
+                continue
+    return None
+
+def extract_price_from_items(items):
+    """
+    Extrae (price, rating, reviews) de los items de un dataset de Booking.
+    Devuelve el primer displayedPrice válido encontrado.
+    """
+    rating = None
+    reviews = None
+    for item in items:
+        # Extraer rating y reviews del item (solo una vez, son datos estáticos)
+        if rating is None:
+            rating = item.get("rating")
+            reviews = item.get("reviews")
+        
+        price = get_item_price(item)
+        if price is not None:
+            return price, rating, reviews
+    return None, rating, reviews
+
+def read_dataset_items(client, dataset_id, limit=None, first_price_only=False):
+    """
+    Lee los items de un dataset con proyección de campos, paginando de forma perezosa.
+    Con first_price_only deja de leer en el primer item con precio válido.
+    """
+    items = []
+    for item in client.dataset(dataset_id).iterate_items(fields=DATASET_ITEM_FIELDS, limit=limit):
+        items.append(item)
+        if first_price_only and get_item_price(item) is not None:
+            break
+    return items
+
+def run_actor_with_retries(client, run_input, label, first_price_only=False, deadline=None, usage=None, budget=None):
+    """
+    Lanza una ejecución del actor de Booking con retry y backoff exponencial.
+    Los errores se clasifican (ver circuit_breaker): rate limits, errores de red y fallos del actor
+    se reintentan; los permanentes no. Mientras el circuit breaker esté abierto se espera sin
+    lanzar ejecuciones.
+    Devuelve la lista de items del dataset, o None si la ejecución falló.
+    Con first_price_only la lectura del dataset se corta en el primer precio válido.
+    Con deadline (timestamp de time.time()) no se lanzan ni se esperan ejecuciones más allá de
+    ese momento: la ejecución en curso se aborta y se devuelve None.
+    Con usage (run_usage.RunUsage) registra cada ejecución, reintento y lectura de dataset.
+    Con budget (rate_limiter.BudgetLease) cada ejecución ocupa un lugar del presupuesto global
+    de ejecuciones en vuelo mientras corre.
+    """
     max_retries = 5
-    base_delay = 1
     
     for attempt in range(max_retries):
         try:
-            logger.info(f"Iniciando scraper para {hotel_name} - {checkin} (intento {attempt + 1}/{max_retries})")
-            run = client.actor("voyager/booking-scraper").call(run_input=run_input)
+            # No lanzar ejecuciones mientras Apify esté fallando
+            if not apify_breaker.acquire(deadline):
+                logger.warning(f"Circuit breaker abierto hasta después del deadline del reporte: se omite {label}")
+                return None
+            # Respetar el presupuesto compartido de arranques del actor
+            actor_run_bucket.acquire()
+            if deadline is not None and time.time() >= deadline:
+                logger.warning(f"Deadline del reporte alcanzado antes de iniciar {label}")
+                return None
+            if budget is not None and not budget.acquire(deadline):
+                logger.warning(f"Deadline del reporte alcanzado esperando lugar en el presupuesto de ejecuciones para {label}")
+                return None
+            try:
+                logger.info(f"Iniciando scraper para {label} (intento {attempt + 1}/{max_retries})")
+                run = client.actor(ACTOR_ID).start(run_input=run_input)
+                wait_secs = None if deadline is None else max(1, math.ceil(deadline - time.time()))
+                run = client.run(run["id"]).wait_for_finish(wait_secs=wait_secs)
+                if run is not None and run.get("status") in ("READY", "RUNNING"):
+                    aborted = client.run(run["id"]).abort()
+                    if usage is not None:
+                        usage.record_run(aborted or run)
+                    logger.warning(f"Deadline del reporte alcanzado para {label}: ejecución {run['id']} abortada")
+                    return None
+            finally:
+                if budget is not None:
+                    budget.release()
+            if usage is not None:
+                usage.record_run(run)
+            check_run_status(run)
+            apify_breaker.record_success()
             
             if run is None or "defaultDatasetId" not in run:
-                logger.warning(f"No se pudo obtener dataset para {hotel_name} - {checkin}")
-                return (hotel_name, base_url, checkin, None, None, None)
+                logger.warning(f"No se pudo obtener dataset para {label}")
+                return None
                 
             dataset_id = run["defaultDatasetId"]
-            items = client.dataset(dataset_id).list_items().items
-            
-            if not items:
-                logger.warning(f"No se encontraron items para {hotel_name} - {checkin}")
-                return (hotel_name, base_url, checkin, None, None, None)
-                
-            price = None
-            rating = None
-            reviews = None
-            
-            for item in items:
-                # Extraer rating y reviews del item (solo una vez, son datos estáticos)
-                if rating is None:
-                    rating = item.get("rating")
-                    reviews = item.get("reviews")
-                
-                if "rooms" in item and item["rooms"]:
-                    for room in item["rooms"]:
-                        if "options" in room and room["options"]:
-                            for option in room["options"]:
-                                try:
-                                    price = str(float(option["displayedPrice"]))
-                                    logger.info(f"Precio encontrado para {hotel_name} - {checkin}: {price}")
-                                    return (hotel_name, base_url, checkin, price, rating, reviews)
-                                except (ValueError, TypeError, KeyError):
-                                    continue
-                                    
-            logger.warning(f"No se encontró precio válido para {hotel_name} - {checkin}")
-            return (hotel_name, base_url, checkin, price, rating, reviews)
+            items = read_dataset_items(client, dataset_id, limit=run_input.get("maxItems"), first_price_only=first_price_only)
+            if usage is not None:
+                usage.record_dataset(items, len(json.dumps(items)))
+            return items
             
         except Exception as e:
-            error_msg = str(e).lower()
-            
-            # Detectar errores de rate limiting
-            if "429" in error_msg or "too many requests" in error_msg or "rate limit" in error_msg:
-                if attempt < max_retries - 1:
-                    # Backoff exponencial con jitter
-                    delay = min(base_delay * (2 ** attempt) + random.uniform(0, 1), 30)
-                    logger.warning(f"Rate limit detectado para {hotel_name} - {checkin}. Esperando {delay:.1f}s antes del reintento {attempt + 2}")
-                    time.sleep(delay)
-                    continue
-                else:
-                    logger.error(f"Rate limit persistente para {hotel_name} - {checkin} después de {max_retries} intentos")
-                    return (hotel_name, base_url, checkin, None, None, None)
+            kind = classify_error(e)
+            apify_breaker.record_failure(kind)
+            if kind == PERMANENT:
+                # Errores permanentes (input inválido, token, etc.) - no reintentar
+                logger.error(f"Error para {label}: {e}")
+                return None
+            if attempt == max_retries - 1:
+                logger.error(f"Error persistente ({kind}) para {label} después de {max_retries} intentos: {e}")
+                return None
+            delay = retry_delay(attempt)
+            if deadline is not None and time.time() + delay >= deadline:
+                logger.warning(f"Error ({kind}) para {label}: el reintento excedería el deadline del reporte")
+                return None
+            if usage is not None:
+                usage.record_retry(kind)
+            if kind == RATE_LIMIT:
+                logger.warning(f"Rate limit detectado para {label}. Esperando {delay:.1f}s antes del reintento {attempt + 2}")
             else:
-                # Otros errores - no reintentar
-                logger.error(f"Error para {hotel_name} {checkin}: {e}")
-                return (hotel_name, base_url, checkin, None, None, None)
+                logger.warning(f"Error ({kind}) para {label}: {e}. Esperando {delay:.1f}s antes del reintento {attempt + 2}")
+            time.sleep(delay)
+    
+    return None
+
+def build_run_input(start_urls, checkin, checkout, currency, max_items=1):
+    return {
+        "startUrls": start_urls,
+        "checkIn": checkin,
+        "checkOut": checkout,
+        "maxRequestsPerCrawl": max_items,
+        "maxConcurrency": 1 if max_items == 1 else min(max_items, 10),
+        "proxyConfiguration": {"useApifyProxy": True, "apifyProxyGroups": ["US"]},
+        "currency": currency,
+        "language": "es",
+        "maxPagesPerCrawl": max_items,
+        "maxItems": max_items,
+        "timeoutSecs": 60 * max_items if max_items > 1 else 60,
+        "requestHandlerTimeoutSecs": 30,
+        "maxRequestRetries": 3,
+    }
+
+def night_result_from_items(hotel_name, base_url, checkin, items):
+    """Convierte los items de una ejecución por noche en la tupla de resultado."""
+    label = f"{hotel_name} - {checkin}"
+    if not items:
+        if items is not None:
+            logger.warning(f"No se encontraron items para {label}")
+        return (hotel_name, base_url, checkin, None, None, None)
+    
+    price, rating, reviews = extract_price_from_items(items)
+    if price is not None:
+        logger.info(f"Precio encontrado para {label}: {price}")
+    else:
+        logger.warning(f"No se encontró precio válido para {label}")
+    return (hotel_name, base_url, checkin, price, rating, reviews)
+
+# Función para lanzar una ejecución individual del actor con retry logic y backoff exponencial
+def fetch_price_for_night(client, base_url, hotel_name, checkin, checkout, currency="USD", deadline=None, usage=None, budget=None):
+    run_input = build_run_input([{"url": base_url}], checkin, checkout, currency)
+    items = run_actor_with_retries(client, run_input, f"{hotel_name} - {checkin}", first_price_only=True, deadline=deadline, usage=usage, budget=budget)
+    return night_result_from_items(hotel_name, base_url, checkin, items)
+
+def build_dated_url(base_url, checkin, checkout):
+    """Agrega checkin/checkout a la URL del hotel para que cada startUrl represente una noche."""
+    parsed = urlparse(base_url)
+    query = {k: v for k, v in parse_qs(parsed.query).items() if k not in ("checkin", "checkout")}
+    query["checkin"] = [checkin]
+    query["checkout"] = [checkout]
+    return urlunparse(parsed._replace(query=urlencode(query, doseq=True)))
+
+def get_item_checkin(item):
+    """Obtiene la fecha de checkIn de un item del dataset (campo del actor o query de la URL)."""
+    checkin = item.get("checkIn") or item.get("checkin")
+    if checkin:
+        return str(checkin)[:10]
+    url = item.get("url")
+    if url:
+        values = parse_qs(urlparse(url).query).get("checkin")
+        if values:
+            return values[0][:10]
+    return None
+
+def build_batch_run_input(base_url, date_ranges, currency):
+    """Arma el input del actor para scrapear varias noches de un hotel en una sola ejecución."""
+    start_urls = [
+        {"url": build_dated_url(base_url, checkin, checkout), "userData": {"checkIn": checkin, "checkOut": checkout}}
+        for checkin, checkout in date_ranges
+    ]
+    first_checkin, first_checkout = date_ranges[0]
+    return build_run_input(start_urls, first_checkin, first_checkout, currency, max_items=len(date_ranges))
+
+def batch_label(hotel_name, date_ranges):
+    return f"{hotel_name} - {date_ranges[0][0]}..{date_ranges[-1][0]} ({len(date_ranges)} noches)"
+
+def batch_results_from_items(hotel_name, base_url, date_ranges, items):
+    """Asigna los items de una ejecución batch a cada noche (una tupla de resultado por rango)."""
+    # Agrupar items por fecha de checkIn
+    items_by_checkin = {}
+    for item in items or []:
+        checkin = get_item_checkin(item)
+        if checkin:
+            items_by_checkin.setdefault(checkin, []).append(item)
+    
+    results = []
+    for checkin, checkout in date_ranges:
+        price, rating, reviews = extract_price_from_items(items_by_checkin.get(checkin, []))
+        if price is None:
+            logger.warning(f"No se encontró precio válido para {hotel_name} - {checkin} (batch)")
+        results.append((hotel_name, base_url, checkin, price, rating, reviews))
+    logger.info(f"Batch completado para {batch_label(hotel_name, date_ranges)}: {sum(1 for r in results if r[3] is not None)}/{len(results)} precios")
+    return results
+
+def fetch_prices_for_hotel(client, base_url, hotel_name, date_ranges, currency="USD", deadline=None, usage=None, budget=None):
+    """
+    Modo batch: scrapea varias noches de un mismo hotel en una sola ejecución del actor.
+    Devuelve una tupla (hotel_name, base_url, checkin, price, rating, reviews) por cada rango,
+    con price None para las noches que no aparezcan en el dataset.
+    """
+    if not date_ranges:
+        return []
+    run_input = build_batch_run_input(base_url, date_ranges, currency)
+    items = run_actor_with_retries(client, run_input, batch_label(hotel_name, date_ranges), deadline=deadline, usage=usage, budget=budget)
+    return batch_results_from_items(hotel_name, base_url, date_ranges, items)
+
+def run_tasks_threaded(client, tasks, batch_mode, currency, on_task_done, deadline=None, usage=None, budget=None):
+    """
+    Ejecuta las tareas en un pool de threads (motor clásico).
+    Llama a on_task_done(base_url, hotel_name, task_ranges, task_results) por cada tarea completada.
+    Con deadline, al vencer se cancelan las tareas que no empezaron; las que están en curso abortan
+    su ejecución del actor (ver run_actor_with_retries). Devuelve la cantidad de tareas canceladas.
+    """
+    cancelled = 0
+    with ThreadPoolExecutor(max_workers=15) as executor:
+        future_to_task = {}
+        for (base_url, hotel_name, task_ranges) in tasks:
+            if batch_mode:
+                future = executor.submit(fetch_prices_for_hotel, client, base_url, hotel_name, task_ranges, currency, deadline, usage, budget)
+            else:
+                checkin, checkout = task_ranges[0]
+                future = executor.submit(fetch_price_for_night, client, base_url, hotel_name, checkin, checkout, currency, deadline, usage, budget)
+            future_to_task[future] = (base_url, hotel_name, task_ranges)
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        try:
+            for future in as_completed(future_to_task, timeout=timeout):
+                base_url, hotel_name, task_ranges = future_to_task[future]
+                try:
+                    result = future.result()
+                    task_results = result if batch_mode else [result]
+                except Exception as exc:
+                    logger.error(f"Error en {hotel_name} {task_ranges[0][0]}: {exc}")
+                    task_results = [(hotel_name, base_url, checkin, None, None, None) for checkin, _ in task_ranges]
+                on_task_done(base_url, hotel_name, task_ranges, task_results)
+        except FuturesTimeoutError:
+            cancelled = sum(1 for future in future_to_task if future.cancel())
+            logger.warning(f"Deadline del reporte alcanzado: {cancelled} tareas canceladas, las ejecuciones en curso se abortan")
+    return cancelled
+
+def build_results_table(results, hotel_base_urls, url_to_name, nights, cached_dates=None, log_metadata=True, missing_dates=None):
+    """
+    Construye las filas por hotel (Hotel Name, URL, fecha -> precio por noche) y la metadata de
+    hoteles a partir de las tuplas de resultado. Las filas respetan el orden de hotel_base_urls
+    (el hotel principal primero). Sirve tanto para el resultado final como para resultados parciales.
+    """
+    # Construir DataFrame y recopilar metadata de hoteles
+    df_dict = {base_url: {"Hotel Name": url_to_name[base_url], "URL": base_url} for base_url in hotel_base_urls}
+    hotel_metadata = {}  # Diccionario: base_url -> {"rating": X, "reviews": Y, "name": Z}
     
-    return (hotel_name, base_url, checkin, None, None, None)
+    for hotel_name, base_url, checkin, price, rating, reviews in results:
+        # Construir datos de precios por fecha
+        if base_url not in df_dict:
+            df_dict[base_url] = {"Hotel Name": hotel_name, "URL": base_url}
+        
+        # Recopilar metadata una vez por hotel (del primer resultado exitoso)
+        if base_url not in hotel_metadata and (rating is not None or reviews is not None):
+            hotel_metadata[base_url] = {
+                "rating": rating,
+                "reviews": reviews,
+                "name": hotel_name
+            }
+            if log_metadata:
+                logger.info(f"Metadata recopilada para {hotel_name}: rating={rating}, reviews={reviews}")
+        
+        # Si nights > 1 y price es numérico, dividir por nights para obtener precio por noche
+        if price is not None:
+            try:
+                price_float = float(price)
+                if nights > 1:
+                    price_float = round(price_float / nights, 2)
+                df_dict[base_url][checkin] = price_float
+            except Exception:
+                df_dict[base_url][checkin] = price
+        else:
+            df_dict[base_url][checkin] = price
+    
+    # Marcar en la metadata las noches servidas desde el cache
+    for base_url, dates in (cached_dates or {}).items():
+        hotel_metadata.setdefault(base_url, {"rating": None, "reviews": None, "name": url_to_name[base_url]})
+        hotel_metadata[base_url]["cached_dates"] = sorted(dates)
+    
+    # Marcar las noches que quedaron sin scrapear porque venció el deadline del reporte
+    for base_url, dates in (missing_dates or {}).items():
+        hotel_metadata.setdefault(base_url, {"rating": None, "reviews": None, "name": url_to_name[base_url]})
+        hotel_metadata[base_url]["missing_dates"] = sorted(dates)
+    
+    return list(df_dict.values()), hotel_metadata
 
-def scrape_booking_data(hotel_base_urls, days=2, nights=1, currency="USD", start_date=None):
+def scrape_booking_data(hotel_base_urls, days=2, nights=1, currency="USD", start_date=None, batch_mode=None, batch_size=None, client=None, use_cache=None, engine=None, progress_callback=None, checkpointed_quotes=None, fx_plan=None, deadline=None, usage=None, budget=None, prefetched_quotes=None):
     """
     Scraping de Booking.com para múltiples hoteles, días, noches y moneda.
     
     Args:
-        hotel_base_urls: Lista de URLs de hoteles
+        hotel_base_urls: Lista de URLs de hoteles (el hotel principal primero). Las URLs que
+            corresponden al mismo hotel (ver hotel_registry) se scrapean y reportan una sola vez.
         days: Número de días a analizar
         nights: Número de noches por reserva
         currency: Moneda para los precios
         start_date: Fecha de inicio en formato "YYYY-MM-DD". Si es None, usa hoy.
+        batch_mode: Si es True, agrupa las noches de cada hotel en ejecuciones batch del actor.
+            Si es None, usa SCRAPER_BATCH_MODE.
+        batch_size: Máximo de noches por ejecución en modo batch. Si es None, usa APIFY_BATCH_SIZE.
+        client: Cliente de Apify a usar. Por defecto ApifyClientAsync (motor asyncio) o ApifyClient
+            (motor threads) con APIFY_API_TOKEN.
+        use_cache: Si es True, reutiliza cotizaciones frescas del cache compartido y no lanza el
+            actor para esas noches. Si es None, usa QUOTE_CACHE_ENABLED. Las noches servidas desde
+            el cache quedan listadas en hotel_metadata[url]["cached_dates"].
+        engine: "asyncio" (event loop con concurrencia adaptativa) o "threads" (pool fijo).
+            Si es None, usa SCRAPER_ENGINE.
+        progress_callback: Función opcional progress_callback(completed_quotes, total_quotes, snapshot, new_quotes)
+            que se llama a medida que llegan cotizaciones (primero las del cache). snapshot() devuelve
+            las filas parciales con el mismo formato que final_results; new_quotes son las tuplas
+            (hotel_name, base_url, checkin, price, rating, reviews) recién obtenidas.
+        checkpointed_quotes: Cotizaciones ya obtenidas por una ejecución anterior del mismo reporte,
+            como dict {(base_url, checkin): (price, rating, reviews)}. Esas noches no se vuelven a scrapear.
+        fx_plan: Conversión de moneda (ver fx_rates.plan_conversion). Si se indica, el actor y el
+            cache trabajan en fx_plan["baseCurrency"] y los precios se convierten a `currency` con
+            fx_plan["rate"]; los resultados, el progreso y los checkpoints quedan en `currency`.
+        deadline: Momento límite del reporte (timestamp de time.time()). Al vencer se cancelan las
+            tareas pendientes y se abortan las ejecuciones en curso; las noches sin resultado quedan
+            con precio None y listadas en hotel_metadata[url]["missing_dates"].
+        usage: run_usage.RunUsage opcional donde se registra el consumo de cada ejecución del actor
+            (compute units, costo, duración, reintentos, items y bytes leídos).
+        budget: rate_limiter.BudgetLease opcional con la parte del reporte en el presupuesto global
+            de ejecuciones en vuelo (cuando el worker procesa varios reportes en paralelo).
+        prefetched_quotes: Cotizaciones ya scrapeadas para un lote de reportes (ver scrape_planner),
+            como dict {quote_cache.make_key(...): (price, rating, reviews)} en la moneda de scraping.
+            Se usan como las del cache (incluidas las agotadas, con precio None) y quedan en cached_dates.
     """
-    logger.info(f"Iniciando scraping para {len(hotel_base_urls)} hoteles por {days} días, {nights} noches, moneda {currency}")
+    if engine is None:
+        engine = SCRAPER_ENGINE
+    if use_cache is None:
+        use_cache = QUOTE_CACHE_ENABLED
+    if batch_mode is None:
+        batch_mode = SCRAPER_BATCH_MODE
+    if batch_size is None:
+        batch_size = APIFY_BATCH_SIZE
+    batch_size = max(1, int(batch_size))
+    # Moneda en la que se scrapea y se cachea; los precios se convierten a `currency` al llegar
+    scrape_currency = fx_plan["baseCurrency"] if fx_plan else currency
+    def to_report_currency(price):
+        return convert_price(price, fx_plan["rate"]) if fx_plan else price
+    if fx_plan:
+        logger.info(f"Conversión local de moneda: se scrapea en {scrape_currency} y se convierte a {currency} (tasa {fx_plan['rate']})")
+    logger.info(f"Iniciando scraping para {len(hotel_base_urls)} hoteles por {days} días, {nights} noches, moneda {currency}, modo {'batch' if batch_mode else 'por noche'}, motor {engine}")
     logger.info(f"DEBUG - start_date recibido en scraper: {start_date} (tipo: {type(start_date)})")
-    client = ApifyClient(APIFY_API_TOKEN)
+    if client is None:
+        client_class = ApifyClientAsync if engine == "asyncio" else ApifyClient
+        client = client_class(APIFY_API_TOKEN, api_url=APIFY_API_URL)
     
     # Determinar fecha de inicio
     if start_date:
@@ -134,72 +444,130 @@ def scrape_booking_data(hotel_base_urls, days=2, nights=1, currency="USD", start
         )
         for i in range(0, days)
     ]
-    # Obtener nombres de hoteles
+    # Resolver hoteles canónicos: las variantes de una misma URL (idioma, query) se scrapean una
+    # sola vez, con la primera URL en la que aparece el hotel como representativa
+    requested_urls = hotel_base_urls
+    hotels = hotel_registry.resolve(requested_urls)
+    hotel_base_urls = [url for url, _ in hotels]
+    if len(hotel_base_urls) < len(requested_urls):
+        logger.info(f"Hoteles duplicados omitidos: {len(requested_urls) - len(hotel_base_urls)} (quedan {len(hotel_base_urls)} hoteles únicos)")
     url_to_name = {}
-    for url in hotel_base_urls:
-        try:
-            hotel_id = url.split("/hotel/")[-1].split(".")[0]
-            hotel_name = hotel_id.replace("-", " ").title()
-            url_to_name[url] = hotel_name
-        except:
-            url_to_name[url] = f"Hotel_{len(url_to_name) + 1}"
-    # Crear lista de tareas
-    tasks = []
+    used_names = set()
+    for url, record in hotels:
+        hotel_name = record["name"] or f"Hotel_{len(url_to_name) + 1}"
+        # Los nombres identifican las columnas del reporte: evitar colisiones entre hoteles distintos
+        if hotel_name in used_names:
+            hotel_name = f"{hotel_name} ({len(url_to_name) + 1})"
+        used_names.add(hotel_name)
+        url_to_name[url] = hotel_name
+    # Reanudar desde checkpoints y consultar el cache de cotizaciones: esas noches no lanzan el actor
+    checkpointed_quotes = checkpointed_quotes or {}
+    results = []
+    new_cached_quotes = []
+    cached_dates = {}  # base_url -> [checkin, ...]
+    pending_ranges = {}  # base_url -> [(checkin, checkout), ...]
     for base_url in hotel_base_urls:
         hotel_name = url_to_name[base_url]
+        pending_ranges[base_url] = []
         for checkin, checkout in date_ranges:
-            tasks.append((base_url, hotel_name, checkin, checkout))
+            checkpoint = checkpointed_quotes.get((base_url, checkin))
+            if checkpoint is not None:
+                price, rating, reviews = checkpoint
+                results.append((hotel_name, base_url, checkin, price, rating, reviews))
+                continue
+            cached = None
+            if prefetched_quotes:
+                cached = prefetched_quotes.get(make_key(base_url, checkin, nights, scrape_currency))
+            if cached is None and use_cache:
+                cached = quote_cache.get(base_url, checkin, nights, scrape_currency)
+            if cached is not None:
+                price, rating, reviews = cached
+                new_cached_quotes.append((hotel_name, base_url, checkin, to_report_currency(price), rating, reviews))
+                cached_dates.setdefault(base_url, []).append(checkin)
+            else:
+                pending_ranges[base_url].append((checkin, checkout))
+    if results:
+        logger.info(f"Reanudando reporte: {len(results)} noches recuperadas de checkpoints")
+    results.extend(new_cached_quotes)
+    if use_cache or prefetched_quotes:
+        logger.info(f"Cache de cotizaciones: {len(new_cached_quotes)} noches servidas desde cache, {sum(len(r) for r in pending_ranges.values())} a scrapear")
+
+    # Crear lista de tareas: (base_url, hotel_name, rangos de fechas)
+    # En modo por noche cada tarea tiene un único rango; en modo batch hasta batch_size rangos.
+    tasks = []
+    for base_url in hotel_base_urls:
+        hotel_name = url_to_name[base_url]
+        ranges = pending_ranges[base_url]
+        if batch_mode:
+            for i in range(0, len(ranges), batch_size):
+                tasks.append((base_url, hotel_name, ranges[i:i + batch_size]))
+        else:
+            for checkin, checkout in ranges:
+                tasks.append((base_url, hotel_name, [(checkin, checkout)]))
     logger.info(f"Total de tareas a ejecutar: {len(tasks)}")
-    results = []
     completed = 0
-    with ThreadPoolExecutor(max_workers=15) as executor:
-        future_to_task = {
-            executor.submit(fetch_price_for_night, client, base_url, hotel_name, checkin, checkout, currency): (base_url, hotel_name, checkin, checkout)
-            for (base_url, hotel_name, checkin, checkout) in tasks
-        }
-        for future in as_completed(future_to_task):
-            base_url, hotel_name, checkin, checkout = future_to_task[future]
-            completed += 1
-            try:
-                result = future.result()
-                results.append(result)
-                logger.info(f"Progreso: {completed}/{len(tasks)} - {hotel_name} - {checkin}")
-            except Exception as exc:
-                logger.error(f"Error en {hotel_name} {checkin}: {exc}")
-                results.append((hotel_name, base_url, checkin, None, None, None))
-            # Delay reducido para acelerar el proceso
-            time.sleep(0.5)
-    # Construir DataFrame y recopilar metadata de hoteles
-    df_dict = {}
-    hotel_metadata = {}  # Diccionario: base_url -> {"rating": X, "reviews": Y, "name": Z}
+    total_quotes = len(hotel_base_urls) * len(date_ranges)
+    # Noches que todavía no llegaron a on_task_done, y noches perdidas por el deadline
+    undelivered = {(base_url, checkin) for base_url, _, task_ranges in tasks for checkin, _ in task_ranges}
+    missing_dates = {}  # base_url -> {checkin, ...}
     
-    for hotel_name, base_url, checkin, price, rating, reviews in results:
-        # Construir datos de precios por fecha
-        if base_url not in df_dict:
-            df_dict[base_url] = {"Hotel Name": hotel_name, "URL": base_url}
-        
-        # Recopilar metadata una vez por hotel (del primer resultado exitoso)
-        if base_url not in hotel_metadata and (rating is not None or reviews is not None):
-            hotel_metadata[base_url] = {
-                "rating": rating,
-                "reviews": reviews,
-                "name": hotel_name
-            }
-            logger.info(f"Metadata recopilada para {hotel_name}: rating={rating}, reviews={reviews}")
-        
-        # Si nights > 1 y price es numérico, dividir por nights para obtener precio por noche
-        if price is not None:
-            try:
-                price_float = float(price)
-                if nights > 1:
-                    price_float = round(price_float / nights, 2)
-                df_dict[base_url][checkin] = price_float
-            except Exception:
-                df_dict[base_url][checkin] = price
-        else:
-            df_dict[base_url][checkin] = price
+    def snapshot():
+        return build_results_table(list(results), hotel_base_urls, url_to_name, nights, log_metadata=False)[0]
+    
+    def notify_progress(new_quotes):
+        if progress_callback is None:
+            return
+        try:
+            progress_callback(len(results), total_quotes, snapshot, new_quotes)
+        except Exception as e:
+            logger.warning(f"Error en progress_callback: {e}")
+    
+    def on_task_done(base_url, hotel_name, task_ranges, task_results):
+        nonlocal completed
+        completed += 1
+        deadline_reached = deadline is not None and time.time() >= deadline
+        for _, _, task_checkin, price, _, _ in task_results:
+            undelivered.discard((base_url, task_checkin))
+            if price is None and deadline_reached:
+                missing_dates.setdefault(base_url, set()).add(task_checkin)
+        if use_cache:
+            for _, _, task_checkin, price, rating, reviews in task_results:
+                quote_cache.set(base_url, task_checkin, nights, scrape_currency, price, rating, reviews)
+        if fx_plan:
+            task_results = [
+                (name, url, task_checkin, to_report_currency(price), rating, reviews)
+                for name, url, task_checkin, price, rating, reviews in task_results
+            ]
+        results.extend(task_results)
+        logger.info(f"Progreso: {completed}/{len(tasks)} - {hotel_name} - {task_ranges[0][0]}")
+        notify_progress(task_results)
     
-    final_results = list(df_dict.values())
+    # Las noches de checkpoints y del cache ya están disponibles
+    if results:
+        notify_progress(new_cached_quotes)
+    
+    if engine == "asyncio":
+        import asyncio
+        from async_engine import run_tasks_async
+        asyncio.run(run_tasks_async(client, tasks, batch_mode, scrape_currency, on_task_done, deadline=deadline, usage=usage, budget=budget))
+    else:
+        run_tasks_threaded(client, tasks, batch_mode, scrape_currency, on_task_done, deadline=deadline, usage=usage, budget=budget)
+    # Noches de tareas canceladas por el deadline: quedan vacías en el reporte
+    for base_url, checkin in undelivered:
+        results.append((url_to_name[base_url], base_url, checkin, None, None, None))
+        missing_dates.setdefault(base_url, set()).add(checkin)
+    if missing_dates:
+        logger.warning(f"Deadline del reporte alcanzado: {sum(len(d) for d in missing_dates.values())} noches sin scrapear (reporte parcial)")
+    final_results, hotel_metadata = build_results_table(results, hotel_base_urls, url_to_name, nights, cached_dates, missing_dates=missing_dates)
+    # Guardar la metadata en el registro y completar la de hoteles servidos solo desde cache/checkpoints
+    for base_url, record in hotels:
+        metadata = hotel_metadata.get(base_url)
+        if metadata and (metadata.get("rating") is not None or metadata.get("reviews") is not None):
+            hotel_registry.update_metadata(base_url, metadata.get("rating"), metadata.get("reviews"))
+        elif record.get("rating") is not None or record.get("reviews") is not None:
+            metadata = hotel_metadata.setdefault(base_url, {"name": url_to_name[base_url]})
+            metadata["rating"] = record.get("rating")
+            metadata["reviews"] = record.get("reviews")
     logger.info(f"Scraping completado. Total de hoteles procesados: {len(final_results)}")
     logger.info(f"Metadata recopilada para {len(hotel_metadata)} hoteles")
     
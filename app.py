@@ -12,6 +12,7 @@ from google.cloud import storage
 from dotenv import load_dotenv
 import json
 from google.oauth2 import service_account
+from google.api_core.exceptions import Conflict
 import threading
 import logging
 from mailersend import MailerSendClient, EmailRequest, EmailContact
@@ -21,6 +22,18 @@ import time
 from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 import openpyxl
+from quote_cache import quote_cache, configure_persistent_store
+import hotel_registry
+import fx_rates
+from circuit_breaker import apify_breaker
+from rate_limiter import actor_run_budget
+from job_pool import FairJobQueue, ScrapeWorkerPool, job_lane
+from queue_listener import QueueListener
+from job_lease import JobLease, WORKER_ID, claim_job, reclaim_expired_leases
+from scrape_planner import ScrapeCoalescer, prefetch_group
+import schedule_window
+from group_scheduler import GroupScheduler, group_next_run_at
+from system_status import SystemStatus, count
 
 # --- CONFIGURACIÓN DE LOGGING ---
 logging.basicConfig(level=logging.INFO)
@@ -53,9 +66,16 @@ else:
 db = firestore.client()
 bucket = storage_client.bucket(GCS_BUCKET_NAME)
 
+# Cache de cotizaciones compartido entre reportes (nivel persistente en Firestore)
+configure_persistent_store(db)
+# Registro canónico de hoteles (nombres y metadata compartidos entre sets)
+hotel_registry.configure_persistent_store(db)
+# Tabla de tipos de cambio para scrapear en la moneda base y convertir localmente
+fx_rates.configure_persistent_store(db)
+
 # --- VARIABLE GLOBAL PARA EL ESTADO DEL SCRAPER (SIMPLE) ---
+# is_running no se guarda acá: con varios slots lo calcula scraper_running() desde el pool
 scraper_status = {
-    "is_running": False,
     "progress": 0,
     "total_tasks": 0,
     "completed_tasks": 0,
@@ -64,8 +84,12 @@ scraper_status = {
     "current_user": None
 }
 
-# Variable global para controlar si hay un scraper corriendo
-scraper_en_proceso = threading.Event()
+def scraper_running():
+    """True si algún slot del pool está procesando un reporte."""
+    return scraper_pool.running_count() > 0
+
+def scraper_status_snapshot():
+    return dict(scraper_status, is_running=scraper_running())
 
 # --- LÍMITES POR PLAN ---
 PLAN_LIMITS = {
@@ -73,31 +97,41 @@ PLAN_LIMITS = {
         "max_groups": 1,
         "max_competitors": 2,
         "max_days": 7,
-        "scheduling": False
+        "scheduling": False,
+        "max_job_minutes": 10,
+        "queue_weight": 1
     },
     "esencial": {
         "max_groups": 1,
         "max_competitors": 3,
         "max_days": 30,
-        "scheduling": False
+        "scheduling": False,
+        "max_job_minutes": 20,
+        "queue_weight": 2
     },
     "pro": {
         "max_groups": 3,
         "max_competitors": 5,
         "max_days": 60,
-        "scheduling": "weekly"
+        "scheduling": "weekly",
+        "max_job_minutes": 30,
+        "queue_weight": 3
     },
     "market_leader": {
         "max_groups": 5,
         "max_competitors": 7,
         "max_days": 90,
-        "scheduling": "weekly"
+        "scheduling": "weekly",
+        "max_job_minutes": 45,
+        "queue_weight": 4
     },
     "custom": {
         "max_groups": 8,
         "max_competitors": 7,
         "max_days": 90,
-        "scheduling": "weekly"
+        "scheduling": "weekly",
+        "max_job_minutes": 45,
+        "queue_weight": 4
     }
 }
 
@@ -121,20 +155,300 @@ def get_user_plan(uid):
         logger.error(f"Error obteniendo plan del usuario {uid}: {e}")
         return 'free_trial'
 
+# --- DATOS PARA GRÁFICOS ---
+def build_chart_data(result):
+    """
+    Genera chartData (una fila por fecha con el precio de cada hotel, el promedio de competidores y
+    la disponibilidad) a partir de las filas por hotel del scraper. El primer hotel es el principal.
+    Devuelve (chartData, hotelNames, all_dates).
+    """
+    hotelNames = [hotel["Hotel Name"] for hotel in result]
+    all_dates = set()
+    for hotel in result:
+        for k in hotel.keys():
+            if k not in ("Hotel Name", "URL"):
+                all_dates.add(k)
+    # Ordenar fechas cronológicamente de menor a mayor
+    from datetime import datetime as dt
+    all_dates = sorted(all_dates, key=lambda x: dt.strptime(x, "%Y-%m-%d"))
+    
+    # Generar chartData con el formato correcto para el frontend
+    chartData = []
+    for date in all_dates:
+        day_obj = {"date": date}
+        
+        # Añadir precios de cada hotel
+        for hotel in result:
+            name = hotel["Hotel Name"]
+            price = hotel.get(date, None)
+            if price is not None:
+                try:
+                    day_obj[name] = float(price)
+                except:
+                    day_obj[name] = None
+            else:
+                day_obj[name] = None
+        
+        # Calcular métricas para esta fecha
+        precios_validos = {}
+        for hotel in result:
+            name = hotel["Hotel Name"]
+            price = hotel.get(date, None)
+            if price is not None:
+                try:
+                    precios_validos[name] = float(price)
+                except:
+                    pass
+        
+        # Calcular promedio de competidores
+        hotel_principal = hotelNames[0] if hotelNames else None
+        competidores = hotelNames[1:] if len(hotelNames) > 1 else []
+        
+        if competidores and hotel_principal:
+            precios_competidores = [precios_validos.get(comp, 0) for comp in competidores if precios_validos.get(comp, 0) > 0]
+            if precios_competidores:
+                promedio = sum(precios_competidores) / len(precios_competidores)
+                day_obj["Tarifa promedio de competidores"] = round(promedio, 2)
+            else:
+                day_obj["Tarifa promedio de competidores"] = None
+            
+            # Calcular disponibilidad (%)
+            total_hoteles = len(hotelNames)
+            hoteles_con_precio = len([name for name in hotelNames if precios_validos.get(name) is not None])
+            disponibilidad_porcentaje = round((hoteles_con_precio / total_hoteles) * 100) if total_hoteles > 0 else 0
+            day_obj["Disponibilidad de la oferta (%)"] = disponibilidad_porcentaje
+        else:
+            day_obj["Tarifa promedio de competidores"] = None
+            day_obj["Disponibilidad de la oferta (%)"] = None
+        
+        chartData.append(day_obj)
+    
+    return chartData, hotelNames, all_dates
+
+# --- PROGRESO PARCIAL DE REPORTES ---
+# Mientras el scraper corre, el reporte recibe chartData parcial y un campo progress.
+# Las escrituras se agrupan: como máximo una cada SCRAPER_PROGRESS_FLUSH_SECONDS, o antes si
+# llegaron SCRAPER_PROGRESS_FLUSH_QUOTES cotizaciones nuevas.
+SCRAPER_STREAMING_PROGRESS = os.environ.get("SCRAPER_STREAMING_PROGRESS", "true").lower() == "true"
+SCRAPER_PROGRESS_FLUSH_QUOTES = int(os.environ.get("SCRAPER_PROGRESS_FLUSH_QUOTES", "10"))
+SCRAPER_PROGRESS_FLUSH_SECONDS = float(os.environ.get("SCRAPER_PROGRESS_FLUSH_SECONDS", "3"))
+
+# --- CHECKPOINTS Y LEASES ---
+# Cada cotización obtenida se guarda en scraping_reports/{id}/quotes para poder reanudar el
+# reporte si el worker muere. El worker que toma un reporte renueva su lease (ver job_lease); un
+# reporte 'pending' con el lease vencido se considera huérfano y vuelve a la cola.
+# Un reporte que tumbó al worker más de SCRAPER_MAX_RESUMES veces se marca como fallido
+SCRAPER_MAX_RESUMES = int(os.environ.get("SCRAPER_MAX_RESUMES", "3"))
+QUOTE_CHECKPOINTS_SUBCOLLECTION = "quotes"
+
+def checkpoint_doc_id(base_url, checkin):
+    import hashlib
+    return f"{checkin}_{hashlib.sha1(base_url.encode('utf-8')).hexdigest()[:16]}"
+
+def load_checkpointed_quotes(report_id):
+    """Devuelve {(base_url, checkin): (price, rating, reviews)} con los checkpoints del reporte."""
+    quotes = {}
+    try:
+        docs = db.collection("scraping_reports").document(report_id).collection(QUOTE_CHECKPOINTS_SUBCOLLECTION).stream()
+        for doc in docs:
+            data = doc.to_dict() or {}
+            if data.get("url") and data.get("checkIn") and data.get("price") is not None:
+                quotes[(data["url"], data["checkIn"])] = (data["price"], data.get("rating"), data.get("reviews"))
+    except Exception as e:
+        logger.warning(f"[Scraper] Error leyendo checkpoints de {report_id}: {e}")
+    return quotes
+
+def delete_checkpointed_quotes(report_id):
+    """Borra los checkpoints de un reporte terminado (en lotes de hasta 500)."""
+    try:
+        docs = list(db.collection("scraping_reports").document(report_id).collection(QUOTE_CHECKPOINTS_SUBCOLLECTION).stream())
+        for i in range(0, len(docs), 500):
+            batch = db.batch()
+            for doc in docs[i:i + 500]:
+                batch.delete(doc.reference)
+            batch.commit()
+    except Exception as e:
+        logger.warning(f"[Scraper] Error borrando checkpoints de {report_id}: {e}")
+
+class ReportProgressWriter:
+    """
+    Recibe el progreso del scraper y lo vuelca al documento del reporte en segundo plano:
+    chartData parcial, progress, heartbeatAt y un checkpoint por cada cotización nueva.
+    """
+    
+    def __init__(self, report_id, flush_quotes=SCRAPER_PROGRESS_FLUSH_QUOTES, flush_seconds=SCRAPER_PROGRESS_FLUSH_SECONDS):
+        self.doc_ref = db.collection("scraping_reports").document(report_id)
+        self.flush_quotes = flush_quotes
+        self.flush_seconds = flush_seconds
+        self.completed = 0
+        self.total = 0
+        self.snapshot = None
+        self.flushed_completed = 0
+        self.flushes = 0
+        self.pending_checkpoints = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def start(self):
+        self._thread.start()
+        return self
+    
+    def __call__(self, completed, total, snapshot, new_quotes=()):
+        # progress_callback de scrape_booking_data: solo guarda el estado, no escribe
+        with self._lock:
+            self.completed = completed
+            self.total = total
+            self.snapshot = snapshot
+            self.pending_checkpoints.extend(quote for quote in new_quotes if quote[3] is not None)
+            pending = self.completed - self.flushed_completed
+        scraper_status["completed_tasks"] = completed
+        scraper_status["total_tasks"] = total
+        scraper_status["progress"] = round(completed / total * 100) if total else 0
+        if pending >= self.flush_quotes:
+            self._wake.set()
+    
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            if not self._stopped.is_set():
+                self.flush()
+                # Firestore admite ~1 escritura sostenida por segundo por documento
+                self._stopped.wait(1.0)
+    
+    def build_update(self):
+        with self._lock:
+            if self.snapshot is None or self.completed == self.flushed_completed:
+                return None
+            completed, total, snapshot = self.completed, self.total, self.snapshot
+            checkpoints, self.pending_checkpoints = self.pending_checkpoints, []
+        chartData, hotelNames, _ = build_chart_data(snapshot())
+        now = datetime.now()
+        return completed, checkpoints, {
+            "chartData": chartData,
+            "hotelNames": hotelNames,
+            "heartbeatAt": now,
+            "progress": {
+                "completed": completed,
+                "total": total,
+                "percent": round(completed / total * 100) if total else 0,
+                "updatedAt": now
+            }
+        }
+    
+    def flush(self):
+        update = None
+        try:
+            update = self.build_update()
+            if update is None:
+                # Sin cotizaciones nuevas (el lease del reporte lo renueva JobLease)
+                return
+            completed, checkpoints, data = update
+            quotes_ref = self.doc_ref.collection(QUOTE_CHECKPOINTS_SUBCOLLECTION)
+            # Un batch admite 500 operaciones: la actualización del reporte va en el primero
+            batch = db.batch()
+            batch.update(self.doc_ref, data)
+            ops = 1
+            for hotel_name, base_url, checkin, price, rating, reviews in checkpoints:
+                if ops >= 500:
+                    batch.commit()
+                    batch = db.batch()
+                    ops = 0
+                batch.set(quotes_ref.document(checkpoint_doc_id(base_url, checkin)), {
+                    "url": base_url,
+                    "checkIn": checkin,
+                    "price": price,
+                    "rating": rating,
+                    "reviews": reviews,
+                    "savedAt": data["heartbeatAt"]
+                })
+                ops += 1
+            batch.commit()
+            with self._lock:
+                self.flushed_completed = completed
+            self.flushes += 1
+            logger.info(f"[Scraper] Progreso parcial guardado ({completed}/{data['progress']['total']}, {len(checkpoints)} checkpoints) en {self.doc_ref.id}")
+        except Exception as e:
+            logger.warning(f"[Scraper] Error guardando progreso parcial de {self.doc_ref.id}: {e}")
+            if update is not None:
+                # Reintentar los checkpoints en el próximo flush
+                with self._lock:
+                    self.pending_checkpoints = update[1] + self.pending_checkpoints
+    
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join(timeout=5)
+        # Último volcado para no perder checkpoints si falla el guardado final del reporte
+        self.flush()
+
+# --- CONSUMO DE APIFY ---
+# Cada reporte guarda el consumo de sus ejecuciones del actor (campo usage) y lo suma al
+# acumulado del usuario en APIFY_USAGE_COLLECTION/{uid}: totales, por set y el plan del usuario.
+APIFY_USAGE_COLLECTION = os.environ.get("APIFY_USAGE_COLLECTION", "apify_usage")
+USAGE_ROLLUP_FIELDS = ("runs", "computeUnits", "usageUsd", "runSeconds", "retries", "datasetItems", "datasetBytes", "hotelNights")
+
+def record_usage_rollup(userId, setId, plan, summary):
+    """Suma el consumo de un reporte al acumulado del usuario (con firestore.Increment)."""
+    if not userId:
+        return
+    totals = {field: firestore.Increment(summary.get(field) or 0) for field in USAGE_ROLLUP_FIELDS}
+    totals["reports"] = firestore.Increment(1)
+    data = {
+        "userId": userId,
+        "plan": plan,
+        "totals": totals,
+        "updatedAt": datetime.now()
+    }
+    if setId:
+        data["sets"] = {setId: dict(totals)}
+    try:
+        db.collection(APIFY_USAGE_COLLECTION).document(userId).set(data, merge=True)
+    except Exception as e:
+        logger.warning(f"[Scraper] Error guardando el consumo de Apify de {userId}: {e}")
+
+def usage_per_hotel_night(totals):
+    """Agrega a un acumulado el costo y los compute units por hotel-noche."""
+    hotel_nights = totals.get("hotelNights") or 0
+    totals["usdPerHotelNight"] = round(totals.get("usageUsd", 0) / hotel_nights, 6) if hotel_nights else None
+    totals["computeUnitsPerHotelNight"] = round(totals.get("computeUnits", 0) / hotel_nights, 6) if hotel_nights else None
+    return totals
+
 # --- FUNCIÓN ASÍNCRONA PARA EL SCRAPER (SIMPLE) ---
-def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, nights=1, currency="USD", report_id=None, userId=None, setId=None, start_date=None):
+def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, nights=1, currency="USD", report_id=None, userId=None, setId=None, start_date=None, exact_prices=False, budget=None, lease=None, prefetched_quotes=None, coalescing=None):
     global scraper_status
     try:
         logger.info(f"[Scraper] INICIO run_scraper_async para reporte: {report_id} | hoteles: {hotel_base_urls}")
-        scraper_status["is_running"] = True
         scraper_status["error"] = None
         scraper_status["progress"] = 0
         
         from apify_scraper import scrape_booking_data
+        from run_usage import RunUsage
         
         logger.info(f"[Scraper] Ejecutando scraper para {len(hotel_base_urls)} hoteles por {days} días, {nights} noches, moneda {currency}, fecha inicio: {start_date or 'hoy'}")
         logger.info(f"[Scraper] DEBUG - start_date recibido: {start_date} (tipo: {type(start_date)})")
-        result, hotel_metadata = scrape_booking_data(hotel_base_urls, days, nights, currency, start_date)
+        progress_writer = None
+        checkpointed_quotes = {}
+        if SCRAPER_STREAMING_PROGRESS and report_id:
+            checkpointed_quotes = load_checkpointed_quotes(report_id)
+            if checkpointed_quotes:
+                logger.info(f"[Scraper] Reanudando reporte {report_id} con {len(checkpointed_quotes)} noches ya scrapeadas")
+            progress_writer = ReportProgressWriter(report_id).start()
+        # Scrapear en la moneda base y convertir localmente, salvo que se pidan los precios exactos de Booking
+        fx_plan = fx_rates.plan_conversion(currency, exact_prices)
+        # Deadline del reporte según el plan: al vencer se cierra con las noches obtenidas (parcial)
+        user_plan = get_user_plan(userId) if userId else "free_trial"
+        plan_limits = PLAN_LIMITS.get(user_plan, PLAN_LIMITS["free_trial"])
+        deadline = time.time() + plan_limits["max_job_minutes"] * 60
+        logger.info(f"[Scraper] Deadline del reporte: {plan_limits['max_job_minutes']} minutos")
+        usage = RunUsage()
+        try:
+            result, hotel_metadata = scrape_booking_data(hotel_base_urls, days, nights, currency, start_date, progress_callback=progress_writer, checkpointed_quotes=checkpointed_quotes, fx_plan=fx_plan, deadline=deadline, usage=usage, budget=budget, prefetched_quotes=prefetched_quotes)
+        finally:
+            if progress_writer:
+                progress_writer.stop()
         
         if not result:
             logger.error(f"[Scraper] ERROR: No se obtuvieron datos del scraper. Antes de raise Exception...")
@@ -144,70 +458,11 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
         logger.info(f"[Scraper] Metadata de hoteles obtenida: {len(hotel_metadata)} hoteles")
         
         # --- ENRIQUECER DATOS PARA GRÁFICOS ---
-        hotelNames = [hotel["Hotel Name"] for hotel in result]
-        all_dates = set()
-        for hotel in result:
-            for k in hotel.keys():
-                if k not in ("Hotel Name", "URL"):
-                    all_dates.add(k)
-        # Ordenar fechas cronológicamente de menor a mayor
-        from datetime import datetime as dt
-        all_dates = sorted(all_dates, key=lambda x: dt.strptime(x, "%Y-%m-%d"))
+        chartData, hotelNames, all_dates = build_chart_data(result)
         column_order = ["Hotel Name", "URL"] + all_dates
         
         logger.info(f"[Scraper] Procesando {len(all_dates)} fechas para {len(hotelNames)} hoteles")
         
-        # Generar chartData con el formato correcto para el frontend
-        chartData = []
-        for date in all_dates:
-            day_obj = {"date": date}
-            
-            # Añadir precios de cada hotel
-            for hotel in result:
-                name = hotel["Hotel Name"]
-                price = hotel.get(date, None)
-                if price is not None:
-                    try:
-                        day_obj[name] = float(price)
-                    except:
-                        day_obj[name] = None
-                else:
-                    day_obj[name] = None
-            
-            # Calcular métricas para esta fecha
-            precios_validos = {}
-            for hotel in result:
-                name = hotel["Hotel Name"]
-                price = hotel.get(date, None)
-                if price is not None:
-                    try:
-                        precios_validos[name] = float(price)
-                    except:
-                        pass
-            
-            # Calcular promedio de competidores
-            hotel_principal = hotelNames[0] if hotelNames else None
-            competidores = hotelNames[1:] if len(hotelNames) > 1 else []
-            
-            if competidores and hotel_principal:
-                precios_competidores = [precios_validos.get(comp, 0) for comp in competidores if precios_validos.get(comp, 0) > 0]
-                if precios_competidores:
-                    promedio = sum(precios_competidores) / len(precios_competidores)
-                    day_obj["Tarifa promedio de competidores"] = round(promedio, 2)
-                else:
-                    day_obj["Tarifa promedio de competidores"] = None
-                
-                # Calcular disponibilidad (%)
-                total_hoteles = len(hotelNames)
-                hoteles_con_precio = len([name for name in hotelNames if precios_validos.get(name) is not None])
-                disponibilidad_porcentaje = round((hoteles_con_precio / total_hoteles) * 100) if total_hoteles > 0 else 0
-                day_obj["Disponibilidad de la oferta (%)"] = disponibilidad_porcentaje
-            else:
-                day_obj["Tarifa promedio de competidores"] = None
-                day_obj["Disponibilidad de la oferta (%)"] = None
-            
-            chartData.append(day_obj)
-        
         logger.info(f"[Scraper] ChartData generado con {len(chartData)} días")
         
         # Asegurar que hotelNames esté correctamente ordenado (hotel principal primero)
@@ -311,8 +566,11 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
         
         # Guardar Excel con pie de página y ajuste de columnas
         from openpyxl import load_workbook
-        df_excel.to_excel('temp_excel_upload.xlsx', sheet_name='Tarifas', index=False)
-        wb = load_workbook('temp_excel_upload.xlsx')
+        # En memoria: varios reportes terminan a la vez en el pool y no deben compartir archivo
+        excel_buffer = io.BytesIO()
+        df_excel.to_excel(excel_buffer, sheet_name='Tarifas', index=False)
+        excel_buffer.seek(0)
+        wb = load_workbook(excel_buffer)
         ws = wb['Tarifas']
         # --- Formato profesional (colores, título, encabezados, etc) ---
         # Definir colores de la marca
@@ -433,14 +691,14 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
             cell.fill = titulo_fondo  # Mismo fondo azul que el título
         
         # 8. GUARDAR EL ARCHIVO CON FORMATO APLICADO
-        wb.save('temp_excel_upload.xlsx')
-        
-        with open('temp_excel_upload.xlsx', 'rb') as f:
-            excel_blob = bucket.blob(excel_blob_name)
-            # Añadir metadatos personalizados con userId para las reglas de seguridad
-            excel_blob.metadata = {'userId': userId}
-            excel_blob.upload_from_file(f, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        os.remove('temp_excel_upload.xlsx')
+        excel_buffer = io.BytesIO()
+        wb.save(excel_buffer)
+        excel_buffer.seek(0)
+        
+        excel_blob = bucket.blob(excel_blob_name)
+        # Añadir metadatos personalizados con userId para las reglas de seguridad
+        excel_blob.metadata = {'userId': userId}
+        excel_blob.upload_from_file(excel_buffer, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         logger.info(f"[Scraper] Archivo Excel generado y subido: {excel_blob_name}")
         
         # --- GUARDAR EN FIRESTORE ---
@@ -509,6 +767,30 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
         
         logger.info(f"[Scraper] Positioning data construida con {len(positioning_data)} hoteles")
 
+        # Noches servidas desde el cache de cotizaciones (sin ejecutar el actor)
+        cached_dates = {
+            metadata.get("name", url): metadata["cached_dates"]
+            for url, metadata in hotel_metadata.items()
+            if metadata.get("cached_dates")
+        }
+        cache_info = {
+            "cachedQuotes": sum(len(dates) for dates in cached_dates.values()),
+            "cachedDates": cached_dates
+        }
+
+        # Noches que quedaron sin scrapear porque venció el deadline del reporte
+        missing_dates = {
+            metadata.get("name", url): metadata["missing_dates"]
+            for url, metadata in hotel_metadata.items()
+            if metadata.get("missing_dates")
+        }
+        if missing_dates:
+            logger.warning(f"[Scraper] Reporte {report_id} parcial: {sum(len(d) for d in missing_dates.values())} noches sin datos por deadline")
+
+        # Consumo de Apify del reporte (las noches servidas desde cache cuentan para el costo por hotel-noche)
+        usage_summary = usage.get_summary(hotel_nights=days * len(hotelNames), cached_nights=cache_info["cachedQuotes"])
+        logger.info(f"[Scraper] Consumo de Apify del reporte {report_id}: {usage_summary['runs']} ejecuciones, {usage_summary['computeUnits']} CU, {usage_summary['usageUsd']} USD")
+
         report_data = {
             "status": "completed",
             "csvFileUrl": csv_signed_url,
@@ -525,15 +807,36 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
             "nights": nights,
             "currency": currency,
             "start_date": start_date,
-            "positioning_data": positioning_data
+            "positioning_data": positioning_data,
+            "cache": cache_info,
+            "fx": fx_plan,
+            "partial": bool(missing_dates),
+            "missingDates": missing_dates,
+            "usage": usage_summary,
+            "coalescing": coalescing,
+            "progress": {
+                "completed": days * len(hotelNames),
+                "total": days * len(hotelNames),
+                "percent": 100,
+                "updatedAt": now
+            }
         }
         
         logger.info(f"[Scraper] ANTES de intentar guardar en Firestore. report_data keys: {list(report_data.keys())}")
         
         try:
             logger.info(f"[Scraper] Guardando documento en Firestore con .set()... (ID: {report_id})")
-            db.collection("scraping_reports").document(report_id).set(report_data)
+            if lease is not None:
+                # Solo el dueño del lease guarda el resultado (otro worker pudo reclamar el reporte)
+                if not lease.commit(report_data):
+                    record_usage_rollup(userId, setId if setId else report_id, user_plan, usage_summary)
+                    logger.warning(f"[Scraper] Reporte {report_id} reclamado por otro worker: se descarta este resultado")
+                    return
+            else:
+                db.collection("scraping_reports").document(report_id).set(report_data)
             logger.info(f"[Scraper] ✅ Documento guardado exitosamente en Firestore (ID: {report_id})")
+            delete_checkpointed_quotes(report_id)
+            record_usage_rollup(userId, setId if setId else report_id, user_plan, usage_summary)
         except Exception as e:
             logger.error(f"[Scraper] ❌ ERROR al guardar documento en Firestore (ID: {report_id}): {e}")
             logger.error(f"[Scraper] ❌ Tipo de error: {type(e)}")
@@ -617,7 +920,6 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
         logger.info(f"[Scraper] Actualizando scraper_status...")
         scraper_status["result"] = report_data
         scraper_status["progress"] = 100
-        scraper_status["is_running"] = False
         logger.info(f"[Scraper] ✅ FIN run_scraper_async (éxito) - report_id: {report_id}")
         
     except Exception as e:
@@ -629,11 +931,15 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
         try:
             now = datetime.now()
             logger.info(f"[Scraper] Intentando actualizar documento a failed en Firestore (ID: {report_id})...")
-            db.collection("scraping_reports").document(report_id).update({
+            failed_data = {
                 "status": "failed",
                 "completedAt": now,
                 "error": str(e)
-            })
+            }
+            if lease is not None:
+                lease.commit(failed_data, merge=True)
+            else:
+                db.collection("scraping_reports").document(report_id).update(failed_data)
             logger.info(f"[Scraper] ✅ Reporte {report_id} marcado como failed en Firestore")
         except Exception as e2:
             logger.error(f"[Scraper] ❌ ERROR actualizando status failed en Firestore: {e2}")
@@ -641,78 +947,338 @@ def run_scraper_async(hotel_base_urls, days, userEmail=None, setName=None, night
         
         logger.info(f"[Scraper] Actualizando scraper_status con error...")
         scraper_status["error"] = str(e)
-        scraper_status["is_running"] = False
         scraper_status["current_user"] = None
         logger.info(f"[Scraper] ❌ FIN run_scraper_async (fallo) - report_id: {report_id}")
 
+def reclaim_orphaned_reports():
+    """
+    Devuelve a la cola los reportes 'pending' cuyo lease venció (el worker que los procesaba
+    murió). Al reprocesarse, run_scraper_async reanuda desde los checkpoints.
+    """
+    requeued, failed = reclaim_expired_leases(db, SCRAPER_MAX_RESUMES)
+    if requeued or failed:
+        logger.warning(f"[ColaScraping] Reportes huérfanos: {requeued} devueltos a la cola, {failed} marcados como fallidos")
+    return requeued
+
+# --- POOL DE WORKERS DE LA COLA ---
+# La cola la procesa el proceso worker (worker.py, línea worker: del Procfile). Importar este
+# módulo no lanza threads; con SCRAPER_EMBEDDED_WORKER=true el procesador corre dentro del
+# proceso web (desarrollo o despliegues de un solo proceso).
+SCRAPER_EMBEDDED_WORKER = os.environ.get("SCRAPER_EMBEDDED_WORKER", "false").lower() == "true"
+# Reportes 'queued' que se leen por vuelta para repartir los slots libres entre usuarios y planes
+SCRAPER_QUEUE_FETCH_LIMIT = int(os.environ.get("SCRAPER_QUEUE_FETCH_LIMIT", "100"))
+# Se activa para que cola_procesadora_scraping deje de tomar reportes y termine
+queue_stop = threading.Event()
+# Cada cuánto se publican posición y ETA en los reportes encolados (solo los que cambiaron)
+SCRAPER_QUEUE_POSITION_UPDATE_SECONDS = float(os.environ.get("SCRAPER_QUEUE_POSITION_UPDATE_SECONDS", "30"))
+
+def hotel_urls_from_report(data):
+    """Hoteles del reporte (denormalizados en el documento): el propio primero y luego los competidores."""
+    hotel_base_urls = []
+    if data.get('ownHotelUrl'):
+        hotel_base_urls.append(data['ownHotelUrl'])
+    comp_urls = data.get('competitorHotelUrls')
+    if comp_urls:
+        if isinstance(comp_urls, list):
+            hotel_base_urls.extend(comp_urls)
+        elif isinstance(comp_urls, str):
+            hotel_base_urls.append(comp_urls)
+        else:
+            logger.warning(f"[ColaScraping][DEBUG] competitorHotelUrls tiene un tipo inesperado: {type(comp_urls)}")
+    return hotel_base_urls
+
+def build_queue_job(doc, plans):
+    """
+    Arma el trabajo de la cola para un reporte 'queued', o None si no se puede procesar (se marca
+    como fallido). plans cachea el plan de cada usuario durante la vuelta.
+    """
+    data = doc.to_dict()
+    if data is None:
+        logger.error(f"[ColaScraping] El documento {doc.id} no tiene datos. Saltando...")
+        return None
+    hotel_base_urls = hotel_urls_from_report(data)
+    if not hotel_base_urls:
+        logger.error(f"[ColaScraping] La tarea {doc.id} no tiene hoteles para analizar. Saltando...")
+        doc.reference.update({'status': 'failed', 'error': 'No se encontraron hoteles para analizar'})
+        return None
+    user_id = data.get('userId')
+    if user_id not in plans:
+        plans[user_id] = get_user_plan(user_id) if user_id else "free_trial"
+    days = data.get('days', data.get('daysToScrape', 7))
+    return {
+        "id": doc.id,
+        "ref": doc.reference,
+        "userId": user_id,
+        "plan": plans[user_id],
+        "lane": job_lane(data),
+        "cost": len(hotel_base_urls) * (days or 1),
+        "hotelUrls": hotel_base_urls,
+        "data": data,
+    }
+
+def claim_queue_job(job):
+    # Los reportes de un lote de coalescing ya se tomaron (con lease) antes del prefetch
+    if job.get("preclaimed"):
+        return True
+    # Transacción: si otro proceso (u otra foto atrasada del listener) ya lo tomó, se saltea
+    if not claim_job(db, job["ref"]):
+        logger.info(f"[ColaScraping] El reporte {job['id']} ya fue tomado por otro worker. Saltando...")
+        return False
+    return True
+
+def run_queue_job(job):
+    """Procesa un reporte de la cola en un slot del pool, con su parte del presupuesto de ejecuciones."""
+    data = job["data"]
+    logger.info(f"[ColaScraping] Procesando tarea: {job['id']} - {data.get('setName', '')} con hoteles: {job['hotelUrls']}")
+    budget = actor_run_budget.lease(job["id"])
+    lease = job.get("lease") or JobLease(db, job["ref"]).start()
+    try:
+        run_scraper_async(
+            job["hotelUrls"],
+            data.get('days', data.get('daysToScrape', 7)),
+            data.get('userEmail', None),
+            data.get('setName', None),
+            data.get('nights', 1),
+            data.get('currency', 'USD'),
+            report_id=job["id"],
+            userId=data.get('userId', None),
+            setId=data.get('setId', None),
+            start_date=data.get('start_date', data.get('startDate', None)),  # Nueva fecha de inicio
+            exact_prices=data.get('exactPrices', False),
+            budget=budget,
+            lease=lease,
+            prefetched_quotes=job.get("prefetched"),
+            coalescing=job.get("coalescing")
+        )
+    finally:
+        lease.stop()
+        budget.close()
+
+scraper_pool = ScrapeWorkerPool(
+    run_queue_job,
+    queue=FairJobQueue(plan_weights={plan: limits["queue_weight"] for plan, limits in PLAN_LIMITS.items()})
+)
+
+def queued_reports_query():
+    return (
+        db.collection('scraping_reports')
+        .where('status', '==', 'queued')
+        .order_by('createdAt')
+        .limit(SCRAPER_QUEUE_FETCH_LIMIT)
+    )
+
+# Despierta al dispatcher apenas entra un reporte a la cola (ver queue_listener)
+queue_listener = QueueListener(queued_reports_query, on_change=scraper_pool.wake)
+
+def claim_coalesced_job(job):
+    """Toma un reporte para un lote de coalescing; el lease se renueva mientras dura el prefetch."""
+    try:
+        if not claim_job(db, job["ref"]):
+            return False
+    except Exception as e:
+        logger.error(f"[ColaScraping] Error reclamando el reporte {job['id']} para coalescing: {e}")
+        return False
+    job["lease"] = JobLease(db, job["ref"]).start()
+    job["preclaimed"] = True
+    return True
+
+def prefetch_coalesced_group(group, batch_id, usage, deadline):
+    """Prefetch de un grupo del lote con su parte del presupuesto global de ejecuciones."""
+    budget = actor_run_budget.lease(batch_id)
+    try:
+        return prefetch_group(group, usage=usage, budget=budget, deadline=deadline)
+    finally:
+        budget.close()
+
+def release_coalesced_jobs(jobs):
+    """Terminado el prefetch, los reportes del lote pasan a la cola del pool con sus cotizaciones."""
+    for job in jobs:
+        scraper_pool.queue.push(job)
+    scraper_pool.wake()
+
+# Planificador de lotes: scrapea una sola vez las cotizaciones que comparten los reportes encolados
+scraper_coalescer = ScrapeCoalescer(claim_coalesced_job, prefetch_coalesced_group, release_coalesced_jobs)
+
+# id de reporte -> (posición, ETA en segundos) publicados por última vez
+published_queue_positions = {}
+
+def publish_queue_positions():
+    """
+    Escribe en cada reporte encolado su carril, su posición en la cola y el ETA estimado de inicio
+    (queuePosition, queueLane, queueEtaSeconds, queueEtaAt). Solo se escriben los que cambiaron de
+    posición o cuyo ETA se movió más de un minuto.
+    """
+    now = datetime.now()
+    estimates = scraper_pool.queue_estimates()
+    current = {job["id"] for job, _, _ in estimates}
+    for job_id in list(published_queue_positions):
+        if job_id not in current:
+            del published_queue_positions[job_id]
+    updates = []
+    for job, position, eta_seconds in estimates:
+        previous = published_queue_positions.get(job["id"])
+        if previous and previous[0] == position and abs(previous[1] - eta_seconds) < 60:
+            continue
+        updates.append((job, position, eta_seconds))
+    # Batches de hasta 400 escrituras (Firestore admite 500 por batch)
+    for i in range(0, len(updates), 400):
+        batch = db.batch()
+        for job, position, eta_seconds in updates[i:i + 400]:
+            batch.update(job["ref"], {
+                "queuePosition": position,
+                "queueLane": job.get("lane"),
+                "queueEtaSeconds": round(eta_seconds),
+                "queueEtaAt": now + timedelta(seconds=eta_seconds),
+                "queueUpdatedAt": now,
+            })
+        batch.commit()
+        for job, position, eta_seconds in updates[i:i + 400]:
+            published_queue_positions[job["id"]] = (position, eta_seconds)
+    if updates:
+        logger.info(f"[ColaScraping] Posición y ETA actualizados en {len(updates)} reportes encolados")
+
+def maybe_publish_queue_positions(last_update):
+    """Publica posiciones y ETA si pasó SCRAPER_QUEUE_POSITION_UPDATE_SECONDS. Devuelve el momento de la última publicación."""
+    if time.time() - last_update < SCRAPER_QUEUE_POSITION_UPDATE_SECONDS:
+        return last_update
+    try:
+        publish_queue_positions()
+    except Exception as e:
+        logger.error(f"[ColaScraping] Error publicando posiciones de la cola: {e}")
+    return time.time()
+
+def sync_queue(docs):
+    """Arma los trabajos de los reportes 'queued' y los deja en la cola del pool (ver FairJobQueue.sync)."""
+    plans = {}
+    jobs = []
+    for doc in docs:
+        if scraper_pool.is_running(doc.id) or scraper_coalescer.holds(doc.id):
+            continue
+        job = build_queue_job(doc, plans)
+        if job is not None:
+            jobs.append(job)
+    # Los reportes que toma un lote esperan su prefetch fuera de la cola del pool
+    held = scraper_coalescer.plan(jobs, capacity=scraper_pool.slots)
+    if held:
+        jobs = [job for job in jobs if job["id"] not in held]
+    scraper_pool.queue.sync(jobs)
+
 def cola_procesadora_scraping():
-    global scraper_en_proceso
-    while True:
+    last_orphan_check = 0
+    last_position_update = 0
+    synced_snapshots = -1
+    while not queue_stop.is_set():
         try:
-            if scraper_en_proceso.is_set():
-                time.sleep(5)
-                continue
-            logger.info("[ColaScraping] Bucle activo. Buscando tareas encoladas...")
-            query = (
-                db.collection('scraping_reports')
-                .where('status', '==', 'queued')
-                .order_by('createdAt')
-                .limit(1)
-            )
-            docs = list(query.stream())
-            if not docs:
-                logger.info("[ColaScraping] No se encontraron tareas encoladas. Esperando 20s...")
-                time.sleep(20)
+            queue_listener.ensure_connected()
+            if scraper_pool.free_slots() <= 0:
+                # Con los slots ocupados se sigue la cola con la foto del listener (sin consultas)
+                # para que los reportes nuevos vean su posición y ETA
+                snapshots = queue_listener.snapshot_count()
+                docs = queue_listener.latest_docs() if snapshots != synced_snapshots else None
+                if docs is not None:
+                    sync_queue(docs)
+                    synced_snapshots = snapshots
+                last_position_update = maybe_publish_queue_positions(last_position_update)
+                scraper_pool.wait_for_slot(5)
                 continue
-            doc = docs[0]
-            doc_ref = doc.reference
-            data = doc.to_dict()
-            if data is None:
-                logger.error(f"[ColaScraping] El documento {doc_ref.id} no tiene datos. Saltando...")
+            # Con el circuit breaker abierto los reportes esperan en la cola en lugar de gastar ejecuciones
+            if apify_breaker.is_open():
+                wait = apify_breaker.seconds_until_retry()
+                logger.warning(f"[ColaScraping] Circuit breaker de Apify abierto: se reintenta en {wait:.0f}s")
+                time.sleep(min(max(wait, 1), 30))
                 continue
-            # LOGS DE DEPURACIÓN
-            logger.info(f"[ColaScraping][DEBUG] Documento Firestore data: {data}")
-            logger.info(f"[ColaScraping][DEBUG] ownHotelUrl: {data.get('ownHotelUrl')} (tipo: {type(data.get('ownHotelUrl'))})")
-            logger.info(f"[ColaScraping][DEBUG] competitorHotelUrls: {data.get('competitorHotelUrls')} (tipo: {type(data.get('competitorHotelUrls'))})")
-            # Obtener hoteles directamente del documento (denormalización)
-            hotel_base_urls = []
-            if data.get('ownHotelUrl'):
-                hotel_base_urls.append(data['ownHotelUrl'])
-            comp_urls = data.get('competitorHotelUrls')
-            if comp_urls:
-                if isinstance(comp_urls, list):
-                    hotel_base_urls.extend(comp_urls)
-                elif isinstance(comp_urls, str):
-                    hotel_base_urls.append(comp_urls)
-                else:
-                    logger.warning(f"[ColaScraping][DEBUG] competitorHotelUrls tiene un tipo inesperado: {type(comp_urls)}")
-            logger.info(f"[ColaScraping][DEBUG] hotel_base_urls final: {hotel_base_urls}")
-            if not hotel_base_urls:
-                logger.error(f"[ColaScraping] La tarea {doc_ref.id} no tiene hoteles para analizar. Saltando...")
-                doc_ref.update({'status': 'failed', 'error': 'No se encontraron hoteles para analizar'})
+            # Buscar reportes huérfanos como máximo una vez por minuto
+            if time.time() - last_orphan_check >= 60:
+                last_orphan_check = time.time()
+                try:
+                    reclaim_orphaned_reports()
+                except Exception as e:
+                    logger.error(f"[ColaScraping] Error buscando reportes huérfanos: {e}")
+            # Usar la foto del listener; consultar solo si está caído o toca la red de seguridad
+            docs = queue_listener.latest_docs()
+            if docs is None:
+                logger.info("[ColaScraping] Bucle activo. Buscando tareas encoladas...")
+                docs = list(queued_reports_query().stream())
+                queue_listener.mark_polled()
+            sync_queue(docs)
+            if not len(scraper_pool.queue):
+                wait = queue_listener.next_wait()
+                logger.info(f"[ColaScraping] No se encontraron tareas encoladas. Esperando hasta {wait:.0f}s...")
+                scraper_pool.wait_for_slot(wait)
                 continue
-            logger.info(f"[ColaScraping] Procesando tarea: {doc_ref.id} - {data.get('setName', '')} con hoteles: {hotel_base_urls}")
-            doc_ref.update({'status': 'pending'})
-            # Marcar que hay un scraper en proceso
-            scraper_en_proceso.set()
-            # Ejecutar el scraper con los datos del documento
-            run_scraper_async(
-                hotel_base_urls,
-                data.get('days', data.get('daysToScrape', 7)),
-                data.get('userEmail', None),
-                data.get('setName', None),
-                data.get('nights', 1),
-                data.get('currency', 'USD'),
-                report_id=doc_ref.id,
-                userId=data.get('userId', None),
-                setId=data.get('setId', None),
-                start_date=data.get('start_date', data.get('startDate', None))  # Nueva fecha de inicio
-            )
-            # Cuando termine, limpiar el flag
-            scraper_en_proceso.clear()
+            launched = scraper_pool.dispatch(claim_queue_job)
+            logger.info(f"[ColaScraping] {launched} reportes lanzados, {len(scraper_pool.queue)} en espera, "
+                        f"{scraper_pool.running_count()}/{scraper_pool.slots} slots ocupados")
+            last_position_update = maybe_publish_queue_positions(last_position_update)
+            # Esperar a que se libere un slot o llegue un reporte nuevo
+            scraper_pool.wait_for_slot(queue_listener.next_wait())
         except Exception as e:
             logger.error(f"[ColaScraping] Error en cola_procesadora_scraping: {e}")
-        time.sleep(5)
+            queue_stop.wait(5)
+    logger.info("[ColaScraping] Procesador de la cola detenido: no se toman reportes nuevos")
+
+def stop_queue_worker():
+    """Deja de tomar reportes y de programar grupos (los reportes en curso siguen hasta terminar)."""
+    queue_stop.set()
+    scraper_pool.wake()
+    group_scheduler.stop()
+
+def start_embedded_worker():
+    """
+    Lanza el procesador de la cola y el scheduler de grupos en threads del proceso actual
+    (SCRAPER_EMBEDDED_WORKER). Con varios procesos, la elección de líder deja un solo scheduler activo.
+    """
+    thread = threading.Thread(target=cola_procesadora_scraping, daemon=True, name="cola-scraping")
+    thread.start()
+    group_scheduler.start()
+    logger.info("[ColaScraping] Procesador de la cola y scheduler embebidos en el proceso web")
+    return thread
+
+# Máximo de escrituras por batch de Firestore
+FIRESTORE_BATCH_LIMIT = 500
+
+def enqueue_reports(reports):
+    """
+    Encola reportes con ids deterministas: reports es [(doc_id, report_doc), ...]. Se escriben con
+    batches de create (hasta FIRESTORE_BATCH_LIMIT por commit), así volver a encolar el mismo
+    reporte no lo duplica ni pisa el existente. Devuelve (creados, ya existentes).
+    """
+    collection = db.collection('scraping_reports')
+    created = existing = 0
+    for i in range(0, len(reports), FIRESTORE_BATCH_LIMIT):
+        chunk = [(collection.document(doc_id), report_doc) for doc_id, report_doc in reports[i:i + FIRESTORE_BATCH_LIMIT]]
+        batch = db.batch()
+        for ref, report_doc in chunk:
+            batch.create(ref, report_doc)
+        try:
+            batch.commit()
+            created += len(chunk)
+            continue
+        except Conflict:
+            pass
+        # Algún reporte del batch ya existía (reintento del cron): crear solo los que faltan
+        found = {snapshot.id for snapshot in db.get_all([ref for ref, _ in chunk], field_paths=['status']) if snapshot.exists}
+        missing = [(ref, report_doc) for ref, report_doc in chunk if ref.id not in found]
+        existing += len(chunk) - len(missing)
+        if missing:
+            batch = db.batch()
+            for ref, report_doc in missing:
+                batch.create(ref, report_doc)
+            batch.commit()
+            created += len(missing)
+    return created, existing
+
+def scheduled_report_id(uid, set_id, run_date):
+    """Id del reporte programado de un grupo para un día: el mismo en cada disparo del cron."""
+    return f"sched_{run_date}_{uid}_{set_id}"
+
+def enqueue_report(report_id, report_doc):
+    """Encola un reporte para el worker. Devuelve el id del documento."""
+    if report_id:
+        db.collection('scraping_reports').document(report_id).set(report_doc, merge=True)
+        return report_id
+    _, doc_ref = db.collection('scraping_reports').add(report_doc)
+    return doc_ref.id
 
 # --- ENDPOINT PRINCIPAL (SIMPLE) ---
 @app.route('/run-scraper', methods=['POST'])
@@ -731,11 +1297,12 @@ def run_scraper():
         report_id = data.get('report_id')
         setId = data.get('setId')  # <-- Tomar el setId del payload
         start_date = data.get('start_date', data.get('startDate'))  # <-- Nueva fecha de inicio
+        exact_prices = data.get('exactPrices', False)  # Precios exactos de Booking (sin conversión local)
         
         logger.info(f"[run-scraper] Recibido UID: {uid}, report_id: {report_id}, setId: {setId}")
         
-        # Verificar si ya hay un scraper corriendo
-        if scraper_status["is_running"]:
+        # Verificar si ya hay un scraper corriendo (solo cuando el scraper corre en este proceso)
+        if SCRAPER_EMBEDDED_WORKER and scraper_running():
             return jsonify({
                 "success": False,
                 "message": "Ya hay un scraper ejecutándose. Espera a que termine."
@@ -760,7 +1327,6 @@ def run_scraper():
         # Validar fecha de inicio si se proporciona
         if start_date:
             try:
-                from datetime import datetime
                 start_datetime = datetime.strptime(start_date, "%Y-%m-%d")
                 today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
                 
@@ -785,11 +1351,40 @@ def run_scraper():
                     "message": "Formato de fecha inválido. Use YYYY-MM-DD"
                 }), 400
         
+        if not SCRAPER_EMBEDDED_WORKER:
+            # El scraping corre en el proceso worker: encolar el reporte
+            report_doc = {
+                'userId': uid,
+                'setId': setId,
+                'setName': setName,
+                'ownHotelUrl': hotel_base_urls[0] if hotel_base_urls else None,
+                'competitorHotelUrls': hotel_base_urls[1:],
+                'hotel_base_urls': hotel_base_urls,
+                'days': days,
+                'nights': nights,
+                'currency': currency,
+                'userEmail': userEmail,
+                'status': 'queued',
+                'createdAt': datetime.now(),
+                'start_date': start_date,
+                'exactPrices': exact_prices,
+                'priority': 'interactive'
+            }
+            queued_id = enqueue_report(report_id, report_doc)
+            logger.info(f"[run-scraper] Reporte {queued_id} encolado para el worker")
+            return jsonify({
+                "success": True,
+                "message": "Scraper iniciado correctamente",
+                "plan": user_plan,
+                "report_id": queued_id
+            })
+        
         # Iniciar scraper en thread separado
         scraper_status["current_user"] = uid
         thread = threading.Thread(
             target=run_scraper_async,
-            args=(hotel_base_urls, days, userEmail, setName, nights, currency, report_id, uid, setId, start_date) # Pasar userId, setId y start_date
+            args=(hotel_base_urls, days, userEmail, setName, nights, currency, report_id, uid, setId, start_date), # Pasar userId, setId y start_date
+            kwargs={"exact_prices": exact_prices}
         )
         thread.daemon = True
         thread.start()
@@ -897,8 +1492,10 @@ def descargar_excel():
         
         # Guardar Excel con pie de página y ajuste de columnas (descarga)
         from openpyxl import load_workbook
-        df.to_excel('temp_excel_download.xlsx', sheet_name='Tarifas', index=False)
-        wb = load_workbook('temp_excel_download.xlsx')
+        excel_buffer = io.BytesIO()
+        df.to_excel(excel_buffer, sheet_name='Tarifas', index=False)
+        excel_buffer.seek(0)
+        wb = load_workbook(excel_buffer)
         ws = wb['Tarifas']
         # --- Formato profesional (colores, título, encabezados, etc) ---
         # Definir colores de la marca
@@ -1019,11 +1616,9 @@ def descargar_excel():
             cell.fill = titulo_fondo  # Mismo fondo azul que el título
         
         # 8. GUARDAR EL ARCHIVO CON FORMATO APLICADO
-        wb.save('temp_excel_download.xlsx')
-        
-        with open('temp_excel_download.xlsx', 'rb') as f:
-            excel_bytes = f.read()
-        os.remove('temp_excel_download.xlsx')
+        excel_buffer = io.BytesIO()
+        wb.save(excel_buffer)
+        excel_bytes = excel_buffer.getvalue()
         # Generar nombre de archivo con formato HotelRateShopper_YYMMDD_NombreSetCompetitivo
         fecha_formato = datetime.now().strftime('%y%m%d')
         nombre_archivo = f"HotelRateShopper_{fecha_formato}_{report_data.get('setName', 'Reporte')}.xlsx"
@@ -1040,7 +1635,84 @@ def descargar_excel():
 
 @app.route('/scraper-status', methods=['GET'])
 def get_scraper_status():
-    return jsonify(scraper_status)
+    return jsonify(scraper_status_snapshot())
+
+@app.route('/scraper-engine-stats', methods=['GET'])
+def scraper_engine_stats():
+    """
+    Totales del motor desde que arrancó el proceso: hedging, rate limiter de arranques, circuit
+    breaker, pool de reportes concurrentes, presupuesto global de ejecuciones en vuelo, lotes de
+    coalescing (dedup ratio por lote) y scheduler de grupos.
+    """
+    try:
+        from async_engine import get_hedging_totals
+        from rate_limiter import actor_run_bucket
+        return jsonify({
+            "success": True,
+            "hedging": get_hedging_totals(),
+            "rateLimiter": actor_run_bucket.get_stats(),
+            "circuitBreaker": apify_breaker.get_status(),
+            "workerPool": scraper_pool.get_stats(),
+            "queueListener": queue_listener.get_stats(),
+            "actorRunBudget": actor_run_budget.get_stats(),
+            "coalescing": scraper_coalescer.get_stats(),
+            "scheduler": group_scheduler.get_stats()
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/circuit-breaker', methods=['GET'])
+def circuit_breaker_status():
+    """Estado del circuit breaker de Apify (cerrado / abierto / semiabierto) y sus últimas transiciones."""
+    return jsonify({"success": True, "circuitBreaker": apify_breaker.get_status()})
+
+@app.route('/apify-usage', methods=['GET'])
+def apify_usage_endpoint():
+    """
+    Consumo acumulado de Apify. Con ?uid=... devuelve el de un usuario (totales y por set);
+    sin uid, los totales de todos los usuarios agrupados por plan, con el costo por hotel-noche.
+    """
+    try:
+        uid = request.args.get('uid')
+        if uid:
+            doc = db.collection(APIFY_USAGE_COLLECTION).document(uid).get()
+            if not doc.exists:
+                return jsonify({"success": True, "usage": None})
+            data = doc.to_dict() or {}
+            usage_per_hotel_night(data.get("totals", {}))
+            for set_totals in (data.get("sets") or {}).values():
+                usage_per_hotel_night(set_totals)
+            return jsonify({"success": True, "usage": data})
+        by_plan = {}
+        for doc in db.collection(APIFY_USAGE_COLLECTION).stream():
+            data = doc.to_dict() or {}
+            plan_totals = by_plan.setdefault(data.get("plan") or "free_trial", {"users": 0})
+            plan_totals["users"] += 1
+            for field, value in (data.get("totals") or {}).items():
+                plan_totals[field] = plan_totals.get(field, 0) + (value or 0)
+        for plan_totals in by_plan.values():
+            usage_per_hotel_night(plan_totals)
+        return jsonify({"success": True, "byPlan": by_plan})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/quote-cache', methods=['GET', 'DELETE'])
+def quote_cache_endpoint():
+    """
+    GET: contadores del cache de cotizaciones (hits, misses, desalojos).
+    DELETE: desaloja las cotizaciones de un hotel (?hotel_url=...) o solo las vencidas si no se indica hotel.
+    """
+    try:
+        if request.method == 'DELETE':
+            hotel_url = request.args.get('hotel_url')
+            if hotel_url:
+                removed = quote_cache.evict(hotel_url)
+            else:
+                removed = quote_cache.evict_expired()
+            return jsonify({"success": True, "removed": removed, "stats": quote_cache.get_stats()})
+        return jsonify({"success": True, "stats": quote_cache.get_stats()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 # --- FUNCIÓN DE CONEXIÓN A APIS EXTERNAS ---
 def obtener_datos_externos():
@@ -1063,8 +1735,150 @@ def obtener_datos_externos():
         ]
 
 # --- MANTENER EL RESTO DE ENDPOINTS ---
+# --- PROGRAMACIÓN DE GRUPOS ---
+def schedule_run_weekdays(enabled, schedule_weekdays):
+    """
+    Días (0=Lunes, 6=Domingo, en la hora local del grupo) en que corre un grupo programado. Se
+    guarda denormalizado en el grupo como schedule_run_weekdays y con él se calcula next_run_at. Sin
+    días configurados el grupo corre todos los días (comportamiento anterior); deshabilitado, ninguno.
+    """
+    if not enabled:
+        return []
+    return sorted(set(schedule_weekdays)) if schedule_weekdays else list(range(7))
+
+def schedule_index_fields(grupo_id, grupo_data):
+    """Campos del índice del scheduler para un grupo: schedule_run_weekdays y next_run_at (o se borra)."""
+    next_run = group_next_run_at(grupo_id, grupo_data)
+    return {
+        'schedule_run_weekdays': grupo_data.get('schedule_run_weekdays') or [],
+        'next_run_at': next_run if next_run is not None else firestore.DELETE_FIELD,
+    }
+
+def refresh_user_schedule_flag(uid):
+    """
+    Actualiza users/{uid}.hasScheduledGroups (si tiene algún grupo programado): system_status cuenta
+    los usuarios con grupos programados con una agregación sobre ese campo.
+    """
+    user_ref = db.collection('users').document(uid)
+    scheduled = count(user_ref.collection('grupos').where('schedule_enabled', '==', True))
+    user_ref.set({'hasScheduledGroups': scheduled > 0}, merge=True)
+
+def scheduled_group_data(grupo_data):
+    """grupo_data con schedule_run_weekdays calculado desde schedule_enabled y schedule_weekdays."""
+    return dict(grupo_data, schedule_run_weekdays=schedule_run_weekdays(
+        grupo_data.get('schedule_enabled', False), grupo_data.get('schedule_weekdays', [])))
+
+def fetch_user_emails(uids):
+    """Emails de los usuarios en una lectura batch (get_all). Devuelve {uid: email}."""
+    if not uids:
+        return {}
+    refs = [db.collection('users').document(uid) for uid in uids]
+    return {
+        snapshot.id: (snapshot.to_dict() or {}).get('email')
+        for snapshot in db.get_all(refs, field_paths=['email'])
+        if snapshot.exists
+    }
+
+def build_scheduled_report(uid, grupo_id, grupo_data, user_email, created_at):
+    """Documento del reporte programado de un grupo, o None si el grupo no tiene hotel principal."""
+    hotel_principal = grupo_data.get('hotel_principal')
+    competidores = grupo_data.get('competidores', [])
+    if not hotel_principal:
+        logger.warning(f"[Scheduler] Grupo {grupo_id} no tiene hotel principal")
+        return None
+    
+    # Construir lista de URLs
+    hotel_urls = [hotel_principal]
+    if competidores:
+        if isinstance(competidores, list):
+            hotel_urls.extend(competidores)
+        elif isinstance(competidores, str):
+            hotel_urls.append(competidores)
+    
+    return {
+        'userId': uid,
+        'setId': grupo_id,
+        'setName': grupo_data.get('name', 'Grupo Programado'),
+        'ownHotelUrl': hotel_principal,
+        'competitorHotelUrls': competidores,
+        'hotel_base_urls': hotel_urls,
+        'days': grupo_data.get('days', 7),
+        'nights': grupo_data.get('nights', 1),
+        'currency': grupo_data.get('currency', 'USD'),
+        'exactPrices': grupo_data.get('exact_prices', False),
+        'userEmail': user_email,
+        'status': 'queued',
+        'createdAt': created_at,
+        'scheduled_task': True,
+        'priority': 'scheduled',
+        'start_date': grupo_data.get('start_date')  # Nueva fecha de inicio
+    }
+
+def enqueue_due_groups(due):
+    """
+    Encola los reportes de los grupos vencidos del scheduler: due es [(uid, grupo_id, grupo_data,
+    run_at)]. Los ids son deterministas por grupo y día local del arranque, así repetir no duplica.
+    """
+    user_emails = fetch_user_emails({uid for uid, _, _, _ in due})
+    created_at = datetime.now()
+    reports = []
+    skipped = 0
+    for uid, grupo_id, grupo_data, run_at in due:
+        report_doc = build_scheduled_report(uid, grupo_id, grupo_data, user_emails.get(uid), created_at)
+        if report_doc is None:
+            skipped += 1
+            continue
+        run_date = schedule_window.local_run_date(run_at, grupo_data.get('schedule_timezone'))
+        reports.append((scheduled_report_id(uid, grupo_id, run_date), report_doc))
+    created, existing = enqueue_reports(reports)
+    return {"created": created, "already_enqueued": existing, "skipped": skipped}
+
+# Scheduler de grupos: corre en el worker con elección de líder (un solo nodo programa)
+def backfill_schedule_index():
+    """
+    Completa schedule_run_weekdays y next_run_at en los grupos programados que no los tienen
+    (creados antes del índice) y marca hasScheduledGroups en sus usuarios. Consulta solo los grupos
+    con schedule_enabled (collection group) y escribe en batches. Devuelve cuántos grupos actualizó.
+    """
+    updated = 0
+    uids = set()
+    batch = db.batch()
+    for grupo in db.collection_group('grupos').where('schedule_enabled', '==', True).stream():
+        grupo_data = grupo.to_dict() or {}
+        if grupo.reference.parent.parent is not None:
+            uids.add(grupo.reference.parent.parent.id)
+        run_weekdays = schedule_run_weekdays(True, grupo_data.get('schedule_weekdays', []))
+        # Los grupos que ya tienen next_run_at con los mismos días no se tocan
+        if grupo_data.get('schedule_run_weekdays') == run_weekdays and grupo_data.get('next_run_at') is not None:
+            continue
+        batch.update(grupo.reference, schedule_index_fields(grupo.id, dict(grupo_data, schedule_run_weekdays=run_weekdays)))
+        updated += 1
+        if updated % FIRESTORE_BATCH_LIMIT == 0:
+            batch.commit()
+            batch = db.batch()
+    if updated % FIRESTORE_BATCH_LIMIT:
+        batch.commit()
+    # Marca de los usuarios con grupos programados (ver refresh_user_schedule_flag)
+    uids = sorted(uids)
+    for i in range(0, len(uids), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for uid in uids[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.set(db.collection('users').document(uid), {'hasScheduledGroups': True}, merge=True)
+        batch.commit()
+    return updated
+
+group_scheduler = GroupScheduler(db, enqueue_due_groups, WORKER_ID, backfill=backfill_schedule_index)
+
+# Totales de /test-scheduled-tasks (consultas de agregación con cache corto)
+system_status = SystemStatus(db)
+
 @app.route('/execute-scheduled-tasks', methods=['POST'])
 def execute_scheduled_tasks():
+    """
+    Disparo manual del scheduler: encola ya los grupos con next_run_at vencido. El worker lo hace
+    solo (group_scheduler); el endpoint queda para compatibilidad con el cron externo y es
+    idempotente.
+    """
     try:
         # Validar token de seguridad (opcional pero recomendado)
         token = request.args.get('token')
@@ -1075,103 +1889,38 @@ def execute_scheduled_tasks():
             return jsonify({"error": "Token inválido"}), 401
         
         logger.info("[execute-scheduled-tasks] Iniciando ejecución de tareas programadas")
-        
-        # Obtener día actual (0=Lunes, 6=Domingo)
-        current_weekday = datetime.now().weekday()
-        logger.info(f"[execute-scheduled-tasks] Día actual de la semana: {current_weekday} ({['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo'][current_weekday]})")
-        
-        # Obtener todos los usuarios que tienen grupos con schedule_enabled = True
-        users_ref = db.collection('users')
-        users = users_ref.stream()
-        
-        total_tasks_created = 0
-        total_tasks_skipped = 0
-        
-        for user_doc in users:
-            uid = user_doc.id
-            user_data = user_doc.to_dict()
-            
-            # Obtener grupos del usuario
-            grupos_ref = db.collection('users').document(uid).collection('grupos')
-            grupos = grupos_ref.stream()
-            
-            for grupo in grupos:
-                grupo_data = grupo.to_dict()
-                grupo_id = grupo.id
-                
-                # Verificar si el grupo tiene schedule habilitado
-                if grupo_data.get('schedule_enabled', False):
-                    # Obtener días programados del grupo
-                    schedule_weekdays = grupo_data.get('schedule_weekdays', [])
-                    
-                    # Verificar si debe ejecutarse hoy
-                    # Si schedule_weekdays está vacío o no existe, mantener comportamiento anterior (ejecutar siempre)
-                    if schedule_weekdays and len(schedule_weekdays) > 0:
-                        if current_weekday not in schedule_weekdays:
-                            logger.info(f"[execute-scheduled-tasks] ⏭️ Omitiendo grupo {grupo_id} del usuario {uid} - hoy es día {current_weekday} ({['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo'][current_weekday]}), programado para días {schedule_weekdays}")
-                            total_tasks_skipped += 1
-                            continue
-                        else:
-                            logger.info(f"[execute-scheduled-tasks] ✅ Día coincide - procesando grupo {grupo_id} del usuario {uid} (día {current_weekday} está en {schedule_weekdays})")
-                    else:
-                        logger.info(f"[execute-scheduled-tasks] ⚠️ Grupo {grupo_id} sin días específicos configurados - ejecutando (comportamiento retrocompatible)")
-                    
-                    logger.info(f"[execute-scheduled-tasks] Procesando grupo {grupo_id} del usuario {uid}")
-                    
-                    # Obtener URLs de hoteles
-                    hotel_principal = grupo_data.get('hotel_principal')
-                    competidores = grupo_data.get('competidores', [])
-                    
-                    if not hotel_principal:
-                        logger.warning(f"[execute-scheduled-tasks] Grupo {grupo_id} no tiene hotel principal")
-                        continue
-                    
-                    # Construir lista de URLs
-                    hotel_urls = [hotel_principal]
-                    if competidores:
-                        if isinstance(competidores, list):
-                            hotel_urls.extend(competidores)
-                        elif isinstance(competidores, str):
-                            hotel_urls.append(competidores)
-                    
-                    # Crear documento de reporte
-                    report_doc = {
-                        'userId': uid,
-                        'setId': grupo_id,
-                        'setName': grupo_data.get('name', 'Grupo Programado'),
-                        'ownHotelUrl': hotel_principal,
-                        'competitorHotelUrls': competidores,
-                        'hotel_base_urls': hotel_urls,
-                        'days': grupo_data.get('days', 7),
-                        'nights': grupo_data.get('nights', 1),
-                        'currency': grupo_data.get('currency', 'USD'),
-                        'userEmail': user_data.get('email'),
-                        'status': 'queued',
-                        'createdAt': datetime.now(),
-                        'scheduled_task': True,
-                        'start_date': grupo_data.get('start_date')  # Nueva fecha de inicio
-                    }
-                    
-                    # Guardar en Firestore
-                    try:
-                        db.collection('scraping_reports').add(report_doc)
-                        total_tasks_created += 1
-                        logger.info(f"[execute-scheduled-tasks] ✅ Tarea creada para grupo {grupo_id} del usuario {uid}")
-                    except Exception as e:
-                        logger.error(f"[execute-scheduled-tasks] ❌ Error creando tarea para grupo {grupo_id}: {e}")
-        
-        logger.info(f"[execute-scheduled-tasks] ✅ Proceso completado. {total_tasks_created} tareas creadas, {total_tasks_skipped} tareas omitidas")
+        groups_run = group_scheduler.run_due()
+        result = group_scheduler.stats["last_result"] if groups_run else {"created": 0, "already_enqueued": 0, "skipped": 0}
+        logger.info(f"[execute-scheduled-tasks] ✅ Proceso completado. {groups_run} grupos vencidos: {result}")
         return jsonify({
             "success": True, 
-            "message": f"Tareas programadas encoladas: {total_tasks_created}",
-            "tasks_created": total_tasks_created,
-            "tasks_skipped": total_tasks_skipped
+            "message": f"Tareas programadas encoladas: {result['created']}",
+            "tasks_created": result["created"],
+            "tasks_already_enqueued": result["already_enqueued"],
+            "tasks_skipped": result["skipped"]
         })
         
     except Exception as e:
         logger.error(f"[execute-scheduled-tasks] ❌ Error general: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/migrate-schedule-index', methods=['POST'])
+def migrate_schedule_index():
+    """
+    Completa schedule_run_weekdays y next_run_at en los grupos programados que no los tienen. El
+    scheduler lo hace solo una vez al arrancar (ver GroupScheduler); este endpoint lo repite a mano.
+    """
+    try:
+        token = request.args.get('token')
+        if token != os.environ.get('SCHEDULER_TOKEN', 'default_token'):
+            return jsonify({"error": "Token inválido"}), 401
+        updated = backfill_schedule_index()
+        logger.info(f"[migrate-schedule-index] ✅ schedule_run_weekdays y next_run_at actualizados en {updated} grupos")
+        return jsonify({"success": True, "groups_updated": updated})
+    except Exception as e:
+        logger.error(f"[migrate-schedule-index] ❌ Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/init-user', methods=['POST'])
 def init_user():
     try:
@@ -1188,6 +1937,8 @@ def init_user():
             'plan': plan,
             'created_at': datetime.now()
         })
+        # set() sin merge borra hasScheduledGroups: recalcularlo por si el usuario ya tenía grupos
+        refresh_user_schedule_flag(uid)
         return jsonify({"success": True, "message": "Usuario inicializado"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1222,6 +1973,7 @@ def crear_grupo():
             'currency': 'USD',
             'schedule_enabled': False,
             'schedule_weekdays': [],
+            'schedule_run_weekdays': [],
             'created_at': datetime.now()
         })
         return jsonify({"success": True, "message": "Grupo creado"})
@@ -1254,9 +2006,10 @@ def agregar_competidor():
         # Agregar competidor
         competidores = grupo_data.get('competidores', [])
         competidores.append(competidor_url)
-        grupo_ref.update({
-            'competidores': competidores
-        })
+        update_data = {'competidores': competidores}
+        # El arranque en la ventana depende del costo (días x hoteles): recalcular next_run_at
+        update_data.update(schedule_index_fields(grupo_id, scheduled_group_data({**grupo_data, **update_data})))
+        grupo_ref.update(update_data)
         return jsonify({"success": True, "message": "Competidor agregado"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1279,9 +2032,13 @@ def configurar_dias():
             }), 400
         # Actualizar días
         grupo_ref = db.collection('users').document(uid).collection('grupos').document(grupo_id)
-        grupo_ref.update({
-            'days': dias
-        })
+        grupo = grupo_ref.get()
+        if not grupo.exists:
+            return jsonify({"error": "Grupo no encontrado"}), 404
+        update_data = {'days': dias}
+        # El arranque en la ventana depende del costo (días x hoteles): recalcular next_run_at
+        update_data.update(schedule_index_fields(grupo_id, scheduled_group_data({**(grupo.to_dict() or {}), **update_data})))
+        grupo_ref.update(update_data)
         return jsonify({"success": True, "message": "Días configurados"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1297,10 +2054,15 @@ def configurar_schedule():
         nights = data.get('nights')
         currency = data.get('currency')
         days = data.get('days')
+        schedule_timezone = data.get('timezone')
+        exact_prices = data.get('exact_prices')  # Precios exactos de Booking (sin conversión local)
         
         if not uid or not grupo_id:
             return jsonify({"error": "UID y grupo_id requeridos"}), 400
         
+        if schedule_timezone is not None and not schedule_window.is_valid_timezone(schedule_timezone):
+            return jsonify({"error": "timezone debe ser una zona horaria IANA (ej: America/Argentina/Buenos_Aires)"}), 400
+        
         # Verificar si el plan permite scheduling
         user_plan = get_user_plan(uid)
         plan_limits = PLAN_LIMITS.get(user_plan, PLAN_LIMITS["free_trial"])
@@ -1335,6 +2097,10 @@ def configurar_schedule():
         if schedule_weekdays is not None:
             update_data['schedule_weekdays'] = schedule_weekdays if enabled else []
         
+        # Zona horaria del grupo: los días y la ventana del scheduler son en hora local del hotel
+        if schedule_timezone is not None:
+            update_data['schedule_timezone'] = schedule_timezone
+        
         # Agregar nights si se proporciona
         if nights is not None:
             if not isinstance(nights, int) or nights < 1:
@@ -1347,6 +2113,12 @@ def configurar_schedule():
                 return jsonify({"error": "currency debe ser un código de 3 letras (ej: USD, EUR)"}), 400
             update_data['currency'] = currency.upper()
         
+        # Agregar exact_prices si se proporciona (los reportes programados lo copian como exactPrices)
+        if exact_prices is not None:
+            if not isinstance(exact_prices, bool):
+                return jsonify({"error": "exact_prices debe ser true o false"}), 400
+            update_data['exact_prices'] = exact_prices
+        
         # Agregar days si se proporciona
         if days is not None:
             if not isinstance(days, int) or days < 1:
@@ -1362,10 +2134,21 @@ def configurar_schedule():
         grupo_ref = db.collection('users').document(uid).collection('grupos').document(grupo_id)
         grupo_doc = grupo_ref.get()
         
+        # Índice del scheduler (schedule_run_weekdays y next_run_at) con el estado final del grupo
+        current_data = (grupo_doc.to_dict() or {}) if grupo_doc.exists else {}
+        effective_weekdays = update_data.get('schedule_weekdays')
+        if effective_weekdays is None:
+            effective_weekdays = current_data.get('schedule_weekdays', [])
+        update_data['schedule_run_weekdays'] = schedule_run_weekdays(enabled, effective_weekdays)
+        update_data.update(schedule_index_fields(grupo_id, {**current_data, **update_data}))
+        if not grupo_doc.exists and update_data['next_run_at'] is firestore.DELETE_FIELD:
+            # Al crear el grupo no hay campo que borrar
+            del update_data['next_run_at']
+        
         if grupo_doc.exists:
             # Si el grupo existe, actualizar
             grupo_ref.update(update_data)
-            logger.info(f"[configurar-schedule] ✅ Schedule actualizado para grupo {grupo_id}: enabled={enabled}, weekdays={schedule_weekdays}, nights={nights}, currency={currency}, days={days}")
+            logger.info(f"[configurar-schedule] ✅ Schedule actualizado para grupo {grupo_id}: enabled={enabled}, weekdays={schedule_weekdays}, nights={nights}, currency={currency}, days={days}, next_run_at={update_data.get('next_run_at')}")
         else:
             # Si el grupo no existe, crearlo con los datos básicos
             # Intentar obtener datos del competitive_set si existe
@@ -1417,6 +2200,7 @@ def configurar_schedule():
                 grupo_ref.set(grupo_data)
                 logger.info(f"[configurar-schedule] ✅ Grupo básico creado y schedule configurado para grupo {grupo_id}")
         
+        refresh_user_schedule_flag(uid)
         return jsonify({"success": True, "message": "Schedule configurado"})
     except Exception as e:
         logger.error(f"[configurar-schedule] ❌ Error: {e}")
@@ -1802,7 +2586,7 @@ def debug_endpoint():
         return jsonify({
             "user": user_data,
             "grupos": grupos,
-            "scraper_status": scraper_status
+            "scraper_status": scraper_status_snapshot()
         })
         
     except Exception as e:
@@ -1876,49 +2660,20 @@ def debug_update_task():
 @app.route('/test-scheduled-tasks', methods=['GET'])
 def test_scheduled_tasks():
     """
-    Endpoint de prueba para verificar el estado del sistema de tareas programadas
+    Endpoint de prueba para verificar el estado del sistema de tareas programadas.
+    Los totales salen de consultas de agregación (cacheadas, ver system_status); ?refresh=true
+    fuerza recalcularlos.
     """
     try:
-        logger.info("[test-scheduled-tasks] Verificando estado del sistema")
-        
-        # Contar usuarios con grupos programados
-        users_with_scheduled_groups = 0
-        total_scheduled_groups = 0
-        
-        users_ref = db.collection('users')
-        users = users_ref.stream()
-        
-        for user_doc in users:
-            uid = user_doc.id
-            user_data = user_doc.to_dict()
-            
-            # Obtener grupos del usuario
-            grupos_ref = db.collection('users').document(uid).collection('grupos')
-            grupos = grupos_ref.stream()
-            
-            user_has_scheduled = False
-            for grupo in grupos:
-                grupo_data = grupo.to_dict()
-                if grupo_data.get('schedule_enabled', False):
-                    user_has_scheduled = True
-                    total_scheduled_groups += 1
-            
-            if user_has_scheduled:
-                users_with_scheduled_groups += 1
-        
-        # Contar tareas en cola
-        queued_tasks = list(db.collection('scraping_reports').where('status', '==', 'queued').stream())
-        pending_tasks = list(db.collection('scraping_reports').where('status', '==', 'pending').stream())
+        refresh = request.args.get('refresh', 'false').lower() == 'true'
+        status = system_status.get(refresh=refresh)
         
         return jsonify({
             "success": True,
             "system_status": {
-                "users_with_scheduled_groups": users_with_scheduled_groups,
-                "total_scheduled_groups": total_scheduled_groups,
-                "queued_tasks": len(queued_tasks),
-                "pending_tasks": len(pending_tasks),
-                "scraper_running": scraper_status["is_running"],
-                "scraper_en_proceso": scraper_en_proceso.is_set()
+                **status,
+                "scraper_running": scraper_running(),
+                "scraper_en_proceso": scraper_running()
             },
             "message": "Estado del sistema verificado"
         })
@@ -1927,9 +2682,8 @@ def test_scheduled_tasks():
         logger.error(f"[test-scheduled-tasks] ❌ Error: {e}")
         return jsonify({"error": str(e)}), 500
 
-# Lanzar el procesador de la cola SIEMPRE, no solo en modo script
-import threading
-threading.Thread(target=cola_procesadora_scraping, daemon=True).start()
-
 if __name__ == '__main__':
+    # En modo script el procesador de la cola corre embebido (con el reloader, solo en el proceso hijo)
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_embedded_worker()
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
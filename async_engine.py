@@ -0,0 +1,487 @@
+"""
+Motor asyncio del scraper.
+
+Todas las ejecuciones del actor corren en un único event loop con el cliente async de Apify
+(ApifyClientAsync), así que cientos de ejecuciones pueden estar en vuelo sin bloquear un
+thread cada una. La concurrencia la regula un controlador AIMD: sube de a poco mientras las
+ejecuciones terminan bien y se reduce a la mitad cuando aparece un rate limit (429).
+
+Hedging: si una ejecución tarda más que un percentil de las ya observadas en el reporte, se
+lanza una ejecución especulativa con el mismo input, se usa la primera que termine y la otra se
+aborta con la API de Apify. Las especulativas se limitan a un porcentaje de las ejecuciones.
+
+scrape_booking_data sigue siendo síncrono y envuelve este motor con asyncio.run().
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from apify_scraper import (
+    ACTOR_ID,
+    DATASET_ITEM_FIELDS,
+    get_item_price,
+    check_run_status,
+    retry_delay,
+    build_run_input,
+    build_batch_run_input,
+    batch_label,
+    night_result_from_items,
+    batch_results_from_items,
+)
+from rate_limiter import actor_run_bucket
+from circuit_breaker import apify_breaker, classify_error, RATE_LIMIT, PERMANENT
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_ASYNC_INITIAL_CONCURRENCY = int(os.environ.get("SCRAPER_ASYNC_INITIAL_CONCURRENCY", "15"))
+SCRAPER_ASYNC_MIN_CONCURRENCY = int(os.environ.get("SCRAPER_ASYNC_MIN_CONCURRENCY", "2"))
+SCRAPER_ASYNC_MAX_CONCURRENCY = int(os.environ.get("SCRAPER_ASYNC_MAX_CONCURRENCY", "200"))
+# Tras una reducción, se ignoran otros 429 durante este intervalo (vienen de la misma ráfaga)
+SCRAPER_ASYNC_DECREASE_COOLDOWN = float(os.environ.get("SCRAPER_ASYNC_DECREASE_COOLDOWN", "5"))
+
+SCRAPER_HEDGING_ENABLED = os.environ.get("SCRAPER_HEDGING_ENABLED", "true").lower() == "true"
+# Percentil de la duración observada a partir del cual se lanza la ejecución especulativa
+SCRAPER_HEDGE_PERCENTILE = float(os.environ.get("SCRAPER_HEDGE_PERCENTILE", "95"))
+# Máximo de ejecuciones especulativas como fracción de las ejecuciones lanzadas
+SCRAPER_HEDGE_MAX_RATE = float(os.environ.get("SCRAPER_HEDGE_MAX_RATE", "0.05"))
+# Duraciones observadas necesarias antes de empezar a especular, y espera mínima
+SCRAPER_HEDGE_MIN_SAMPLES = int(os.environ.get("SCRAPER_HEDGE_MIN_SAMPLES", "10"))
+SCRAPER_HEDGE_MIN_DELAY = float(os.environ.get("SCRAPER_HEDGE_MIN_DELAY", "5"))
+
+
+class AIMDController:
+    """
+    Límite de concurrencia adaptativo (Additive Increase / Multiplicative Decrease).
+
+    - Cada ejecución exitosa suma 1/limit al límite (≈ +1 por cada "ronda" completa).
+    - Cada rate limit multiplica el límite por decrease_factor (como máximo una vez por cooldown).
+    """
+
+    def __init__(self, initial=SCRAPER_ASYNC_INITIAL_CONCURRENCY, min_limit=SCRAPER_ASYNC_MIN_CONCURRENCY,
+                 max_limit=SCRAPER_ASYNC_MAX_CONCURRENCY, decrease_factor=0.5,
+                 cooldown=SCRAPER_ASYNC_DECREASE_COOLDOWN):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def try_acquire(self):
+        """Toma un lugar sin esperar (para las especulativas). Todo corre en el mismo event loop."""
+        if self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return True
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def on_success(self):
+        async with self._condition:
+            previous = int(self.limit)
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            if int(self.limit) > previous:
+                self.increases += 1
+                self._condition.notify_all()
+
+    async def on_rate_limit(self):
+        async with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.decreases += 1
+            logger.warning(f"[AsyncEngine] Rate limit: concurrencia reducida a {int(self.limit)}")
+
+    def get_stats(self):
+        return {
+            "limit": int(self.limit),
+            "peak_in_flight": self.peak_in_flight,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+
+class HedgeController:
+    """
+    Decide cuándo lanzar una ejecución especulativa y lleva sus estadísticas.
+
+    El umbral es el percentil `percentile` de las duraciones de las ejecuciones del reporte (ventana
+    de las últimas `window`), con un mínimo de `min_delay` segundos. Como mucho se especula en
+    `max_rate` de las ejecuciones lanzadas.
+    """
+
+    def __init__(self, percentile=SCRAPER_HEDGE_PERCENTILE, max_rate=SCRAPER_HEDGE_MAX_RATE,
+                 min_samples=SCRAPER_HEDGE_MIN_SAMPLES, min_delay=SCRAPER_HEDGE_MIN_DELAY, window=200):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = max(1, min_samples)
+        self.min_delay = min_delay
+        self.durations = deque(maxlen=window)
+        self.primary_runs = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.aborted = 0
+        self.estimated_saved_seconds = 0.0
+
+    def hedge_delay(self):
+        """Segundos a esperar antes de especular, o None si todavía no hay suficientes muestras."""
+        if len(self.durations) < self.min_samples:
+            return None
+        ordered = sorted(self.durations)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def record_duration(self, seconds):
+        self.durations.append(seconds)
+
+    def try_hedge(self):
+        """Reserva una ejecución especulativa si no se supera el tope de max_rate."""
+        if self.hedges + 1 > self.max_rate * self.primary_runs:
+            return False
+        self.hedges += 1
+        return True
+
+    def on_hedge_win(self, primary_elapsed):
+        """
+        La especulativa terminó primero. El ahorro se estima como la duración esperada de la
+        original dado que ya llevaba primary_elapsed segundos (media de las duraciones mayores).
+        """
+        self.hedge_wins += 1
+        slower = [d for d in self.durations if d > primary_elapsed]
+        if slower:
+            self.estimated_saved_seconds += sum(slower) / len(slower) - primary_elapsed
+
+    def get_stats(self):
+        return {
+            "primary_runs": self.primary_runs,
+            "hedges": self.hedges,
+            "hedge_rate": round(self.hedges / self.primary_runs, 4) if self.primary_runs else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins": self.primary_wins,
+            "aborted": self.aborted,
+            "estimated_saved_seconds": round(self.estimated_saved_seconds, 2),
+            "threshold_seconds": round(self.hedge_delay() or 0.0, 2),
+        }
+
+
+# Totales del proceso (todas las ejecuciones del motor), para ajustar el hedging
+_hedging_totals_lock = threading.Lock()
+hedging_totals = {"primary_runs": 0, "hedges": 0, "hedge_wins": 0, "primary_wins": 0, "aborted": 0, "estimated_saved_seconds": 0.0}
+
+
+def get_hedging_totals():
+    with _hedging_totals_lock:
+        totals = dict(hedging_totals)
+    totals["hedge_rate"] = round(totals["hedges"] / totals["primary_runs"], 4) if totals["primary_runs"] else 0.0
+    totals["estimated_saved_seconds"] = round(totals["estimated_saved_seconds"], 2)
+    return totals
+
+
+async def _start_and_wait(client, run_input, run_ref):
+    """Arranca una ejecución del actor y espera a que termine; guarda su id en run_ref para poder abortarla."""
+    run = await client.actor(ACTOR_ID).start(run_input=run_input)
+    run_ref["id"] = run["id"]
+    return await client.run(run["id"]).wait_for_finish()
+
+
+async def _abort_attempt(client, task, run_ref, label, hedger=None, usage=None):
+    task.cancel()
+    if not run_ref.get("id"):
+        return
+    try:
+        run = await client.run(run_ref["id"]).abort()
+        if usage is not None:
+            usage.record_run(run)
+        if hedger is not None:
+            hedger.aborted += 1
+        logger.info(f"[AsyncEngine] Ejecución {run_ref['id']} abortada ({label})")
+    except Exception as e:
+        logger.warning(f"[AsyncEngine] No se pudo abortar la ejecución {run_ref['id']} ({label}): {e}")
+
+
+def _reserve_hedge(controller, budget):
+    """
+    Lugar para una especulativa sin esperar: breaker cerrado, un lugar del controlador AIMD y uno
+    del presupuesto global. Devuelve (controlador tomado, presupuesto tomado) o None si no hay.
+    """
+    if apify_breaker.is_open():
+        return None
+    holding_budget = budget is not None and budget.try_acquire()
+    if budget is not None and not holding_budget:
+        return None
+    holding_controller = controller is not None and controller.try_acquire()
+    if controller is not None and not holding_controller:
+        if holding_budget:
+            budget.release()
+        return None
+    return holding_controller, holding_budget
+
+
+async def call_actor_hedged(client, run_input, label, hedger=None, usage=None, controller=None, budget=None):
+    """
+    Equivalente a actor.call(): devuelve la ejecución terminada. Con hedger, si la ejecución supera
+    el umbral lanza una especulativa, devuelve la primera que termina en SUCCEEDED y aborta la otra.
+    La especulativa ocupa su propio lugar del controlador AIMD y del presupuesto (budget); si no hay
+    lugar o el breaker está abierto, no se lanza y se sigue esperando a la original.
+    Si la tarea se cancela (deadline del reporte), aborta las ejecuciones en curso.
+    Las ejecuciones abortadas o perdedoras se registran en usage; la devuelta la registra quien llama.
+    """
+    started = time.monotonic()
+    attempts = {}
+    hedge_slots = None
+    primary_ref = {}
+    primary = asyncio.ensure_future(_start_and_wait(client, run_input, primary_ref))
+    attempts[primary] = primary_ref
+    try:
+        if hedger is None:
+            return await asyncio.shield(primary)
+        hedger.primary_runs += 1
+        # Esperar a la original; el umbral y el tope se reevalúan mientras siga corriendo
+        # (al principio del reporte todavía no hay muestras ni cupo de especulativas)
+        while True:
+            delay = hedger.hedge_delay()
+            elapsed = time.monotonic() - started
+            timeout = hedger.min_delay if delay is None or elapsed >= delay else delay - elapsed
+            done, _ = await asyncio.wait({primary}, timeout=timeout)
+            if primary in done:
+                run = primary.result()
+                hedger.record_duration(time.monotonic() - started)
+                return run
+            delay = hedger.hedge_delay()
+            if delay is None or time.monotonic() - started < delay:
+                continue
+            hedge_slots = _reserve_hedge(controller, budget)
+            if hedge_slots is None:
+                continue
+            if hedger.try_hedge():
+                break
+            await _release_hedge(controller, budget, hedge_slots)
+            hedge_slots = None
+
+        logger.warning(f"[AsyncEngine] {label} supera {delay:.1f}s: lanzando ejecución especulativa")
+        await actor_run_bucket.acquire_async()
+        hedge_ref = {}
+        hedge = asyncio.ensure_future(_start_and_wait(client, run_input, hedge_ref))
+        attempts[hedge] = hedge_ref
+
+        winner = None
+        errors = []
+        failed_runs = []
+        pending = {primary, hedge}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif (task.result() or {}).get("status") != "SUCCEEDED":
+                    # Terminó pero sin éxito (FAILED, TIMED-OUT...): no gana, se espera a la otra
+                    failed_runs.append(task.result())
+                elif winner is None:
+                    winner = task
+        for task in pending:
+            await _abort_attempt(client, task, attempts[task], label, hedger, usage)
+        if winner is None and failed_runs:
+            # Se devuelve una fallida para que quien llama la registre y la clasifique (check_run_status)
+            winner_run = failed_runs.pop()
+        elif winner is None:
+            raise errors[0]
+        else:
+            winner_run = winner.result()
+        if usage is not None:
+            for run in failed_runs:
+                if run is not None:
+                    usage.record_run(run)
+        if winner is None:
+            return winner_run
+
+        elapsed = time.monotonic() - started
+        if winner is hedge:
+            hedger.on_hedge_win(elapsed)
+            logger.info(f"[AsyncEngine] La ejecución especulativa de {label} terminó primero ({elapsed:.1f}s)")
+        else:
+            hedger.primary_wins += 1
+            hedger.record_duration(elapsed)
+        return winner_run
+    except asyncio.CancelledError:
+        # La tarea se canceló (por ejemplo por deadline): no dejar ejecuciones huérfanas en Apify
+        for task, run_ref in attempts.items():
+            if not task.done():
+                await _abort_attempt(client, task, run_ref, label, hedger, usage)
+        raise
+    finally:
+        if hedge_slots is not None:
+            await _release_hedge(controller, budget, hedge_slots)
+
+
+async def _release_hedge(controller, budget, hedge_slots):
+    holding_controller, holding_budget = hedge_slots
+    if holding_budget:
+        budget.release()
+    if holding_controller:
+        await controller.release()
+
+
+async def read_dataset_items_async(client, dataset_id, limit=None, first_price_only=False):
+    """Versión async de read_dataset_items (proyección de campos y lectura perezosa)."""
+    items = []
+    async for item in client.dataset(dataset_id).iterate_items(fields=DATASET_ITEM_FIELDS, limit=limit):
+        items.append(item)
+        if first_price_only and get_item_price(item) is not None:
+            break
+    return items
+
+
+async def run_actor_with_retries_async(client, controller, run_input, label, first_price_only=False, hedger=None, usage=None, budget=None):
+    """
+    Versión async de run_actor_with_retries: misma clasificación de errores, reintentos y
+    circuit breaker, pero cada intento ocupa un lugar del controlador AIMD y le informa el resultado.
+    Con hedger, las ejecuciones lentas se cubren con una especulativa (ver call_actor_hedged).
+    Con budget (rate_limiter.BudgetLease) cada intento ocupa además un lugar del presupuesto global.
+    Devuelve la lista de items del dataset, o None si la ejecución falló.
+    """
+    max_retries = 5
+
+    for attempt in range(max_retries):
+        # No lanzar ejecuciones mientras Apify esté fallando (sin ocupar lugar en el controlador)
+        await apify_breaker.acquire_async()
+        await controller.acquire()
+        holding_budget = False
+        try:
+            if budget is not None:
+                holding_budget = await budget.acquire_async()
+            # Respetar el presupuesto compartido de arranques del actor
+            await actor_run_bucket.acquire_async()
+            logger.info(f"Iniciando scraper para {label} (intento {attempt + 1}/{max_retries})")
+            run = await call_actor_hedged(client, run_input, label, hedger, usage, controller, budget)
+            if usage is not None:
+                usage.record_run(run)
+            check_run_status(run)
+            apify_breaker.record_success()
+
+            if run is None or "defaultDatasetId" not in run:
+                logger.warning(f"No se pudo obtener dataset para {label}")
+                return None
+
+            dataset_id = run["defaultDatasetId"]
+            items = await read_dataset_items_async(
+                client, dataset_id, limit=run_input.get("maxItems"), first_price_only=first_price_only
+            )
+            if usage is not None:
+                usage.record_dataset(items, len(json.dumps(items)))
+            await controller.on_success()
+            return items
+
+        except Exception as e:
+            error = e
+            kind = classify_error(e)
+            apify_breaker.record_failure(kind)
+            if kind == PERMANENT:
+                logger.error(f"Error para {label}: {e}")
+                return None
+            if kind == RATE_LIMIT:
+                await controller.on_rate_limit()
+        finally:
+            if holding_budget:
+                budget.release()
+            await controller.release()
+
+        # Backoff exponencial con jitter (sin ocupar lugar en el controlador)
+        if attempt < max_retries - 1:
+            delay = retry_delay(attempt)
+            if usage is not None:
+                usage.record_retry(kind)
+            if kind == RATE_LIMIT:
+                logger.warning(f"Rate limit detectado para {label}. Esperando {delay:.1f}s antes del reintento {attempt + 2}")
+            else:
+                logger.warning(f"Error ({kind}) para {label}: {error}. Esperando {delay:.1f}s antes del reintento {attempt + 2}")
+            await asyncio.sleep(delay)
+        else:
+            logger.error(f"Error persistente ({kind}) para {label} después de {max_retries} intentos")
+            return None
+
+    return None
+
+
+async def run_task_async(client, controller, task, batch_mode, currency, hedger=None, usage=None, budget=None):
+    base_url, hotel_name, task_ranges = task
+    if batch_mode:
+        run_input = build_batch_run_input(base_url, task_ranges, currency)
+        items = await run_actor_with_retries_async(client, controller, run_input, batch_label(hotel_name, task_ranges), hedger=hedger, usage=usage, budget=budget)
+        return batch_results_from_items(hotel_name, base_url, task_ranges, items)
+    checkin, checkout = task_ranges[0]
+    run_input = build_run_input([{"url": base_url}], checkin, checkout, currency)
+    items = await run_actor_with_retries_async(client, controller, run_input, f"{hotel_name} - {checkin}", first_price_only=True, hedger=hedger, usage=usage, budget=budget)
+    return [night_result_from_items(hotel_name, base_url, checkin, items)]
+
+
+async def run_tasks_async(client, tasks, batch_mode, currency, on_task_done, controller=None, hedger=None, deadline=None, usage=None, budget=None):
+    """
+    Ejecuta todas las tareas en el event loop actual.
+    Llama a on_task_done(base_url, hotel_name, task_ranges, task_results) a medida que terminan.
+    Con deadline (timestamp de time.time()), al vencer cancela las tareas pendientes, lo que aborta
+    sus ejecuciones en curso en Apify. Con usage (run_usage.RunUsage) registra el consumo y con
+    budget (rate_limiter.BudgetLease) comparte el presupuesto global de ejecuciones en vuelo.
+    Devuelve las estadísticas del controlador de concurrencia (con las de hedging en "hedging" y
+    las tareas canceladas en "cancelled_tasks").
+    """
+    controller = controller or AIMDController()
+    if hedger is None and SCRAPER_HEDGING_ENABLED:
+        hedger = HedgeController()
+
+    async def run_one(task):
+        try:
+            return task, await run_task_async(client, controller, task, batch_mode, currency, hedger, usage, budget)
+        except Exception as exc:
+            base_url, hotel_name, task_ranges = task
+            logger.error(f"Error en {hotel_name} {task_ranges[0][0]}: {exc}")
+            return task, [(hotel_name, base_url, checkin, None, None, None) for checkin, _ in task_ranges]
+
+    pending = {asyncio.ensure_future(run_one(task)) for task in tasks}
+    cancelled = 0
+    while pending:
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            (base_url, hotel_name, task_ranges), task_results = future.result()
+            on_task_done(base_url, hotel_name, task_ranges, task_results)
+        if not done:
+            cancelled = len(pending)
+            logger.warning(f"[AsyncEngine] Deadline del reporte alcanzado: cancelando {cancelled} tareas pendientes")
+            for future in pending:
+                future.cancel()
+            # Esperar a que las tareas canceladas aborten sus ejecuciones
+            await asyncio.gather(*pending, return_exceptions=True)
+            break
+
+    stats = controller.get_stats()
+    stats["cancelled_tasks"] = cancelled
+    logger.info(f"[AsyncEngine] Concurrencia final {stats['limit']}, pico en vuelo {stats['peak_in_flight']}, reducciones {stats['decreases']}")
+    if hedger is not None:
+        stats["hedging"] = hedger.get_stats()
+        with _hedging_totals_lock:
+            for key in hedging_totals:
+                hedging_totals[key] += stats["hedging"][key]
+        logger.info(f"[AsyncEngine] Hedging: {stats['hedging']}")
+    return stats
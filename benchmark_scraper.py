@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Benchmark del scraper contra un actor de Apify falso (ver fake_apify.py).
+
+Modos:
+- Comparación (default): modo por noche vs modo batch para un tamaño de set.
+- Suite (--suite): recorre sets de hoteles x días (por defecto de 2x7 a 8x90) y reporta tiempo
+  total, cotizaciones/s, latencia p50/p95/p99 por noche (segundos desde el inicio hasta que llega la
+  cotización de cada noche), 429 recibidos, reintentos (el costo de los 429 que el token bucket
+  debería reducir) y bytes descargados. La latencia por ejecución del actor se muestra aparte: en
+  modo batch una ejecución cubre varias noches, así que no es la latencia por noche.
+
+Con --transport http el scraper usa el cliente real de Apify contra el servidor local
+FakeApifyServer; con --transport memory usa los clientes falsos en memoria.
+
+Uso:
+    python benchmark_scraper.py --hotels 4 --days 30 --cold-start 1.0 --per-url 0.05 --engine asyncio
+    python benchmark_scraper.py --suite --transport http --latency lognormal --base 0.5 --spread 0.4 --rate-limit-rate 0.05
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+# El scraper exige el token al importarse; el actor falso no lo usa.
+os.environ.setdefault("APIFY_API_TOKEN", "fake-token")
+
+from apify_client import ApifyClient, ApifyClientAsync
+
+from apify_scraper import scrape_booking_data
+from fake_apify import FakeApifyClient, FakeApifyClientAsync, FakeApifyServer, LatencyModel, percentile
+from rate_limiter import actor_run_bucket
+from run_usage import RunUsage
+
+DEFAULT_SUITE_SIZES = "2x7,4x14,4x30,8x30,8x60,8x90"
+
+
+def build_hotel_urls(hotels):
+    return [f"https://www.booking.com/hotel/ar/hotel-benchmark-{i + 1}.es.html" for i in range(hotels)]
+
+
+def parse_sizes(sizes):
+    parsed = []
+    for size in sizes.split(","):
+        hotels, days = size.lower().split("x")
+        parsed.append((int(hotels), int(days)))
+    return parsed
+
+
+def build_latency(args):
+    spread = 0.0 if args.latency == "constant" else args.spread
+    return LatencyModel(args.latency, base=args.cold_start, spread=spread, per_url=args.per_url,
+                        stall_rate=args.stall_rate, stall_seconds=args.stall_seconds)
+
+
+def run_benchmark(hotels, days, args, batch_mode):
+    """Ejecuta un scrape completo contra el actor falso y devuelve sus métricas."""
+    latency = build_latency(args)
+    server = None
+    if args.transport == "http":
+        server = FakeApifyServer(latency=latency, rate_limit_rate=args.rate_limit_rate).start()
+        client_class = ApifyClientAsync if args.engine == "asyncio" else ApifyClient
+        client = client_class("fake-token", api_url=server.url)
+        backend = server.backend
+    else:
+        client_class = FakeApifyClientAsync if args.engine == "asyncio" else FakeApifyClient
+        client = client_class(latency=latency, rate_limit_rate=args.rate_limit_rate)
+        backend = client.backend
+
+    quote_times = []
+    usage = RunUsage()
+
+    def on_progress(completed, total, snapshot, new_quotes):
+        elapsed = time.perf_counter() - start
+        quote_times.extend(elapsed for _ in new_quotes)
+
+    start = time.perf_counter()
+    try:
+        results, metadata = scrape_booking_data(
+            build_hotel_urls(hotels), days=days, nights=args.nights, currency="USD",
+            batch_mode=batch_mode, batch_size=args.batch_size, client=client, use_cache=False,
+            engine=args.engine, progress_callback=on_progress, usage=usage,
+        )
+    finally:
+        elapsed = time.perf_counter() - start
+        if server:
+            server.stop()
+
+    prices = sum(1 for hotel in results for k, v in hotel.items() if k not in ("Hotel Name", "URL") and v is not None)
+    stats = backend.get_stats()
+    return {
+        "size": f"{hotels}x{days}",
+        "modo": "batch" if batch_mode else "por noche",
+        "tiempo_s": elapsed,
+        "precios": prices,
+        "cotizaciones_por_s": prices / elapsed if elapsed > 0 else 0,
+        "primera_cotizacion_s": min(quote_times) if quote_times else 0,
+        "cotizacion_p50_s": percentile(quote_times, 50),
+        "cotizacion_p95_s": percentile(quote_times, 95),
+        "cotizacion_p99_s": percentile(quote_times, 99),
+        **stats,
+        "usage": usage.get_summary(hotel_nights=hotels * days),
+        "results": results,
+    }
+
+
+def print_row(stats):
+    print(f"{stats['size']:>6} {stats['modo']:>10} | {stats['tiempo_s']:8.2f}s | {stats['cotizaciones_por_s']:7.2f} cot/s | "
+          f"noche p50 {stats['cotizacion_p50_s']:6.2f}s p95 {stats['cotizacion_p95_s']:6.2f}s p99 {stats['cotizacion_p99_s']:6.2f}s | "
+          f"run p50 {stats['run_latency_p50']:6.2f}s p95 {stats['run_latency_p95']:6.2f}s p99 {stats['run_latency_p99']:6.2f}s | "
+          f"{stats['runs_started']:4d} runs | {stats['rate_limited']:4d} x429 {stats['usage']['retries']:4d} reintentos | "
+          f"{stats['dataset_bytes'] / 1024:8.1f} KB | {stats['precios']:4d} precios | "
+          f"{stats['aborted']:3d} abortadas ({stats['abort_saved_seconds']:.1f}s ahorrados) | "
+          f"{stats['usage']['computeUnits']:.4f} CU ${stats['usage']['usdPerHotelNight']:.6f}/hotel-noche")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del scraper con un actor falso")
+    parser.add_argument("--hotels", type=int, default=2)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--nights", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=30)
+    parser.add_argument("--suite", action="store_true", help="Recorre todos los tamaños de --sizes")
+    parser.add_argument("--sizes", default=DEFAULT_SUITE_SIZES, help="Tamaños hotelesxdías separados por coma")
+    parser.add_argument("--batch", action="store_true", help="En --suite, usar modo batch")
+    parser.add_argument("--transport", choices=["memory", "http"], default="memory")
+    parser.add_argument("--latency", choices=["constant", "uniform", "lognormal"], default="constant")
+    parser.add_argument("--cold-start", "--base", dest="cold_start", type=float, default=1.0,
+                        help="Segundos de arranque por ejecución (mediana en lognormal)")
+    parser.add_argument("--spread", type=float, default=0.5, help="Rango extra (uniform) o sigma (lognormal)")
+    parser.add_argument("--per-url", type=float, default=0.05, help="Segundos por startUrl procesada")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Probabilidad de que una ejecución quede trabada")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="Segundos extra de una ejecución trabada")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Probabilidad de responder 429 al arrancar una ejecución")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Arranques del actor por segundo (0 = sin límite)")
+    parser.add_argument("--burst", type=float, default=20, help="Ráfaga máxima del rate limiter")
+    parser.add_argument("--engine", choices=["asyncio", "threads"], default="asyncio", help="Motor de ejecución del scraper")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # Bucket propio del benchmark (no comparte estado con los workers reales)
+    actor_run_bucket.rate = args.rate_limit
+    actor_run_bucket.burst = args.burst
+    actor_run_bucket.path = os.path.join(tempfile.mkdtemp(), "benchmark_bucket.json")
+
+    print("=" * 60)
+    print(f"Benchmark: motor {args.engine}, transporte {args.transport}, latencia {args.latency} "
+          f"(base {args.cold_start}s, {args.per_url}s por URL), 429 {args.rate_limit_rate:.0%}")
+    print("=" * 60)
+
+    if args.suite:
+        for hotels, days in parse_sizes(args.sizes):
+            print_row(run_benchmark(hotels, days, args, batch_mode=args.batch))
+        print(f"Rate limiter: {actor_run_bucket.get_stats()}")
+        return
+
+    per_night = run_benchmark(args.hotels, args.days, args, batch_mode=False)
+    batch = run_benchmark(args.hotels, args.days, args, batch_mode=True)
+    for stats in (per_night, batch):
+        print_row(stats)
+    if batch["tiempo_s"] > 0:
+        print(f"Speedup batch: {per_night['tiempo_s'] / batch['tiempo_s']:.2f}x")
+    print(f"Rate limiter: {actor_run_bucket.get_stats()}")
+    same = sorted(per_night["results"], key=lambda h: h["URL"]) == sorted(batch["results"], key=lambda h: h["URL"])
+    print(f"Resultados idénticos: {same}")
+
+
+if __name__ == "__main__":
+    main()
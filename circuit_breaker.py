@@ -0,0 +1,212 @@
+"""
+Circuit breaker para las ejecuciones del actor de Apify.
+
+Todas las tareas y reportes del proceso comparten un breaker (apify_breaker). Cada error se
+clasifica como rate limit, error de red transitorio, fallo del actor o error permanente:
+
+- Los rate limits (429) no cuentan: los manejan el backoff, el token bucket y el control AIMD.
+- Los errores permanentes (4xx, entrada inválida, bugs propios) tampoco: fallan la tarea pero no
+  dicen nada de la salud de Apify (unas URLs malas de un usuario no deben frenar al resto).
+- Los transitorios y los fallos del actor cuentan como fallos. Tras APIFY_BREAKER_FAILURE_THRESHOLD fallos consecutivos el
+  breaker se abre y no se lanzan ejecuciones durante APIFY_BREAKER_OPEN_SECONDS.
+- Pasado ese tiempo queda semiabierto: se permiten APIFY_BREAKER_HALF_OPEN_PROBES ejecuciones
+  de prueba. Si una termina bien se cierra; si falla vuelve a abrirse.
+
+Mientras está abierto, las tareas esperan (sin consumir ejecuciones) y la cola no toma reportes nuevos.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+APIFY_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("APIFY_BREAKER_FAILURE_THRESHOLD", "5"))
+APIFY_BREAKER_OPEN_SECONDS = float(os.environ.get("APIFY_BREAKER_OPEN_SECONDS", "60"))
+APIFY_BREAKER_HALF_OPEN_PROBES = int(os.environ.get("APIFY_BREAKER_HALF_OPEN_PROBES", "1"))
+
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+ACTOR_FAILURE = "actor_failure"
+PERMANENT = "permanent"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Nombres de excepciones de red de httpx/urllib3 (el cliente de Apify las deja pasar tras sus reintentos)
+_TRANSIENT_ERROR_NAMES = ("Timeout", "Connect", "Network", "Transport", "Protocol", "RemoteDisconnected", "ReadError")
+
+
+class ActorRunFailed(Exception):
+    """La ejecución del actor terminó con estado FAILED."""
+
+    def __init__(self, run_id, status):
+        super().__init__(f"La ejecución {run_id} del actor terminó con estado {status}")
+        self.run_id = run_id
+        self.status = status
+
+
+def is_rate_limit_message(error):
+    error_msg = str(error).lower()
+    return "429" in error_msg or "too many requests" in error_msg or "rate limit" in error_msg
+
+
+def classify_error(error):
+    """Clasifica un error de una ejecución: RATE_LIMIT, TRANSIENT, ACTOR_FAILURE o PERMANENT."""
+    if isinstance(error, ActorRunFailed):
+        return ACTOR_FAILURE
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429 or is_rate_limit_message(error):
+        return RATE_LIMIT
+    if isinstance(status_code, int):
+        return TRANSIENT if status_code >= 500 or status_code == 408 else PERMANENT
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return TRANSIENT
+    if any(name in type(error).__name__ for name in _TRANSIENT_ERROR_NAMES):
+        return TRANSIENT
+    # Lo desconocido (bugs propios, datos inválidos) es permanente: reintentarlo no lo arregla, la
+    # tarea falla enseguida y el breaker no lo cuenta
+    return PERMANENT
+
+
+class CircuitBreaker:
+    """Breaker cerrado / abierto / semiabierto, seguro entre threads."""
+
+    def __init__(self, failure_threshold=APIFY_BREAKER_FAILURE_THRESHOLD, open_seconds=APIFY_BREAKER_OPEN_SECONDS,
+                 half_open_probes=APIFY_BREAKER_HALF_OPEN_PROBES, name="apify"):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self.name = name
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.failures_by_kind = {TRANSIENT: 0, ACTOR_FAILURE: 0, PERMANENT: 0}
+        self.rate_limits = 0
+        self.successes = 0
+        self.rejected_waits = 0
+        self.history = deque(maxlen=20)
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._last_probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def _transition(self, new_state, reason):
+        # Llamar con self._lock tomado
+        if new_state == self.state:
+            return
+        self.history.append({"at": datetime.now().isoformat(), "from": self.state, "to": new_state, "reason": reason})
+        log = logger.warning if new_state == OPEN else logger.info
+        log(f"[CircuitBreaker] {self.name}: {self.state} -> {new_state} ({reason})")
+        self.state = new_state
+        if new_state == OPEN:
+            self._opened_at = time.monotonic()
+        self._probes_in_flight = 0
+
+    def try_acquire(self):
+        """Devuelve 0 si se puede lanzar una ejecución, o los segundos a esperar antes de volver a intentar."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                remaining = self._opened_at + self.open_seconds - now
+                if remaining > 0:
+                    return remaining
+                self._transition(HALF_OPEN, "fin del período abierto")
+            if self.state == HALF_OPEN:
+                # Una prueba sin resultado (cancelada) libera su lugar después de un período abierto
+                if self._probes_in_flight >= self.half_open_probes and now - self._last_probe_at < self.open_seconds:
+                    return 1.0
+                if self._probes_in_flight >= self.half_open_probes:
+                    self._probes_in_flight = 0
+                self._probes_in_flight += 1
+                self._last_probe_at = now
+            return 0.0
+
+    def acquire(self, deadline=None):
+        """Bloquea hasta poder lanzar una ejecución. Devuelve False si antes vence el deadline (time.time())."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.time() + wait >= deadline:
+                return False
+            self._record_wait()
+            time.sleep(wait)
+
+    async def acquire_async(self, deadline=None):
+        """Versión async de acquire (no bloquea el event loop)."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.time() + wait >= deadline:
+                return False
+            self._record_wait()
+            await asyncio.sleep(wait)
+
+    def _record_wait(self):
+        with self._lock:
+            self.rejected_waits += 1
+
+    def record_success(self):
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self._transition(CLOSED, "ejecución de prueba exitosa")
+
+    def record_failure(self, kind):
+        """
+        Registra el resultado fallido de una ejecución. Solo TRANSIENT y ACTOR_FAILURE acercan el
+        breaker a abrirse; los rate limits y los errores permanentes no afectan el estado.
+        """
+        with self._lock:
+            if kind == RATE_LIMIT:
+                self.rate_limits += 1
+            else:
+                self.failures_by_kind[kind] = self.failures_by_kind.get(kind, 0) + 1
+            if kind not in (TRANSIENT, ACTOR_FAILURE):
+                # La prueba no dijo nada de Apify: libera su lugar para otra
+                if self.state == HALF_OPEN:
+                    self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                return
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN:
+                self._transition(OPEN, f"falló la ejecución de prueba ({kind})")
+            elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self._transition(OPEN, f"{self.consecutive_failures} fallos consecutivos (último: {kind})")
+
+    def is_open(self):
+        """True mientras el breaker esté abierto y no haya llegado el momento de probar."""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() < self._opened_at + self.open_seconds
+
+    def seconds_until_retry(self):
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def get_status(self):
+        retry_in = self.seconds_until_retry()
+        with self._lock:
+            return {
+                "name": self.name,
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "open_seconds": self.open_seconds,
+                "retry_in_seconds": round(retry_in, 1),
+                "failures_by_kind": dict(self.failures_by_kind),
+                "rate_limits": self.rate_limits,
+                "successes": self.successes,
+                "waits": self.rejected_waits,
+                "history": list(self.history),
+            }
+
+
+# Breaker compartido por todas las ejecuciones del actor del proceso
+apify_breaker = CircuitBreaker()
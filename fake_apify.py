@@ -0,0 +1,527 @@
+"""
+Stand-in local de Apify para benchmarks del scraper (sin gastar créditos).
+
+Simula el actor voyager/booking-scraper: cada ejecución tarda según un modelo de latencia
+configurable (cold start + tiempo por startUrl), puede rechazarse con 429 según una tasa de
+inyección, y genera items con la misma forma que lee el parser
+(rating, reviews, rooms/options/displayedPrice, checkIn, url).
+
+Dos formas de uso:
+- FakeApifyClient / FakeApifyClientAsync: reemplazos en memoria de ApifyClient / ApifyClientAsync.
+- FakeApifyServer: servidor HTTP local que implementa los endpoints de la API v2 que usa el
+  cliente real (runs, actor-runs, datasets/items, abort, logs). Se usa con
+  ApifyClient(token, api_url=server.url) o con APIFY_API_URL.
+"""
+import asyncio
+import gzip
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# Memoria asignada a cada ejecución simulada y precio del compute unit (1 CU = 1 GB-hora)
+FAKE_RUN_MEMORY_GB = 1.0
+FAKE_USD_PER_COMPUTE_UNIT = 0.4
+
+
+def run_usage_fields(started_at, finished_at):
+    """Campos de consumo de una ejecución terminada, con la forma que devuelve la API de Apify."""
+    run_seconds = max(0.0, finished_at - started_at)
+    compute_units = FAKE_RUN_MEMORY_GB * run_seconds / 3600
+    return {
+        "stats": {
+            "runTimeSecs": round(run_seconds, 3),
+            "durationMillis": int(run_seconds * 1000),
+            "computeUnits": round(compute_units, 6),
+        },
+        "usageTotalUsd": round(compute_units * FAKE_USD_PER_COMPUTE_UNIT, 6),
+    }
+
+
+class FakeRateLimitError(Exception):
+    """Error equivalente al 429 de la API de Apify."""
+
+    def __init__(self):
+        super().__init__("429 Too Many Requests: rate limit exceeded")
+
+
+class LatencyModel:
+    """
+    Modelo de duración de una ejecución del actor.
+
+    Args:
+        kind: "constant", "uniform" o "lognormal".
+        base: Segundos de cold start (mediana en lognormal, mínimo en uniform).
+        spread: Máximo adicional en uniform, o sigma en lognormal.
+        per_url: Segundos adicionales por cada startUrl.
+        stall_rate: Probabilidad (0-1) de que una ejecución quede trabada (proxy colgado, challenge).
+        stall_seconds: Segundos extra de una ejecución trabada.
+    """
+
+    def __init__(self, kind="constant", base=1.0, spread=0.0, per_url=0.05, stall_rate=0.0, stall_seconds=30.0):
+        self.kind = kind
+        self.base = base
+        self.spread = spread
+        self.per_url = per_url
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+
+    def sample(self, rng, urls):
+        if self.kind == "uniform":
+            base = rng.uniform(self.base, self.base + self.spread)
+        elif self.kind == "lognormal":
+            base = self.base * math.exp(rng.gauss(0, self.spread))
+        else:
+            base = self.base
+        if self.stall_rate and rng.random() < self.stall_rate:
+            base += self.stall_seconds
+        return base + self.per_url * urls
+
+
+def percentile(values, pct):
+    """Percentil por rango más cercano (values no necesita estar ordenado)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class FakeActorBackend:
+    """Estado compartido del actor simulado: ejecuciones, datasets y estadísticas."""
+
+    def __init__(self, latency=None, rate_limit_rate=0.0, seed=42):
+        self.latency = latency or LatencyModel()
+        self.rate_limit_rate = rate_limit_rate
+        self.seed = seed
+        self.runs = {}
+        self.datasets = {}
+        self.runs_started = 0
+        self.rate_limited = 0
+        self.aborted = 0
+        self.abort_saved_seconds = 0.0
+        self.compute_units = 0.0
+        self.urls_processed = 0
+        self.dataset_bytes = 0
+        self._ids = itertools.count(1)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def start_run(self, run_input):
+        """Registra una ejecución nueva. Lanza FakeRateLimitError si toca inyectar un 429."""
+        start_urls = run_input.get("startUrls", [])
+        with self._lock:
+            if self._rng.random() < self.rate_limit_rate:
+                self.rate_limited += 1
+                raise FakeRateLimitError()
+            self.runs_started += 1
+            self.urls_processed += len(start_urls)
+            run_number = next(self._ids)
+            duration = self.latency.sample(self._rng, len(start_urls))
+            run = {
+                "id": f"fake-run-{run_number}",
+                "actId": "voyager~booking-scraper",
+                "status": "RUNNING",
+                "defaultDatasetId": f"fake-dataset-{run_number}",
+                "startedAt": datetime.now(timezone.utc).isoformat(),
+                "finishedAt": None,
+                "_created": time.time(),
+                "_finish_at": time.time() + duration,
+                "_input": run_input,
+                "_items_fetched": None,
+            }
+            self.runs[run["id"]] = run
+        return run
+
+    def refresh(self, run_id):
+        """Actualiza el estado de la ejecución según el reloj y devuelve su versión pública."""
+        with self._lock:
+            run = self.runs.get(run_id)
+            if run is None:
+                return None
+            if run["status"] == "RUNNING" and time.time() >= run["_finish_at"]:
+                run["status"] = "SUCCEEDED"
+                run["finishedAt"] = datetime.now(timezone.utc).isoformat()
+                self._record_usage(run, run["_finish_at"])
+                self.datasets[run["defaultDatasetId"]] = [
+                    self.build_item(start_url, run["_input"]) for start_url in run["_input"].get("startUrls", [])
+                ]
+            return {k: v for k, v in run.items() if not k.startswith("_")}
+
+    def seconds_left(self, run_id):
+        with self._lock:
+            run = self.runs.get(run_id)
+            if run is None or run["status"] != "RUNNING":
+                return 0.0
+            return max(0.0, run["_finish_at"] - time.time())
+
+    def abort(self, run_id):
+        with self._lock:
+            run = self.runs.get(run_id)
+            if run is not None and run["status"] == "RUNNING":
+                run["status"] = "ABORTED"
+                run["finishedAt"] = datetime.now(timezone.utc).isoformat()
+                self.aborted += 1
+                # Tiempo que le faltaba a la ejecución abortada (lo que se ahorró al no esperarla)
+                self.abort_saved_seconds += max(0.0, run["_finish_at"] - time.time())
+                self._record_usage(run, time.time())
+        return self.refresh(run_id)
+
+    def _record_usage(self, run, finished_at):
+        # Llamar con self._lock tomado
+        run.update(run_usage_fields(run["_created"], finished_at))
+        self.compute_units += run["stats"]["computeUnits"]
+
+    def list_items(self, dataset_id, offset=0, limit=None, fields=None):
+        """Devuelve (items de la página, total) y registra la latencia de la ejecución."""
+        with self._lock:
+            items = self.datasets.get(dataset_id, [])
+            run = self.runs.get(dataset_id.replace("fake-dataset-", "fake-run-"))
+            if run is not None and run["_items_fetched"] is None:
+                run["_items_fetched"] = time.time()
+        page = items[offset:offset + limit if limit is not None else None]
+        if fields:
+            page = [{k: item[k] for k in fields if k in item} for item in page]
+        return page, len(items)
+
+    def record_bytes(self, size):
+        with self._lock:
+            self.dataset_bytes += size
+
+    def run_latencies(self):
+        """Segundos entre la creación de cada ejecución y la primera lectura de su dataset."""
+        with self._lock:
+            return [run["_items_fetched"] - run["_created"] for run in self.runs.values() if run["_items_fetched"]]
+
+    def get_stats(self):
+        latencies = self.run_latencies()
+        return {
+            "runs_started": self.runs_started,
+            "rate_limited": self.rate_limited,
+            "aborted": self.aborted,
+            "abort_saved_seconds": round(self.abort_saved_seconds, 2),
+            "compute_units": round(self.compute_units, 4),
+            "urls_processed": self.urls_processed,
+            "dataset_bytes": self.dataset_bytes,
+            "run_latency_p50": percentile(latencies, 50),
+            "run_latency_p95": percentile(latencies, 95),
+            "run_latency_p99": percentile(latencies, 99),
+        }
+
+    def build_item(self, start_url, run_input):
+        url = start_url.get("url", "")
+        query = parse_qs(urlparse(url).query)
+        user_data = start_url.get("userData") or {}
+        checkin = user_data.get("checkIn") or query.get("checkin", [run_input.get("checkIn")])[0]
+        checkout = user_data.get("checkOut") or query.get("checkout", [run_input.get("checkOut")])[0]
+        hotel_path = urlparse(url).path
+        rng = random.Random(f"{self.seed}-{hotel_path}-{checkin}")
+        return {
+            "url": url,
+            "name": hotel_path.split("/")[-1].split(".")[0],
+            "checkIn": checkin,
+            "checkOut": checkout,
+            "rating": round(rng.uniform(7.0, 9.8), 1),
+            "reviews": rng.randint(50, 3000),
+            "description": "x" * 2000,
+            "images": [f"https://example.com/img/{i}.jpg" for i in range(20)],
+            "rooms": [
+                {
+                    "roomType": f"Habitación {r + 1}",
+                    "options": [
+                        {"displayedPrice": round(rng.uniform(60, 400), 2), "currency": run_input.get("currency", "USD")}
+                        for _ in range(3)
+                    ],
+                }
+                for r in range(4)
+            ],
+        }
+
+
+# --- CLIENTES EN MEMORIA ---
+
+class FakeListPage:
+    def __init__(self, items):
+        self.items = items
+
+
+class FakeDatasetClient:
+    def __init__(self, fake, dataset_id):
+        self.fake = fake
+        self.dataset_id = dataset_id
+
+    def list_items(self, offset=0, limit=None, fields=None, **kwargs):
+        items, _ = self.fake.backend.list_items(self.dataset_id, offset or 0, limit, fields)
+        self.fake.backend.record_bytes(len(json.dumps(items)))
+        return FakeListPage(items)
+
+    def iterate_items(self, offset=0, limit=None, fields=None, **kwargs):
+        yield from self.list_items(offset=offset, limit=limit, fields=fields).items
+
+
+class FakeRunClient:
+    def __init__(self, fake, run_id):
+        self.fake = fake
+        self.run_id = run_id
+
+    def abort(self, **kwargs):
+        return self.fake.backend.abort(self.run_id)
+
+    def get(self):
+        return self.fake.backend.refresh(self.run_id)
+
+    def wait_for_finish(self, wait_secs=None):
+        left = self.fake.backend.seconds_left(self.run_id)
+        time.sleep(left if wait_secs is None else min(left, wait_secs))
+        return self.fake.backend.refresh(self.run_id)
+
+
+class FakeActorClient:
+    def __init__(self, fake, actor_id):
+        self.fake = fake
+        self.actor_id = actor_id
+
+    def start(self, run_input=None, **kwargs):
+        run = self.fake.backend.start_run(run_input or {})
+        return self.fake.backend.refresh(run["id"])
+
+    def call(self, run_input=None, **kwargs):
+        run = self.fake.backend.start_run(run_input or {})
+        time.sleep(self.fake.backend.seconds_left(run["id"]))
+        return self.fake.backend.refresh(run["id"])
+
+
+class FakeApifyClient:
+    """
+    Reemplazo en memoria de ApifyClient.
+
+    Args:
+        cold_start: Segundos de arranque de cada ejecución (si no se pasa latency).
+        per_url: Segundos adicionales por cada startUrl (si no se pasa latency).
+        seed: Semilla para que precios, latencias y 429 sean reproducibles.
+        latency: LatencyModel a usar en lugar de cold_start/per_url.
+        rate_limit_rate: Probabilidad (0-1) de rechazar el arranque de una ejecución con 429.
+    """
+
+    def __init__(self, cold_start=1.0, per_url=0.05, seed=42, latency=None, rate_limit_rate=0.0):
+        self.backend = FakeActorBackend(latency or LatencyModel(base=cold_start, per_url=per_url), rate_limit_rate, seed)
+
+    @property
+    def runs_started(self):
+        return self.backend.runs_started
+
+    def actor(self, actor_id):
+        return FakeActorClient(self, actor_id)
+
+    def dataset(self, dataset_id):
+        return FakeDatasetClient(self, dataset_id)
+
+    def run(self, run_id):
+        return FakeRunClient(self, run_id)
+
+
+class FakeDatasetClientAsync(FakeDatasetClient):
+    async def list_items(self, offset=0, limit=None, fields=None, **kwargs):
+        return FakeDatasetClient.list_items(self, offset=offset, limit=limit, fields=fields)
+
+    async def iterate_items(self, offset=0, limit=None, fields=None, **kwargs):
+        for item in FakeDatasetClient.list_items(self, offset=offset, limit=limit, fields=fields).items:
+            yield item
+
+
+class FakeRunClientAsync(FakeRunClient):
+    async def abort(self, **kwargs):
+        return self.fake.backend.abort(self.run_id)
+
+    async def get(self):
+        return self.fake.backend.refresh(self.run_id)
+
+    async def wait_for_finish(self, wait_secs=None):
+        left = self.fake.backend.seconds_left(self.run_id)
+        await asyncio.sleep(left if wait_secs is None else min(left, wait_secs))
+        return self.fake.backend.refresh(self.run_id)
+
+
+class FakeActorClientAsync(FakeActorClient):
+    async def start(self, run_input=None, **kwargs):
+        return FakeActorClient.start(self, run_input)
+
+    async def call(self, run_input=None, **kwargs):
+        run = self.fake.backend.start_run(run_input or {})
+        await asyncio.sleep(self.fake.backend.seconds_left(run["id"]))
+        return self.fake.backend.refresh(run["id"])
+
+
+class FakeApifyClientAsync(FakeApifyClient):
+    """Reemplazo en memoria de ApifyClientAsync (mismo actor simulado, con asyncio.sleep)."""
+
+    def actor(self, actor_id):
+        return FakeActorClientAsync(self, actor_id)
+
+    def dataset(self, dataset_id):
+        return FakeDatasetClientAsync(self, dataset_id)
+
+    def run(self, run_id):
+        return FakeRunClientAsync(self, run_id)
+
+
+# --- SERVIDOR HTTP ---
+
+class _FakeApifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    backend = None  # Se asigna en FakeApifyServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def _send_error(self, status, error_type, message):
+        self._send_json(status, {"error": {"type": error_type, "message": message}})
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        # El cliente de Apify comprime el input con gzip
+        if body and self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def _wait(self, run_id, params):
+        # waitForFinish: el servidor retiene la respuesta hasta que termine la ejecución (máx. 60 s)
+        wait = min(float(params.get("waitForFinish", ["0"])[0] or 0), 60.0)
+        if wait > 0:
+            time.sleep(min(wait, self.backend.seconds_left(run_id)))
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        parts = [p for p in parsed.path.split("/") if p]
+        body = self._read_body()
+        # POST /v2/acts/{actorId}/runs
+        if len(parts) == 4 and parts[1] == "acts" and parts[3] == "runs":
+            try:
+                run_input = json.loads(body or b"{}")
+            except ValueError:
+                return self._send_error(400, "invalid-input", "Input inválido")
+            try:
+                run = self.backend.start_run(run_input)
+            except FakeRateLimitError as e:
+                return self._send_error(429, "rate-limit-exceeded", str(e))
+            self._wait(run["id"], params)
+            return self._send_json(201, {"data": self.backend.refresh(run["id"])})
+        # POST /v2/actor-runs/{runId}/abort
+        if len(parts) == 4 and parts[1] == "actor-runs" and parts[3] == "abort":
+            run = self.backend.abort(parts[2])
+            if run is None:
+                return self._send_error(404, "record-not-found", "Run no encontrado")
+            return self._send_json(200, {"data": run})
+        return self._send_error(404, "page-not-found", f"Ruta no soportada: {parsed.path}")
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        parts = [p for p in parsed.path.split("/") if p]
+        # GET /v2/actor-runs/{runId}
+        if len(parts) == 3 and parts[1] == "actor-runs":
+            if self.backend.refresh(parts[2]) is None:
+                return self._send_error(404, "record-not-found", "Run no encontrado")
+            self._wait(parts[2], params)
+            return self._send_json(200, {"data": self.backend.refresh(parts[2])})
+        # GET /v2/actor-runs/{runId}/log y /v2/logs/{runId}: el actor falso no genera logs
+        if (len(parts) == 4 and parts[1] == "actor-runs" and parts[3] == "log") or (len(parts) == 3 and parts[1] == "logs"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        # GET /v2/datasets/{datasetId}/items
+        if len(parts) == 4 and parts[1] == "datasets" and parts[3] == "items":
+            offset = int(params.get("offset", ["0"])[0])
+            limit = int(params["limit"][0]) if "limit" in params else None
+            fields = params["fields"][0].split(",") if "fields" in params else None
+            items, total = self.backend.list_items(parts[2], offset, limit, fields)
+            size = self._send_json(200, items, headers={
+                "X-Apify-Pagination-Total": str(total),
+                "X-Apify-Pagination-Offset": str(offset),
+                "X-Apify-Pagination-Limit": str(limit if limit is not None else 999999999999),
+                "X-Apify-Pagination-Count": str(len(items)),
+                "X-Apify-Pagination-Desc": "false",
+            })
+            self.backend.record_bytes(size)
+            return
+        return self._send_error(404, "page-not-found", f"Ruta no soportada: {parsed.path}")
+
+
+class FakeApifyServer:
+    """
+    Servidor HTTP local con la API de Apify que usa el scraper.
+
+    Uso:
+        server = FakeApifyServer(latency=LatencyModel("lognormal", base=2, spread=0.5), rate_limit_rate=0.05).start()
+        client = ApifyClient("fake-token", api_url=server.url)
+        ...
+        server.stop()
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=None, rate_limit_rate=0.0, seed=42):
+        self.backend = FakeActorBackend(latency, rate_limit_rate, seed)
+        handler = type("FakeApifyHandler", (_FakeApifyHandler,), {"backend": self.backend})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Servidor local que simula la API de Apify")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", choices=["constant", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--base", type=float, default=2.0)
+    parser.add_argument("--spread", type=float, default=0.5)
+    parser.add_argument("--per-url", type=float, default=0.05)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-seconds", type=float, default=30.0)
+    args = parser.parse_args()
+
+    server = FakeApifyServer(
+        port=args.port,
+        latency=LatencyModel(args.latency, args.base, args.spread, args.per_url, args.stall_rate, args.stall_seconds),
+        rate_limit_rate=args.rate_limit_rate,
+    ).start()
+    print(f"API falsa de Apify escuchando en {server.url} (usar APIFY_API_URL={server.url})")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,171 @@
+"""
+Conversión local de monedas para el scraper.
+
+En lugar de lanzar el actor una vez por moneda, los reportes se scrapean en una moneda base
+(FX_BASE_CURRENCY) y los precios se convierten localmente con una tabla de tipos de cambio. Así
+dos sets que siguen el mismo hotel en USD y en ARS comparten ejecuciones y entradas del cache.
+
+La tabla se descarga de FX_RATES_URL cada FX_REFRESH_HOURS horas y se guarda en memoria y,
+opcionalmente, en Firestore (colección FX_RATES_COLLECTION) para compartirla entre workers.
+Si la tabla no está disponible o tiene más de FX_MAX_AGE_HOURS horas, o si el reporte pide los
+precios exactos que muestra Booking (exact_prices), se scrapea directamente en la moneda pedida.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+FX_CONVERSION_ENABLED = os.environ.get("FX_CONVERSION_ENABLED", "true").lower() == "true"
+FX_BASE_CURRENCY = os.environ.get("FX_BASE_CURRENCY", "USD").upper()
+FX_RATES_URL = os.environ.get("FX_RATES_URL", "https://open.er-api.com/v6/latest/{base}")
+FX_REFRESH_HOURS = float(os.environ.get("FX_REFRESH_HOURS", "6"))
+FX_MAX_AGE_HOURS = float(os.environ.get("FX_MAX_AGE_HOURS", "36"))
+FX_RATES_COLLECTION = os.environ.get("FX_RATES_COLLECTION", "fx_rates")
+
+
+def fetch_rates(base):
+    """Descarga la tabla de tipos de cambio para la moneda base: dict moneda -> unidades por 1 base."""
+    response = requests.get(FX_RATES_URL.format(base=base), timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    rates = data.get("rates") or data.get("conversion_rates")
+    if not rates:
+        raise ValueError(f"Respuesta de tipos de cambio sin tabla de tasas: {list(data.keys())}")
+    return {currency.upper(): float(rate) for currency, rate in rates.items()}
+
+
+def convert_price(price, rate):
+    """Convierte un precio (número o string numérico, como los devuelve el actor) con la tasa dada."""
+    if price is None:
+        return None
+    try:
+        return str(round(float(price) * rate, 2))
+    except (ValueError, TypeError):
+        return price
+
+
+class FirestoreRatesStore:
+    """Tabla de tipos de cambio compartida en Firestore (un documento por moneda base)."""
+
+    def __init__(self, db, collection=FX_RATES_COLLECTION):
+        self.db = db
+        self.collection = collection
+
+    def get(self, base):
+        doc = self.db.collection(self.collection).document(base).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set(self, base, rates, fetched_at):
+        self.db.collection(self.collection).document(base).set({
+            "base": base,
+            "rates": rates,
+            "fetched_at": fetched_at,
+            "updatedAt": datetime.fromtimestamp(fetched_at),
+        })
+
+
+class FxRateTable:
+    """Tabla de tipos de cambio con refresco periódico y nivel persistente opcional."""
+
+    def __init__(self, base=FX_BASE_CURRENCY, persistent_store=None, fetcher=fetch_rates):
+        self.base = base
+        self.persistent_store = persistent_store
+        self.fetcher = fetcher
+        self.rates = {}
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"refreshes": 0, "persistent_hits": 0, "errors": 0}
+
+    def _age_hours(self, fetched_at, now):
+        return (now - fetched_at) / 3600
+
+    def refresh(self, force=False):
+        """
+        Actualiza la tabla si está vencida: primero desde el nivel persistente (si otro worker ya
+        la refrescó) y si no desde FX_RATES_URL. Los errores dejan la tabla anterior.
+        """
+        with self._lock:
+            now = time.time()
+            if not force and self.rates and self._age_hours(self.fetched_at, now) < FX_REFRESH_HOURS:
+                return
+            if not force and self.persistent_store is not None:
+                try:
+                    stored = self.persistent_store.get(self.base)
+                except Exception as e:
+                    logger.warning(f"[FX] Error leyendo tabla persistente: {e}")
+                    stored = None
+                if stored and stored.get("rates") and self._age_hours(stored.get("fetched_at", 0), now) < FX_REFRESH_HOURS:
+                    self.rates = stored["rates"]
+                    self.fetched_at = stored["fetched_at"]
+                    self.stats["persistent_hits"] += 1
+                    return
+            try:
+                rates = self.fetcher(self.base)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"[FX] No se pudo actualizar la tabla de tipos de cambio ({self.base}): {e}")
+                return
+            self.rates = rates
+            self.fetched_at = now
+            self.stats["refreshes"] += 1
+            logger.info(f"[FX] Tabla de tipos de cambio actualizada: {len(rates)} monedas, base {self.base}")
+        if self.persistent_store is not None:
+            try:
+                self.persistent_store.set(self.base, rates, now)
+            except Exception as e:
+                logger.warning(f"[FX] Error guardando tabla persistente: {e}")
+
+    def get_rate(self, currency):
+        """Unidades de `currency` por 1 unidad de la moneda base, o None si no hay tasa vigente."""
+        currency = (currency or "").upper()
+        if currency == self.base:
+            return 1.0
+        self.refresh()
+        with self._lock:
+            if not self.rates or self._age_hours(self.fetched_at, time.time()) > FX_MAX_AGE_HOURS:
+                return None
+            return self.rates.get(currency)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["base"] = self.base
+            stats["currencies"] = len(self.rates)
+            stats["fetched_at"] = datetime.fromtimestamp(self.fetched_at).isoformat() if self.fetched_at else None
+        return stats
+
+
+# Tabla compartida por todos los reportes del proceso
+fx_rate_table = FxRateTable()
+
+
+def configure_persistent_store(db):
+    """Activa el nivel persistente en Firestore para la tabla de tipos de cambio."""
+    fx_rate_table.persistent_store = FirestoreRatesStore(db)
+    logger.info(f"[FX] Nivel persistente configurado en la colección '{FX_RATES_COLLECTION}'")
+
+
+def plan_conversion(currency, exact_prices=False):
+    """
+    Decide cómo obtener los precios de un reporte en `currency`.
+    Devuelve None para scrapear en la moneda pedida, o un dict con la moneda base y la tasa a
+    aplicar ({"baseCurrency", "currency", "rate", "ratesAt"}) para scrapear en la base y convertir.
+    """
+    currency = (currency or "").upper()
+    if not FX_CONVERSION_ENABLED or exact_prices or not currency or currency == fx_rate_table.base:
+        return None
+    rate = fx_rate_table.get_rate(currency)
+    if not rate:
+        logger.info(f"[FX] Sin tasa vigente {fx_rate_table.base}->{currency}: se scrapea en {currency}")
+        return None
+    return {
+        "baseCurrency": fx_rate_table.base,
+        "currency": currency,
+        "rate": rate,
+        "ratesAt": datetime.fromtimestamp(fx_rate_table.fetched_at).isoformat(),
+    }
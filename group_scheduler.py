@@ -0,0 +1,259 @@
+"""
+Scheduler de grupos programados dentro del proceso worker.
+
+Cada grupo programado guarda next_run_at (datetime UTC, ver schedule_window.next_run_at). El
+scheduler consulta con una collection group query los grupos con next_run_at vencido, encola sus
+reportes (ids deterministas: un reporte por grupo y día local) y avanza next_run_at al próximo
+arranque. Después duerme hasta el next_run_at más cercano (o hasta renovar su liderazgo).
+
+Solo un nodo programa: el que tiene el lease del documento SCHEDULER_LEADER_COLLECTION/leader
+(leaderId + leaderExpiresAt, renovado en una transacción). Si el líder muere, otro worker toma el
+lease cuando vence.
+
+La primera vez que un nodo es líder corre backfill (completa next_run_at en los grupos programados
+creados antes del índice) y deja la marca SCHEDULER_LEADER_COLLECTION/schedule_index, así ningún
+grupo existente queda sin correr después del deploy.
+
+Requiere los índices de campo único de next_run_at y schedule_enabled con alcance collection group
+en 'grupos'.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound
+
+import schedule_window
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_LEADER_COLLECTION = os.environ.get("SCHEDULER_LEADER_COLLECTION", "scheduler_leader")
+SCHEDULER_LEADER_LEASE_SECONDS = float(os.environ.get("SCHEDULER_LEADER_LEASE_SECONDS", "60"))
+# Grupos vencidos que se procesan por vuelta
+SCHEDULER_DUE_LIMIT = int(os.environ.get("SCHEDULER_DUE_LIMIT", "500"))
+
+# Los null de Firestore se ordenan antes que los timestamps: este filtro los excluye
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def group_next_run_at(set_id, grupo_data, after=None):
+    """next_run_at de un grupo según su schedule (None si no está programado)."""
+    days = grupo_data.get("days") or 1
+    hotels = 1 + len(grupo_data.get("competidores") or [])
+    return schedule_window.next_run_at(
+        set_id,
+        grupo_data.get("schedule_run_weekdays") or [],
+        grupo_data.get("schedule_timezone"),
+        cost=days * hotels,
+        after=after,
+    )
+
+
+class LeaderLease:
+    """Lease de liderazgo en un documento de Firestore (un solo scheduler activo entre nodos)."""
+
+    def __init__(self, db, worker_id, collection=SCHEDULER_LEADER_COLLECTION, lease_seconds=SCHEDULER_LEADER_LEASE_SECONDS):
+        self.db = db
+        self.worker_id = worker_id
+        self.doc_ref = db.collection(collection).document("leader")
+        self.lease_seconds = lease_seconds
+        self.is_leader = False
+        self.expires_at = 0.0
+
+    def ensure(self):
+        """Toma o renueva el liderazgo. Devuelve True si este worker es el líder."""
+
+        @firestore.transactional
+        def acquire(transaction):
+            snapshot = self.doc_ref.get(transaction=transaction)
+            data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            expires = data.get("leaderExpiresAt")
+            if data.get("leaderId") not in (None, self.worker_id) and expires is not None and expires > now:
+                return False
+            transaction.set(self.doc_ref, {
+                "leaderId": self.worker_id,
+                "leaderExpiresAt": now + timedelta(seconds=self.lease_seconds),
+                "renewedAt": now,
+            })
+            return True
+
+        was_leader = self.is_leader
+        try:
+            self.is_leader = acquire(self.db.transaction())
+        except Exception as e:
+            # Sin poder renovar, el liderazgo vale solo hasta que vence el lease
+            logger.warning(f"[Scheduler] Error renovando el liderazgo: {e}")
+            self.is_leader = self.is_leader and time.time() < self.expires_at
+            return self.is_leader
+        if self.is_leader:
+            self.expires_at = time.time() + self.lease_seconds
+        if self.is_leader != was_leader:
+            logger.info(f"[Scheduler] {self.worker_id} {'es ahora' if self.is_leader else 'dejó de ser'} el líder del scheduler")
+        return self.is_leader
+
+    def release(self):
+        if not self.is_leader:
+            return
+
+        @firestore.transactional
+        def release(transaction):
+            snapshot = self.doc_ref.get(transaction=transaction)
+            if snapshot.exists and (snapshot.to_dict() or {}).get("leaderId") == self.worker_id:
+                transaction.update(self.doc_ref, {"leaderExpiresAt": datetime.now(timezone.utc)})
+
+        try:
+            release(self.db.transaction())
+        except Exception as e:
+            logger.warning(f"[Scheduler] Error liberando el liderazgo: {e}")
+        self.is_leader = False
+
+
+class GroupScheduler:
+    """
+    Encola los reportes de los grupos con next_run_at vencido.
+
+    enqueue_due(due) recibe [(uid, grupo_id, grupo_data, run_at)] y encola sus reportes
+    (idempotente); devuelve un dict con los totales para el log.
+    """
+
+    def __init__(self, db, enqueue_due, worker_id, enabled=SCHEDULER_ENABLED, due_limit=SCHEDULER_DUE_LIMIT,
+                 backfill=None):
+        self.db = db
+        self.enqueue_due = enqueue_due
+        self.backfill = backfill
+        self.worker_id = worker_id
+        self._backfilled = backfill is None
+        self.enabled = enabled
+        self.due_limit = due_limit
+        self.leader = LeaderLease(db, worker_id)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self.next_due_at = None
+        self.stats = {"ticks": 0, "groups_run": 0, "last_tick_at": None, "last_result": None}
+
+    def _groups(self):
+        return self.db.collection_group("grupos")
+
+    def run_due(self, now=None):
+        """Encola los grupos vencidos y avanza su next_run_at. Devuelve cuántos grupos corrieron."""
+        now = now or datetime.now(timezone.utc)
+        due_query = (
+            self._groups()
+            .where("next_run_at", "<=", now)
+            .order_by("next_run_at")
+            .limit(self.due_limit)
+        )
+        due = []
+        for grupo in due_query.stream():
+            user_ref = grupo.reference.parent.parent
+            grupo_data = grupo.to_dict() or {}
+            if user_ref is None:
+                continue
+            due.append((user_ref.id, grupo.id, grupo_data, grupo_data["next_run_at"], grupo))
+        if not due:
+            return 0
+        # Primero encolar (ids deterministas: repetir no duplica) y después avanzar next_run_at
+        result = self.enqueue_due([
+            (uid, grupo_id, grupo_data, run_at)
+            for uid, grupo_id, grupo_data, run_at, _ in due
+            if grupo_data.get("schedule_enabled", False)
+        ])
+        rescheduled = 0
+        for uid, grupo_id, grupo_data, run_at, grupo in due:
+            if grupo_data.get("schedule_enabled", False):
+                # Si el worker estuvo caído varios días, se corre una vez y se sigue desde ahora
+                following = group_next_run_at(grupo_id, grupo_data, after=max(now, run_at))
+            else:
+                # Un grupo deshabilitado con next_run_at viejo no corre: solo se le borra el next_run_at
+                following = None
+            try:
+                # Precondición: si /configurar-schedule lo reprogramó después de la consulta, gana ese valor
+                grupo.reference.update(
+                    {"next_run_at": following if following is not None else firestore.DELETE_FIELD},
+                    option=self.db.write_option(last_update_time=grupo.update_time),
+                )
+            except (FailedPrecondition, NotFound):
+                rescheduled += 1
+        if rescheduled:
+            logger.info(f"[Scheduler] {rescheduled} grupos cambiaron durante la vuelta: se respeta su nuevo next_run_at")
+        self.stats["groups_run"] += len(due)
+        self.stats["last_result"] = result
+        logger.info(f"[Scheduler] {len(due)} grupos vencidos procesados: {result}")
+        return len(due)
+
+    def run_backfill(self):
+        """Corre backfill una sola vez entre todos los nodos (marca en SCHEDULER_LEADER_COLLECTION)."""
+        marker = self.db.collection(SCHEDULER_LEADER_COLLECTION).document("schedule_index")
+        if not marker.get().exists:
+            updated = self.backfill()
+            marker.set({"completedAt": datetime.now(timezone.utc), "groupsUpdated": updated, "workerId": self.worker_id})
+            logger.info(f"[Scheduler] Índice del scheduler completado en {updated} grupos existentes")
+        self._backfilled = True
+
+    def earliest_next_run(self):
+        query = (
+            self._groups()
+            .where("next_run_at", ">=", _EPOCH)
+            .order_by("next_run_at")
+            .limit(1)
+        )
+        for grupo in query.stream():
+            return (grupo.to_dict() or {}).get("next_run_at")
+        return None
+
+    def tick(self):
+        """Una vuelta del líder. Devuelve los segundos hasta la próxima."""
+        self.stats["ticks"] += 1
+        self.stats["last_tick_at"] = datetime.now(timezone.utc).isoformat()
+        # Con más vencidos que due_limit, seguir enseguida
+        if self.run_due() >= self.due_limit:
+            return 0.0
+        self.next_due_at = self.earliest_next_run()
+        if self.next_due_at is None:
+            return float("inf")
+        # Medio segundo de margen para no despertar justo antes del vencimiento
+        return max(0.5, (self.next_due_at - datetime.now(timezone.utc)).total_seconds() + 0.5)
+
+    def run(self):
+        """Bucle del scheduler: duerme hasta el próximo grupo vencido (o hasta renovar el liderazgo)."""
+        if not self.enabled:
+            logger.info("[Scheduler] Scheduler deshabilitado (SCHEDULER_ENABLED=false)")
+            return
+        renew_every = self.leader.lease_seconds / 3
+        while not self._stop.is_set():
+            wait = renew_every
+            try:
+                if self.leader.ensure():
+                    if not self._backfilled:
+                        self.run_backfill()
+                    wait = min(renew_every, self.tick())
+            except Exception as e:
+                logger.error(f"[Scheduler] Error en el scheduler: {e}")
+            self._wake.wait(wait)
+            self._wake.clear()
+        self.leader.release()
+        logger.info("[Scheduler] Scheduler detenido")
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True, name="group-scheduler")
+        thread.start()
+        return thread
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["enabled"] = self.enabled
+        stats["is_leader"] = self.leader.is_leader
+        stats["next_due_at"] = self.next_due_at.isoformat() if self.next_due_at else None
+        return stats
@@ -1,16 +1,18 @@
 # Configuración de Gunicorn para Render.com
-# Aumenta timeouts y mejora manejo de memoria
+# El scraping corre en el proceso worker (worker.py): el web solo atiende requests,
+# así que usa timeouts cortos y más workers
+import os
 
 # Configuración básica
 bind = "0.0.0.0:10000"
-workers = 2
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
 worker_class = "sync"
 worker_connections = 1000
 
-# Timeouts aumentados para evitar problemas con el scraper
-timeout = 300  # 5 minutos
+# Timeouts (los reportes ya no se generan dentro de un request)
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
 keepalive = 5
-graceful_timeout = 300
+graceful_timeout = 30
 worker_tmp_dir = "/dev/shm"
 
 # Configuración de memoria
@@ -46,4 +48,12 @@ secure_scheme_headers = {
     'X-FORWARDED-PROTOCOL': 'ssl',
     'X-FORWARDED-PROTO': 'https',
     'X-FORWARDED-SSL': 'on'
-} 
\ No newline at end of file
+}
+
+
+def post_fork(server, worker):
+    # Despliegues de un solo proceso: el procesador de la cola corre en cada worker web (nunca en
+    # el master, donde con preload_app el thread no sobreviviría al fork)
+    if os.environ.get("SCRAPER_EMBEDDED_WORKER", "false").lower() == "true":
+        from app import start_embedded_worker
+        start_embedded_worker()
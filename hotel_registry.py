@@ -0,0 +1,217 @@
+"""
+Registro canónico de hoteles de Booking.
+
+Los usuarios pegan la misma URL de distintas formas: con query strings (selected_currency,
+aid, checkin...), con sufijo de idioma (`.es.html` vs `.html`), con o sin `www`. Este módulo
+reduce cada URL a una clave estable del hotel (`booking:{país}/{slug}`) para que:
+
+- scrape_booking_data scrapee una sola vez cada hotel aunque aparezca repetido en el set,
+- el cache de cotizaciones comparta entradas entre grupos que usan variantes de la misma URL,
+- el nombre y la metadata (rating, reviews) de cada hotel se guarden una sola vez.
+
+Dos niveles, igual que quote_cache: memoria por proceso y, opcionalmente, Firestore
+(colección HOTEL_REGISTRY_COLLECTION, un documento por hotel).
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+HOTEL_REGISTRY_COLLECTION = os.environ.get("HOTEL_REGISTRY_COLLECTION", "hotels")
+
+# /hotel/{país}/{slug}[.{idioma}].html
+_BOOKING_HOTEL_PATH = re.compile(r"^/hotel/([a-z]{2})/([^/.]+)(?:\.[a-z]{2}(?:-[a-z]{2,4})?)?\.html?$")
+
+
+def hotel_key(url):
+    """
+    Devuelve la clave canónica del hotel para una URL.
+    Las URLs de Booking se reducen a `booking:{país}/{slug}`; el resto a host + path en minúsculas.
+    """
+    parsed = urlparse((url or "").strip())
+    path = parsed.path.lower().rstrip("/")
+    match = _BOOKING_HOTEL_PATH.match(path)
+    if match and "booking." in parsed.netloc.lower():
+        return f"booking:{match.group(1)}/{match.group(2)}"
+    netloc = parsed.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return f"{netloc}{path}"
+
+
+def canonical_url(url):
+    """URL canónica del hotel (sin idioma ni query), o la URL original si no es de Booking."""
+    key = hotel_key(url)
+    if key.startswith("booking:"):
+        return f"https://www.booking.com/hotel/{key[len('booking:'):]}.html"
+    return (url or "").strip()
+
+
+def hotel_name_from_url(url):
+    """
+    Nombre del hotel derivado de la URL, con el formato de siempre (ej. .../hotel/ar/el-pueblito-iguazu.html
+    -> Ar/El Pueblito Iguazu). Los reportes usan el nombre como clave de hotelNames y chartData:
+    cambiar el formato desarma la comparación con los reportes anteriores del grupo.
+    """
+    hotel_id = (url or "").strip().split("/hotel/")[-1].split(".")[0]
+    return hotel_id.replace("-", " ").title() or None
+
+
+class FirestoreHotelStore:
+    """Nivel persistente del registro: un documento por hotel con nombre, alias y metadata."""
+
+    def __init__(self, db, collection=HOTEL_REGISTRY_COLLECTION):
+        self.db = db
+        self.collection = collection
+
+    def _doc_id(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        doc = self.db.collection(self.collection).document(self._doc_id(key)).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set(self, key, record):
+        from firebase_admin import firestore
+        self.db.collection(self.collection).document(self._doc_id(key)).set({
+            "key": key,
+            "canonicalUrl": record["canonical_url"],
+            "name": record["name"],
+            "aliases": firestore.ArrayUnion(sorted(record["aliases"])),
+            "rating": record.get("rating"),
+            "reviews": record.get("reviews"),
+            "updatedAt": datetime.now(),
+        }, merge=True)
+
+
+class HotelRegistry:
+    """Registro de hoteles canónicos con nivel en memoria y nivel persistente opcional."""
+
+    def __init__(self, persistent_store=None):
+        self.persistent_store = persistent_store
+        self._hotels = {}  # clave -> registro
+        self._lock = threading.Lock()
+        self.stats = {"registered": 0, "duplicates": 0, "persistent_hits": 0, "persistent_errors": 0}
+
+    def _load(self, key, url):
+        """
+        Crea el registro de una clave nueva, recuperándolo del nivel persistente si existe.
+        Lee Firestore: llamar sin self._lock tomado. Devuelve (registro, resultado de la lectura).
+        """
+        record = {
+            "key": key,
+            "canonical_url": canonical_url(url),
+            # El nombre siempre se deriva de la URL: los guardados por versiones anteriores
+            # (sin el prefijo del país) no se usan
+            "name": hotel_name_from_url(url),
+            "aliases": set(),
+            "rating": None,
+            "reviews": None,
+        }
+        outcome = None
+        if self.persistent_store is not None:
+            try:
+                stored = self.persistent_store.get(key)
+            except Exception as e:
+                logger.warning(f"[HotelRegistry] Error leyendo nivel persistente: {e}")
+                stored = None
+                outcome = "persistent_errors"
+            if stored:
+                record["aliases"].update(stored.get("aliases") or [])
+                record["rating"] = stored.get("rating")
+                record["reviews"] = stored.get("reviews")
+                outcome = "persistent_hits"
+        return record, outcome
+
+    def _persist(self, record):
+        if self.persistent_store is None:
+            return
+        try:
+            self.persistent_store.set(record["key"], record)
+        except Exception as e:
+            logger.warning(f"[HotelRegistry] Error escribiendo nivel persistente: {e}")
+            with self._lock:
+                self.stats["persistent_errors"] += 1
+
+    def register(self, url):
+        """Registra una URL (si hace falta) y devuelve una copia del registro de su hotel."""
+        key = hotel_key(url)
+        alias = (url or "").strip()
+        with self._lock:
+            known = key in self._hotels
+        # La lectura de Firestore va fuera del lock (lo comparten todos los reportes en curso)
+        loaded, outcome = self._load(key, url) if not known else (None, None)
+        with self._lock:
+            if outcome:
+                self.stats[outcome] += 1
+            record = self._hotels.get(key)
+            if record is None:
+                # Si otro reporte lo cargó mientras tanto, gana el primero
+                record = self._hotels[key] = loaded
+                self.stats["registered"] += 1
+            is_new_alias = alias not in record["aliases"]
+            record["aliases"].add(alias)
+            snapshot = dict(record, aliases=set(record["aliases"]))
+        if is_new_alias:
+            self._persist(snapshot)
+        return snapshot
+
+    def resolve(self, urls):
+        """
+        Deduplica una lista de URLs por hotel canónico, conservando el orden (el hotel principal
+        primero). Devuelve la lista de (url representativa, registro), usando como representativa
+        la primera URL con la que apareció cada hotel en la lista.
+        """
+        unique = {}
+        for url in urls:
+            record = self.register(url)
+            if record["key"] in unique:
+                logger.info(f"[HotelRegistry] URL duplicada del hotel {record['key']}: {url}")
+                with self._lock:
+                    self.stats["duplicates"] += 1
+                continue
+            unique[record["key"]] = (url, record)
+        return list(unique.values())
+
+    def get(self, url_or_key):
+        key = url_or_key if url_or_key in self._hotels else hotel_key(url_or_key)
+        with self._lock:
+            record = self._hotels.get(key)
+            return dict(record, aliases=set(record["aliases"])) if record else None
+
+    def update_metadata(self, url, rating=None, reviews=None, name=None):
+        """Guarda rating/reviews (y opcionalmente el nombre) de un hotel si cambiaron."""
+        key = hotel_key(url)
+        with self._lock:
+            record = self._hotels.get(key)
+            if record is None:
+                return
+            changed = False
+            for field, value in (("rating", rating), ("reviews", reviews), ("name", name)):
+                if value is not None and record.get(field) != value:
+                    record[field] = value
+                    changed = True
+            snapshot = dict(record, aliases=set(record["aliases"])) if changed else None
+        if snapshot:
+            self._persist(snapshot)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["hotels"] = len(self._hotels)
+        return stats
+
+
+# Instancia compartida por todos los reportes del proceso
+hotel_registry = HotelRegistry()
+
+
+def configure_persistent_store(db):
+    """Activa el nivel persistente en Firestore para el registro compartido."""
+    hotel_registry.persistent_store = FirestoreHotelStore(db)
+    logger.info(f"[HotelRegistry] Nivel persistente configurado en la colección '{HOTEL_REGISTRY_COLLECTION}'")
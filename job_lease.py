@@ -0,0 +1,185 @@
+"""
+Leases de reportes de la cola para compartirla entre procesos y nodos.
+
+Un worker toma un reporte 'queued' en una transacción de Firestore: solo uno de los procesos que
+leyeron el mismo documento logra pasarlo a 'pending' con su leaseOwner y un leaseExpiresAt. Mientras
+el reporte corre, JobLease renueva el lease cada SCRAPER_HEARTBEAT_SECONDS (también en una
+transacción, verificando que el dueño siga siendo este worker). Si el worker muere, el lease vence
+y reclaim_expired_leases devuelve el reporte a la cola.
+
+Requiere un índice compuesto en scraping_reports (status, leaseExpiresAt).
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_HEARTBEAT_SECONDS = float(os.environ.get("SCRAPER_HEARTBEAT_SECONDS", "30"))
+SCRAPER_JOB_LEASE_SECONDS = float(os.environ.get("SCRAPER_JOB_LEASE_SECONDS", "180"))
+
+# Identifica a este proceso como dueño de los leases (único por host, proceso y arranque)
+WORKER_ID = os.environ.get("SCRAPER_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def lease_expired(lease_expires_at):
+    """Los datetimes se guardan sin zona (datetime.now()) y Firestore los devuelve en UTC con tzinfo."""
+    if lease_expires_at is None:
+        return False
+    return lease_expires_at.replace(tzinfo=None) < datetime.now()
+
+
+def claim_job(db, doc_ref, worker_id=WORKER_ID, lease_seconds=SCRAPER_JOB_LEASE_SECONDS):
+    """Pasa el reporte de 'queued' a 'pending' a nombre de este worker. False si otro lo tomó antes."""
+
+    @firestore.transactional
+    def claim(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        if data.get("status") != "queued":
+            return False
+        now = datetime.now()
+        update = {
+            "status": "pending",
+            "leaseOwner": worker_id,
+            "leaseExpiresAt": now + timedelta(seconds=lease_seconds),
+            "claimedAt": now,
+            "heartbeatAt": now,
+        }
+        # Espera desde la última vez que entró a la cola (para la espera promedio de system_status)
+        entered_at = data.get("requeuedAt") or data.get("queuedAt") or data.get("createdAt")
+        if entered_at is not None:
+            update["queueWaitSeconds"] = max(0.0, (now - entered_at.replace(tzinfo=None)).total_seconds())
+        transaction.update(doc_ref, update)
+        return True
+
+    return claim(db.transaction())
+
+
+def reclaim_expired_leases(db, max_resumes, collection="scraping_reports"):
+    """
+    Devuelve a la cola los reportes 'pending' cuyo lease venció (el worker que los procesaba murió
+    o perdió la conexión). Un reporte que ya se reanudó max_resumes veces se marca como fallido.
+    Devuelve (reencolados, fallidos).
+    """
+
+    @firestore.transactional
+    def reclaim(transaction, doc_ref):
+        snapshot = doc_ref.get(transaction=transaction)
+        data = snapshot.to_dict() or {}
+        # Otro worker pudo renovarlo o reclamarlo entre la consulta y la transacción
+        if data.get("status") != "pending" or not lease_expired(data.get("leaseExpiresAt")):
+            return None
+        if data.get("resumeCount", 0) >= max_resumes:
+            transaction.update(doc_ref, {
+                "status": "failed",
+                "error": f"El reporte se interrumpió {max_resumes + 1} veces sin completarse",
+            })
+            return "failed"
+        transaction.update(doc_ref, {
+            "status": "queued",
+            "requeuedAt": datetime.now(),
+            "previousLeaseOwner": data.get("leaseOwner"),
+            "leaseOwner": None,
+            "leaseExpiresAt": None,
+            "resumeCount": firestore.Increment(1),
+        })
+        return "queued"
+
+    query = (
+        db.collection(collection)
+        .where("status", "==", "pending")
+        .where("leaseExpiresAt", "<", datetime.now())
+    )
+    requeued = failed = 0
+    for doc in query.stream():
+        result = reclaim(db.transaction(), doc.reference)
+        if result == "queued":
+            requeued += 1
+            logger.warning(f"[JobLease] Reporte {doc.id} devuelto a la cola (lease vencido)")
+        elif result == "failed":
+            failed += 1
+            logger.error(f"[JobLease] Reporte {doc.id} marcado como fallido (demasiados reintentos)")
+    return requeued, failed
+
+
+class JobLease:
+    """Renueva en segundo plano el lease de un reporte tomado por este worker."""
+
+    def __init__(self, db, doc_ref, worker_id=WORKER_ID, lease_seconds=SCRAPER_JOB_LEASE_SECONDS,
+                 heartbeat_seconds=SCRAPER_HEARTBEAT_SECONDS):
+        self.db = db
+        self.doc_ref = doc_ref
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.lost = False
+        self.renewals = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stopped.wait(self.heartbeat_seconds):
+            try:
+                if not self.renew():
+                    self.lost = True
+                    logger.error(f"[JobLease] Se perdió el lease del reporte {self.doc_ref.id}: otro worker lo tomó")
+                    return
+            except Exception as e:
+                # Un error puntual no pierde el lease: hay margen hasta leaseExpiresAt
+                logger.warning(f"[JobLease] Error renovando el lease de {self.doc_ref.id}: {e}")
+
+    def _owns(self, snapshot):
+        data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        return data.get("leaseOwner") == self.worker_id and data.get("status") == "pending"
+
+    def renew(self):
+        """Extiende leaseExpiresAt si este worker sigue siendo el dueño. Devuelve False si no."""
+
+        @firestore.transactional
+        def renew(transaction):
+            if not self._owns(self.doc_ref.get(transaction=transaction)):
+                return False
+            now = datetime.now()
+            transaction.update(self.doc_ref, {
+                "leaseExpiresAt": now + timedelta(seconds=self.lease_seconds),
+                "heartbeatAt": now,
+            })
+            return True
+
+        renewed = renew(self.db.transaction())
+        if renewed:
+            self.renewals += 1
+        return renewed
+
+    def commit(self, data, merge=False):
+        """
+        Escribe el resultado del reporte solo si este worker sigue siendo el dueño del lease
+        (si otro lo tomó, su resultado es el que vale). Devuelve False si el lease se perdió.
+        """
+
+        @firestore.transactional
+        def commit(transaction):
+            if not self._owns(self.doc_ref.get(transaction=transaction)):
+                return False
+            transaction.set(self.doc_ref, data, merge=merge)
+            return True
+
+        committed = commit(self.db.transaction())
+        if not committed:
+            self.lost = True
+            logger.error(f"[JobLease] El reporte {self.doc_ref.id} ya no pertenece a este worker: no se guarda el resultado")
+        return committed
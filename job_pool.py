@@ -0,0 +1,409 @@
+"""
+Pool de workers para la cola de reportes (scraping_reports con status 'queued').
+
+El worker procesa hasta SCRAPER_WORKER_SLOTS reportes en paralelo. Los reportes se separan en
+carriles de prioridad (PRIORITY_LANES): primero los interactivos (pedidos desde la UI), después los
+programados (execute_scheduled_tasks) y al final los backfills. Un carril de menor prioridad con
+reportes esperando recibe igual al menos su parte mínima (SCRAPER_LANE_MIN_SHARES) del costo
+despachado en los últimos SCRAPER_LANE_WINDOW reportes, así el trabajo batch nunca queda sin turno.
+
+Dentro de cada carril los slots se asignan con weighted fair queuing en dos niveles:
+
+- Entre planes, según el peso de cada plan (queue_weight en PLAN_LIMITS).
+- Dentro de cada plan, entre usuarios en partes iguales, con como mucho
+  SCRAPER_MAX_JOBS_PER_USER reportes en curso por usuario.
+
+Cada reporte cuesta su cantidad estimada de hotel-noches, así un usuario con muchos grupos
+grandes avanza su tiempo virtual más rápido y no deja sin turno al resto. Las ejecuciones del
+actor de todos los reportes en curso comparten el presupuesto global de rate_limiter.actor_run_budget.
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_WORKER_SLOTS = int(os.environ.get("SCRAPER_WORKER_SLOTS", "3"))
+SCRAPER_MAX_JOBS_PER_USER = int(os.environ.get("SCRAPER_MAX_JOBS_PER_USER", "1"))
+# Parte mínima del costo despachado por carril, como "carril:parte,..." (el primer carril no la necesita)
+SCRAPER_LANE_MIN_SHARES = os.environ.get("SCRAPER_LANE_MIN_SHARES", "scheduled:0.2,backfill:0.05")
+SCRAPER_LANE_WINDOW = int(os.environ.get("SCRAPER_LANE_WINDOW", "20"))
+# Segundos por hotel-noche para estimar el ETA hasta que terminen los primeros reportes
+SCRAPER_ETA_SECONDS_PER_COST = float(os.environ.get("SCRAPER_ETA_SECONDS_PER_COST", "5"))
+
+# Carriles de prioridad, de mayor a menor
+PRIORITY_LANES = ("interactive", "scheduled", "backfill")
+
+
+def parse_lane_shares(value):
+    """Convierte "scheduled:0.2,backfill:0.05" en {"scheduled": 0.2, "backfill": 0.05}."""
+    shares = {}
+    for item in (value or "").split(","):
+        lane, _, share = item.partition(":")
+        lane = lane.strip()
+        if lane not in PRIORITY_LANES:
+            continue
+        try:
+            shares[lane] = min(1.0, max(0.0, float(share)))
+        except ValueError:
+            logger.warning(f"[WorkerPool] Parte mínima inválida para el carril {lane}: {share!r}")
+    return shares
+
+
+def job_lane(data):
+    """
+    Carril de un reporte: el campo "priority" si es uno de PRIORITY_LANES; si no, "backfill" para
+    los reportes con backfill, "scheduled" para los de execute_scheduled_tasks e "interactive" para el resto.
+    """
+    priority = data.get("priority")
+    if priority in PRIORITY_LANES:
+        return priority
+    if data.get("backfill"):
+        return "backfill"
+    if data.get("scheduled_task"):
+        return "scheduled"
+    return "interactive"
+
+
+class FairJobQueue:
+    """
+    Cola de reportes con carriles de prioridad y, dentro de cada carril, weighted fair queuing
+    por plan y por usuario (start-time fair queuing).
+
+    Los trabajos son dicts con al menos "id", "userId", "plan" y "cost" ("lane" opcional, por
+    defecto el primer carril). Un plan o usuario que vuelve a tener trabajos encolados arranca en
+    el tiempo virtual actual, así no acumula crédito mientras estuvo inactivo.
+    """
+
+    def __init__(self, plan_weights=None, max_running_per_user=SCRAPER_MAX_JOBS_PER_USER,
+                 lane_min_shares=None, lane_window=SCRAPER_LANE_WINDOW):
+        self.plan_weights = plan_weights or {}
+        self.max_running_per_user = max_running_per_user
+        self.lane_min_shares = lane_min_shares if lane_min_shares is not None else parse_lane_shares(SCRAPER_LANE_MIN_SHARES)
+        self._pending = {}  # carril -> plan -> usuario -> deque de trabajos
+        self._ids = set()
+        self._plan_vtime = {}
+        self._user_vtime = {}
+        self._plan_clock = 0.0
+        self._user_clock = {}  # plan -> tiempo virtual actual entre sus usuarios
+        self._running_by_user = {}
+        self._recent = deque(maxlen=max(1, lane_window))  # (carril, costo) de los últimos despachados
+        self._dispatched_by_lane = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids)
+
+    def __contains__(self, job_id):
+        with self._lock:
+            return job_id in self._ids
+
+    def _weight(self, plan):
+        return max(0.1, float(self.plan_weights.get(plan, 1)))
+
+    def _lane(self, job):
+        lane = job.get("lane")
+        return lane if lane in PRIORITY_LANES else PRIORITY_LANES[0]
+
+    def _plan_backlogged(self, plan):
+        # Llamar con self._lock tomado
+        return any(queue for plans in self._pending.values() for queue in plans.get(plan, {}).values())
+
+    def _user_backlogged(self, plan, user):
+        # Llamar con self._lock tomado
+        return any(plans.get(plan, {}).get(user) for plans in self._pending.values())
+
+    def _push(self, job):
+        # Llamar con self._lock tomado
+        plan = job.get("plan") or "free_trial"
+        user = job.get("userId") or job["id"]
+        if not self._plan_backlogged(plan):
+            self._plan_vtime[plan] = max(self._plan_vtime.get(plan, 0.0), self._plan_clock)
+        if not self._user_backlogged(plan, user):
+            self._user_vtime[user] = max(self._user_vtime.get(user, 0.0), self._user_clock.get(plan, 0.0))
+        job["_seq"] = next(self._seq)
+        users = self._pending.setdefault(self._lane(job), {}).setdefault(plan, {})
+        users.setdefault(user, deque()).append(job)
+        self._ids.add(job["id"])
+
+    def push(self, job):
+        """Encola un trabajo. Devuelve False si ya estaba encolado."""
+        with self._lock:
+            if job["id"] in self._ids:
+                return False
+            self._push(job)
+            return True
+
+    def sync(self, jobs):
+        """
+        Deja encolados exactamente `jobs` (lo que hoy figura como 'queued' en Firestore): quita los
+        que ya no están y agrega los nuevos. Los que siguen encolados conservan su lugar. Los
+        trabajos con "preclaimed" (ya tomados por este worker, ver scrape_planner) no se quitan.
+        """
+        wanted = {job["id"]: job for job in jobs}
+        with self._lock:
+            for plans in self._pending.values():
+                for users in plans.values():
+                    for user, queue in users.items():
+                        kept = [job for job in queue if job["id"] in wanted or job.get("preclaimed")]
+                        if len(kept) != len(queue):
+                            users[user] = deque(kept)
+            self._ids = {job["id"] for plans in self._pending.values() for users in plans.values()
+                         for queue in users.values() for job in queue}
+            for job in jobs:
+                if job["id"] not in self._ids:
+                    self._push(job)
+
+    def _choose_lane(self, candidates, recent):
+        """
+        Carril a despachar entre los que tienen trabajos disponibles: el de mayor prioridad que
+        esté por debajo de su parte mínima del costo reciente, o si no hay, el de mayor prioridad.
+        """
+        total = sum(cost for _, cost in recent)
+        if total > 0:
+            for lane in PRIORITY_LANES:
+                share = self.lane_min_shares.get(lane, 0.0)
+                if lane in candidates and share > 0:
+                    lane_cost = sum(cost for recent_lane, cost in recent if recent_lane == lane)
+                    if lane_cost < share * total:
+                        return lane
+        return next(lane for lane in PRIORITY_LANES if lane in candidates)
+
+    def _best_by_lane(self, pending, plan_vtime, user_vtime, running_by_user):
+        """Por carril, el (clave, plan, usuario) con menor tiempo virtual que se puede despachar."""
+        best = {}
+        for lane, plans in pending.items():
+            for plan, users in plans.items():
+                for user, queue in users.items():
+                    if not queue or running_by_user.get(user, 0) >= self.max_running_per_user:
+                        continue
+                    key = (plan_vtime[plan], user_vtime[user], queue[0]["_seq"])
+                    if lane not in best or key < best[lane][0]:
+                        best[lane] = (key, plan, user)
+        return best
+
+    def pop(self):
+        """
+        Devuelve el próximo trabajo según la prioridad de los carriles y el tiempo virtual de
+        planes y usuarios, o None.
+        """
+        with self._lock:
+            best = self._best_by_lane(self._pending, self._plan_vtime, self._user_vtime, self._running_by_user)
+            if not best:
+                return None
+            lane = self._choose_lane(best, self._recent)
+            _, plan, user = best[lane]
+            job = self._pending[lane][plan][user].popleft()
+            self._ids.discard(job["id"])
+            cost = max(1.0, float(job.get("cost") or 1))
+            self._plan_clock = self._plan_vtime[plan]
+            self._user_clock[plan] = self._user_vtime[user]
+            self._plan_vtime[plan] += cost / self._weight(plan)
+            self._user_vtime[user] += cost
+            self._running_by_user[user] = self._running_by_user.get(user, 0) + 1
+            self._recent.append((lane, cost))
+            self._dispatched_by_lane[lane] = self._dispatched_by_lane.get(lane, 0) + 1
+            return job
+
+    def ordered(self):
+        """
+        Orden estimado en el que se despacharían los trabajos encolados, simulando pop() sobre una
+        copia del estado. Es aproximado: no modela cuándo terminan los reportes en curso, así que
+        ignora el máximo de reportes en curso por usuario.
+        """
+        with self._lock:
+            pending = {
+                lane: {plan: {user: deque(queue) for user, queue in users.items()} for plan, users in plans.items()}
+                for lane, plans in self._pending.items()
+            }
+            plan_vtime = dict(self._plan_vtime)
+            user_vtime = dict(self._user_vtime)
+            recent = deque(self._recent, maxlen=self._recent.maxlen)
+        order = []
+        while True:
+            best = self._best_by_lane(pending, plan_vtime, user_vtime, {})
+            if not best:
+                return order
+            lane = self._choose_lane(best, recent)
+            _, plan, user = best[lane]
+            job = pending[lane][plan][user].popleft()
+            cost = max(1.0, float(job.get("cost") or 1))
+            plan_vtime[plan] += cost / self._weight(plan)
+            user_vtime[user] += cost
+            recent.append((lane, cost))
+            order.append(job)
+
+    def done(self, job):
+        """Libera el lugar del usuario cuando su reporte termina (o no se pudo reclamar)."""
+        user = job.get("userId") or job["id"]
+        with self._lock:
+            running = self._running_by_user.get(user, 0) - 1
+            if running > 0:
+                self._running_by_user[user] = running
+            else:
+                self._running_by_user.pop(user, None)
+
+    def get_stats(self):
+        with self._lock:
+            queued_by_plan = {}
+            queued_by_lane = {}
+            for lane, plans in self._pending.items():
+                for plan, users in plans.items():
+                    count = sum(len(queue) for queue in users.values())
+                    if count:
+                        queued_by_plan[plan] = queued_by_plan.get(plan, 0) + count
+                        queued_by_lane[lane] = queued_by_lane.get(lane, 0) + count
+            total = sum(cost for _, cost in self._recent)
+            recent_shares = {
+                lane: round(sum(cost for recent_lane, cost in self._recent if recent_lane == lane) / total, 3)
+                for lane in PRIORITY_LANES
+            } if total else {}
+            return {
+                "queued": len(self._ids),
+                "queued_by_plan": queued_by_plan,
+                "queued_by_lane": queued_by_lane,
+                "dispatched_by_lane": dict(self._dispatched_by_lane),
+                "recent_lane_shares": recent_shares,
+                "lane_min_shares": dict(self.lane_min_shares),
+                "running_by_user": dict(self._running_by_user),
+                "plan_weights": dict(self.plan_weights),
+                "max_running_per_user": self.max_running_per_user,
+            }
+
+
+class ScrapeWorkerPool:
+    """Slots de reportes concurrentes alimentados por una FairJobQueue."""
+
+    def __init__(self, run_job, slots=SCRAPER_WORKER_SLOTS, queue=None):
+        self.run_job = run_job
+        self.slots = max(1, slots)
+        self.queue = queue if queue is not None else FairJobQueue()
+        self._executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="scrape-job")
+        self._running = {}  # id -> trabajo
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Event()
+        # Segundos por hotel-noche observados (promedio móvil), para el ETA de los encolados
+        self.seconds_per_cost = SCRAPER_ETA_SECONDS_PER_COST
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+
+    def running_count(self):
+        with self._lock:
+            return len(self._running)
+
+    def free_slots(self):
+        return self.slots - self.running_count()
+
+    def is_running(self, job_id):
+        with self._lock:
+            return job_id in self._running
+
+    def dispatch(self, claim):
+        """
+        Lanza trabajos de la cola mientras haya slots libres. claim(job) debe marcar el reporte
+        como tomado y devolver False si otro worker ya lo tomó. Devuelve cuántos se lanzaron.
+        """
+        launched = 0
+        while self.free_slots() > 0:
+            job = self.queue.pop()
+            if job is None:
+                break
+            try:
+                claimed = claim(job)
+            except Exception as e:
+                logger.error(f"[WorkerPool] Error reclamando el reporte {job['id']}: {e}")
+                claimed = False
+            if not claimed:
+                self.queue.done(job)
+                continue
+            with self._lock:
+                self._running[job["id"]] = dict(job, startedAt=time.time())
+                self.started += 1
+            self._executor.submit(self._run, job)
+            launched += 1
+            logger.info(f"[WorkerPool] Reporte {job['id']} lanzado (carril {job.get('lane')}, usuario {job.get('userId')}, plan {job.get('plan')}, "
+                        f"costo {job.get('cost')}) - {self.running_count()}/{self.slots} slots ocupados")
+        return launched
+
+    def _run(self, job):
+        started = time.time()
+        try:
+            self.run_job(job)
+            cost = max(1.0, float(job.get("cost") or 1))
+            with self._lock:
+                self.completed += 1
+                self.seconds_per_cost = 0.8 * self.seconds_per_cost + 0.2 * (time.time() - started) / cost
+        except Exception as e:
+            logger.error(f"[WorkerPool] Error procesando el reporte {job['id']}: {e}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._running.pop(job["id"], None)
+            self.queue.done(job)
+            self._slot_freed.set()
+
+    def queue_estimates(self):
+        """
+        Posición y ETA estimados de cada reporte encolado, en el orden de FairJobQueue.ordered():
+        [(trabajo, posición desde 1, segundos hasta que empiece)]. Supone que cada reporte tarda
+        su costo por seconds_per_cost y que los slots se liberan en ese orden.
+        """
+        now = time.time()
+        with self._lock:
+            per_cost = self.seconds_per_cost
+            free_at = [
+                max(0.0, max(1.0, float(job.get("cost") or 1)) * per_cost - (now - job["startedAt"]))
+                for job in self._running.values()
+            ]
+        free_at += [0.0] * max(0, self.slots - len(free_at))
+        heapq.heapify(free_at)
+        estimates = []
+        for position, job in enumerate(self.queue.ordered(), start=1):
+            start = heapq.heappop(free_at)
+            estimates.append((job, position, start))
+            heapq.heappush(free_at, start + max(1.0, float(job.get("cost") or 1)) * per_cost)
+        return estimates
+
+    def wake(self):
+        """Despierta al dispatcher (por ejemplo, cuando llega un reporte nuevo a la cola)."""
+        self._slot_freed.set()
+
+    def wait_for_slot(self, timeout):
+        """Espera hasta que termine algún reporte, llegue un aviso (wake) o pasen `timeout` segundos."""
+        freed = self._slot_freed.wait(timeout)
+        self._slot_freed.clear()
+        return freed
+
+    def wait_idle(self, timeout):
+        """Espera a que terminen los reportes en curso. Devuelve False si pasó el timeout antes."""
+        deadline = time.time() + timeout
+        while self.running_count() and time.time() < deadline:
+            self.wait_for_slot(min(1.0, max(0.0, deadline - time.time())))
+        return self.running_count() == 0
+
+    def shutdown(self):
+        """Cancela los lanzamientos pendientes sin esperar a los reportes en curso."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            running = [
+                {"id": job_id, "userId": job.get("userId"), "plan": job.get("plan"), "lane": job.get("lane"), "cost": job.get("cost"),
+                 "runningSeconds": round(now - job["startedAt"], 1)}
+                for job_id, job in self._running.items()
+            ]
+            stats = {"slots": self.slots, "running": running, "started": self.started,
+                     "completed": self.completed, "failed": self.failed,
+                     "seconds_per_cost": round(self.seconds_per_cost, 2)}
+        stats["queue"] = self.queue.get_stats()
+        return stats
@@ -0,0 +1,157 @@
+"""
+Listener de la cola de reportes.
+
+En lugar de consultar scraping_reports cada 20 s, el worker escucha la consulta de reportes
+'queued' con on_snapshot y se despierta apenas aparece uno. El listener guarda la última foto de
+la consulta para que el worker no tenga que volver a leerla.
+
+- Cada SCRAPER_QUEUE_SAFETY_POLL_SECONDS se hace igual una consulta completa (red de seguridad
+  por si se perdió algún evento).
+- Si el stream del listener se corta, se reconecta con backoff exponencial (hasta
+  SCRAPER_QUEUE_LISTENER_MAX_BACKOFF segundos). Mientras está caído, el worker vuelve a consultar
+  cada SCRAPER_QUEUE_FALLBACK_POLL_SECONDS.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_QUEUE_LISTENER_ENABLED = os.environ.get("SCRAPER_QUEUE_LISTENER_ENABLED", "true").lower() == "true"
+SCRAPER_QUEUE_SAFETY_POLL_SECONDS = float(os.environ.get("SCRAPER_QUEUE_SAFETY_POLL_SECONDS", "300"))
+SCRAPER_QUEUE_FALLBACK_POLL_SECONDS = float(os.environ.get("SCRAPER_QUEUE_FALLBACK_POLL_SECONDS", "20"))
+SCRAPER_QUEUE_LISTENER_MAX_BACKOFF = float(os.environ.get("SCRAPER_QUEUE_LISTENER_MAX_BACKOFF", "300"))
+
+
+class QueueListener:
+    """
+    Mantiene un on_snapshot sobre la consulta que devuelve query_factory() y llama a on_change()
+    cuando entra un documento nuevo a la consulta.
+    """
+
+    def __init__(self, query_factory, on_change=None, enabled=SCRAPER_QUEUE_LISTENER_ENABLED,
+                 safety_poll_seconds=SCRAPER_QUEUE_SAFETY_POLL_SECONDS,
+                 fallback_poll_seconds=SCRAPER_QUEUE_FALLBACK_POLL_SECONDS,
+                 max_backoff=SCRAPER_QUEUE_LISTENER_MAX_BACKOFF, name="cola"):
+        self.query_factory = query_factory
+        self.on_change = on_change
+        self.enabled = enabled
+        self.safety_poll_seconds = safety_poll_seconds
+        self.fallback_poll_seconds = fallback_poll_seconds
+        self.max_backoff = max_backoff
+        self.name = name
+        self._watch = None
+        self._docs = None
+        self._snapshot_at = 0.0
+        self._last_poll_at = 0.0
+        self._failures = 0
+        self._next_connect_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"snapshots": 0, "wakeups": 0, "connects": 0, "disconnects": 0, "errors": 0, "polls": 0}
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # Corre en el thread del stream de Firestore
+        added = sum(1 for change in changes if getattr(change.type, "name", "") == "ADDED")
+        with self._lock:
+            self._docs = list(docs)
+            self._snapshot_at = time.time()
+            self._failures = 0
+            self.stats["snapshots"] += 1
+            if added:
+                self.stats["wakeups"] += 1
+        if added and self.on_change is not None:
+            logger.info(f"[QueueListener] {self.name}: {added} documentos nuevos en la cola")
+            self.on_change()
+
+    def _is_active(self):
+        # Llamar con self._lock tomado
+        if self._watch is None:
+            return False
+        active = getattr(self._watch, "is_active", True)
+        return active() if callable(active) else bool(active)
+
+    def ensure_connected(self):
+        """Abre el listener, o lo reabre (con backoff) si el stream se cortó."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._is_active():
+                return
+            if self._watch is not None:
+                self.stats["disconnects"] += 1
+                self._failures += 1
+                self._schedule_reconnect("el stream del listener se cortó")
+                try:
+                    self._watch.unsubscribe()
+                except Exception:
+                    pass
+                self._watch = None
+                self._docs = None
+            if time.time() < self._next_connect_at:
+                return
+            try:
+                self._watch = self.query_factory().on_snapshot(self._on_snapshot)
+                self.stats["connects"] += 1
+                logger.info(f"[QueueListener] {self.name}: listener conectado")
+            except Exception as e:
+                self.stats["errors"] += 1
+                self._failures += 1
+                self._schedule_reconnect(e)
+
+    def _schedule_reconnect(self, reason):
+        # Llamar con self._lock tomado
+        delay = min(self.max_backoff, 2 ** min(self._failures, 16)) * random.uniform(0.5, 1.0)
+        self._next_connect_at = time.time() + delay
+        logger.warning(f"[QueueListener] {self.name}: {reason}. Reconectando en {delay:.0f}s")
+
+    def latest_docs(self):
+        """
+        Documentos de la última foto del listener, o None si hay que consultar (listener caído,
+        sin foto todavía o vencida la red de seguridad).
+        """
+        with self._lock:
+            if not self._is_active() or self._docs is None:
+                return None
+            if time.time() - self._last_poll_at >= self.safety_poll_seconds:
+                return None
+            return list(self._docs)
+
+    def snapshot_count(self):
+        """Fotos recibidas desde que arrancó (cambia cuando cambia la consulta)."""
+        with self._lock:
+            return self.stats["snapshots"]
+
+    def mark_polled(self):
+        with self._lock:
+            self._last_poll_at = time.time()
+            self.stats["polls"] += 1
+
+    def next_wait(self):
+        """Segundos que el worker puede dormir antes de volver a mirar la cola."""
+        with self._lock:
+            now = time.time()
+            if not self._is_active():
+                wait = self.fallback_poll_seconds
+                if self.enabled:
+                    wait = min(wait, max(1.0, self._next_connect_at - now))
+                return wait
+            return max(1.0, self._last_poll_at + self.safety_poll_seconds - now)
+
+    def close(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["enabled"] = self.enabled
+            stats["active"] = self._is_active()
+            stats["queued_in_snapshot"] = len(self._docs) if self._docs is not None else None
+            stats["last_snapshot_at"] = datetime.fromtimestamp(self._snapshot_at).isoformat() if self._snapshot_at else None
+            stats["reconnect_in_seconds"] = round(max(0.0, self._next_connect_at - time.time()), 1) if not self._is_active() else 0.0
+        return stats
@@ -0,0 +1,240 @@
+"""
+Cache compartido de cotizaciones de Booking.
+
+Clave: (hotel canónico, checkIn, noches, moneda). Se guarda el precio tal como lo devuelve el
+actor (total de la estadía), junto con rating y reviews del hotel.
+
+Dos niveles:
+- Memoria: LRU acotado por QUOTE_CACHE_MAX_ENTRIES, por proceso.
+- Persistente: opcional (Firestore, ver FirestoreQuoteStore), compartido entre workers y reportes.
+
+La frescura depende de qué tan cerca está la noche: las noches dentro de
+QUOTE_CACHE_NEAR_DAYS días valen QUOTE_CACHE_TTL_NEAR_HOURS horas, el resto
+QUOTE_CACHE_TTL_FAR_HOURS horas.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from hotel_registry import hotel_key
+
+logger = logging.getLogger(__name__)
+
+QUOTE_CACHE_ENABLED = os.environ.get("QUOTE_CACHE_ENABLED", "true").lower() == "true"
+QUOTE_CACHE_MAX_ENTRIES = int(os.environ.get("QUOTE_CACHE_MAX_ENTRIES", "20000"))
+QUOTE_CACHE_NEAR_DAYS = int(os.environ.get("QUOTE_CACHE_NEAR_DAYS", "14"))
+QUOTE_CACHE_TTL_NEAR_HOURS = float(os.environ.get("QUOTE_CACHE_TTL_NEAR_HOURS", "6"))
+QUOTE_CACHE_TTL_FAR_HOURS = float(os.environ.get("QUOTE_CACHE_TTL_FAR_HOURS", "24"))
+QUOTE_CACHE_COLLECTION = os.environ.get("QUOTE_CACHE_COLLECTION", "quote_cache")
+
+
+def normalize_hotel_url(url):
+    """Normaliza la URL del hotel para la clave del cache (clave canónica del hotel, ver hotel_registry)."""
+    return hotel_key(url)
+
+
+def make_key(hotel_url, checkin, nights, currency):
+    return (normalize_hotel_url(hotel_url), checkin, int(nights), (currency or "").upper())
+
+
+def ttl_seconds_for(checkin, now=None):
+    """Devuelve la frescura (en segundos) de una cotización según la distancia a la noche."""
+    now = now or datetime.now()
+    try:
+        days_ahead = (datetime.strptime(checkin, "%Y-%m-%d").date() - now.date()).days
+    except (ValueError, TypeError):
+        days_ahead = 0
+    hours = QUOTE_CACHE_TTL_NEAR_HOURS if days_ahead <= QUOTE_CACHE_NEAR_DAYS else QUOTE_CACHE_TTL_FAR_HOURS
+    return hours * 3600
+
+
+class FirestoreQuoteStore:
+    """
+    Nivel persistente sobre una colección de Firestore (un documento por cotización).
+
+    Cada documento incluye `expiresAt`, que puede usarse como campo de una política TTL de
+    Firestore para que las cotizaciones viejas se borren solas.
+    """
+
+    def __init__(self, db, collection=QUOTE_CACHE_COLLECTION):
+        self.db = db
+        self.collection = collection
+
+    def _doc_id(self, key):
+        return hashlib.sha1("|".join(str(part) for part in key).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        doc = self.db.collection(self.collection).document(self._doc_id(key)).get()
+        if not doc.exists:
+            return None
+        return doc.to_dict()
+
+    def set(self, key, entry):
+        hotel_url, checkin, nights, currency = key
+        self.db.collection(self.collection).document(self._doc_id(key)).set({
+            **entry,
+            "hotelUrl": hotel_url,
+            "checkIn": checkin,
+            "nights": nights,
+            "currency": currency,
+            "expiresAt": datetime.fromtimestamp(entry["fetched_at"] + ttl_seconds_for(checkin)),
+        })
+
+    def delete(self, key):
+        self.db.collection(self.collection).document(self._doc_id(key)).delete()
+
+    def delete_hotel(self, hotel_url):
+        query = self.db.collection(self.collection).where("hotelUrl", "==", normalize_hotel_url(hotel_url))
+        deleted = 0
+        for doc in query.stream():
+            doc.reference.delete()
+            deleted += 1
+        return deleted
+
+
+class QuoteCache:
+    """Cache de cotizaciones con nivel en memoria (LRU) y nivel persistente opcional."""
+
+    def __init__(self, max_entries=QUOTE_CACHE_MAX_ENTRIES, persistent_store=None):
+        self.max_entries = max_entries
+        self.persistent_store = persistent_store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "persistent_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expired": 0,
+            "persistent_errors": 0,
+        }
+
+    def _is_fresh(self, key, entry, now):
+        return now - entry["fetched_at"] <= ttl_seconds_for(key[1])
+
+    def _remember(self, key, entry):
+        # Llamar con self._lock tomado
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, hotel_url, checkin, nights, currency):
+        """Devuelve (price, rating, reviews) si hay una cotización fresca, o None."""
+        key = make_key(hotel_url, checkin, nights, currency)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_fresh(key, entry, now):
+                    self._entries.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry["price"], entry.get("rating"), entry.get("reviews")
+                del self._entries[key]
+                self.stats["expired"] += 1
+
+        if self.persistent_store is not None:
+            try:
+                entry = self.persistent_store.get(key)
+            except Exception as e:
+                logger.warning(f"[QuoteCache] Error leyendo nivel persistente: {e}")
+                entry = None
+                with self._lock:
+                    self.stats["persistent_errors"] += 1
+            if entry is not None and entry.get("price") is not None and self._is_fresh(key, entry, now):
+                with self._lock:
+                    self._remember(key, {k: entry.get(k) for k in ("price", "rating", "reviews", "fetched_at")})
+                    self.stats["persistent_hits"] += 1
+                return entry["price"], entry.get("rating"), entry.get("reviews")
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def peek(self, hotel_url, checkin, nights, currency):
+        """Como get pero solo en memoria, sin contar en las estadísticas ni mover el LRU."""
+        key = make_key(hotel_url, checkin, nights, currency)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not self._is_fresh(key, entry, time.time()):
+                return None
+            return entry["price"], entry.get("rating"), entry.get("reviews")
+
+    def set(self, hotel_url, checkin, nights, currency, price, rating=None, reviews=None):
+        """Guarda una cotización. Los precios vacíos no se cachean."""
+        if price is None:
+            return
+        key = make_key(hotel_url, checkin, nights, currency)
+        entry = {"price": price, "rating": rating, "reviews": reviews, "fetched_at": time.time()}
+        with self._lock:
+            self._remember(key, entry)
+            self.stats["stores"] += 1
+        if self.persistent_store is not None:
+            try:
+                self.persistent_store.set(key, entry)
+            except Exception as e:
+                logger.warning(f"[QuoteCache] Error escribiendo nivel persistente: {e}")
+                with self._lock:
+                    self.stats["persistent_errors"] += 1
+
+    def evict(self, hotel_url, checkin=None, nights=None, currency=None):
+        """
+        Elimina cotizaciones de un hotel. Si se indican checkin, nights y currency elimina solo esa
+        cotización; si no, todas las del hotel. Devuelve la cantidad eliminada en memoria.
+        """
+        if checkin is not None and nights is not None and currency is not None:
+            key = make_key(hotel_url, checkin, nights, currency)
+            with self._lock:
+                removed = 1 if self._entries.pop(key, None) is not None else 0
+            if self.persistent_store is not None:
+                self.persistent_store.delete(key)
+            return removed
+
+        hotel_key = normalize_hotel_url(hotel_url)
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == hotel_key]
+            for key in keys:
+                del self._entries[key]
+        if self.persistent_store is not None:
+            self.persistent_store.delete_hotel(hotel_url)
+        return len(keys)
+
+    def evict_expired(self):
+        """Elimina de memoria las cotizaciones vencidas. Devuelve la cantidad eliminada."""
+        now = time.time()
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if not self._is_fresh(key, entry, now)]
+            for key in keys:
+                del self._entries[key]
+            self.stats["expired"] += len(keys)
+        return len(keys)
+
+    def clear(self):
+        """Vacía el nivel en memoria (el persistente expira por TTL)."""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        hits = stats["memory_hits"] + stats["persistent_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# Instancia compartida por todos los reportes del proceso
+quote_cache = QuoteCache()
+
+
+def configure_persistent_store(db):
+    """Activa el nivel persistente en Firestore para el cache compartido."""
+    quote_cache.persistent_store = FirestoreQuoteStore(db)
+    logger.info(f"[QuoteCache] Nivel persistente configurado en la colección '{QUOTE_CACHE_COLLECTION}'")
@@ -0,0 +1,281 @@
+"""
+Token bucket para limitar el arranque de ejecuciones del actor de Apify.
+
+El estado del bucket (tokens disponibles y última recarga) vive en un archivo local protegido
+con flock, así que el límite se comparte entre threads, el motor asyncio y todos los workers
+de gunicorn del mismo host. Por defecto el archivo va a /dev/shm (memoria compartida).
+
+Configuración:
+    SCRAPER_RATE_LIMIT_PER_SEC: ejecuciones por segundo sostenidas (0 desactiva el límite)
+    SCRAPER_RATE_LIMIT_BURST: tamaño máximo de ráfaga
+    SCRAPER_RATE_LIMIT_FILE: ruta del archivo de estado
+
+También define el presupuesto global de ejecuciones en vuelo del proceso (ActorRunBudget), que
+reparten los reportes que se procesan en paralelo:
+    SCRAPER_ACTOR_RUN_BUDGET: máximo de ejecuciones del actor en vuelo entre todos los reportes (0 sin límite)
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: el límite queda compartido solo entre threads del proceso
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_RATE_LIMIT_PER_SEC = float(os.environ.get("SCRAPER_RATE_LIMIT_PER_SEC", "5"))
+SCRAPER_RATE_LIMIT_BURST = float(os.environ.get("SCRAPER_RATE_LIMIT_BURST", "20"))
+_default_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SCRAPER_RATE_LIMIT_FILE = os.environ.get(
+    "SCRAPER_RATE_LIMIT_FILE", os.path.join(_default_dir, "competitor_eye_apify_bucket.json")
+)
+SCRAPER_ACTOR_RUN_BUDGET = int(os.environ.get("SCRAPER_ACTOR_RUN_BUDGET", "60"))
+
+
+class TokenBucket:
+    """Token bucket con estado en archivo, seguro entre threads y procesos."""
+
+    def __init__(self, rate=SCRAPER_RATE_LIMIT_PER_SEC, burst=SCRAPER_RATE_LIMIT_BURST, path=SCRAPER_RATE_LIMIT_FILE):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self.waits = 0
+        self.waited_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _read_state(self, f):
+        f.seek(0)
+        raw = f.read()
+        try:
+            state = json.loads(raw) if raw else {}
+        except ValueError:
+            state = {}
+        return float(state.get("tokens", self.burst)), float(state.get("updated_at", time.time()))
+
+    def _write_state(self, f, tokens, updated_at):
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps({"tokens": tokens, "updated_at": updated_at}))
+        f.flush()
+
+    def try_acquire(self):
+        """
+        Intenta consumir un token. Devuelve 0 si lo consiguió, o los segundos a esperar antes de
+        volver a intentar.
+        """
+        if not self.enabled:
+            return 0.0
+        with self._thread_lock:
+            with open(self.path, "a+") as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    tokens, updated_at = self._read_state(f)
+                    now = time.time()
+                    tokens = min(self.burst, tokens + max(0.0, now - updated_at) * self.rate)
+                    if tokens >= 1:
+                        self._write_state(f, tokens - 1, now)
+                        return 0.0
+                    self._write_state(f, tokens, now)
+                    return (1 - tokens) / self.rate
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self):
+        """Bloquea el thread hasta obtener un token."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            self._record_wait(wait)
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Espera (sin bloquear el event loop) hasta obtener un token."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            self._record_wait(wait)
+            await asyncio.sleep(wait)
+
+    def _record_wait(self, wait):
+        with self._thread_lock:
+            self.waits += 1
+            self.waited_seconds += wait
+
+    def get_stats(self):
+        return {
+            "rate_per_sec": self.rate,
+            "burst": self.burst,
+            "waits": self.waits,
+            "waited_seconds": round(self.waited_seconds, 2),
+        }
+
+
+# Bucket compartido para todos los arranques del actor
+actor_run_bucket = TokenBucket()
+
+
+class ActorRunBudget:
+    """
+    Presupuesto de ejecuciones del actor en vuelo compartido por los reportes del proceso.
+
+    Cada reporte en curso se registra y obtiene una parte justa del presupuesto (limit / reportes
+    activos). Un reporte puede pasar su parte solo si ningún otro está esperando lugar, así el
+    presupuesto no queda ocioso cuando hay un único reporte corriendo.
+    """
+
+    def __init__(self, limit=SCRAPER_ACTOR_RUN_BUDGET):
+        self.limit = limit
+        self._held = {}  # reporte -> ejecuciones en vuelo
+        self._waiting = {}  # reporte -> tareas esperando lugar
+        self._condition = threading.Condition()
+        self.acquired = 0
+        self.waits = 0
+        self.peak_in_flight = 0
+
+    @property
+    def enabled(self):
+        return self.limit > 0
+
+    def register(self, job_id):
+        with self._condition:
+            self._held.setdefault(job_id, 0)
+            self._waiting.setdefault(job_id, 0)
+
+    def unregister(self, job_id):
+        with self._condition:
+            self._held.pop(job_id, None)
+            self._waiting.pop(job_id, None)
+            self._condition.notify_all()
+
+    def fair_share(self):
+        with self._condition:
+            return self._fair_share()
+
+    def _fair_share(self):
+        # Llamar con self._condition tomado
+        return max(1, math.ceil(self.limit / max(1, len(self._held))))
+
+    def _try_acquire(self, job_id):
+        # Llamar con self._condition tomado
+        in_flight = sum(self._held.values())
+        if in_flight >= self.limit:
+            return False
+        held = self._held.get(job_id, 0)
+        others_waiting = any(count > 0 for other, count in self._waiting.items() if other != job_id)
+        if held >= self._fair_share() and others_waiting:
+            return False
+        self._held[job_id] = held + 1
+        self.acquired += 1
+        self.peak_in_flight = max(self.peak_in_flight, in_flight + 1)
+        return True
+
+    def _set_waiting(self, job_id, delta):
+        with self._condition:
+            self._waiting[job_id] = max(0, self._waiting.get(job_id, 0) + delta)
+            if delta > 0:
+                self.waits += 1
+
+    def try_acquire(self, job_id):
+        if not self.enabled:
+            return True
+        with self._condition:
+            return self._try_acquire(job_id)
+
+    def acquire(self, job_id, deadline=None):
+        """Bloquea hasta obtener lugar. Devuelve False si antes vence el deadline (time.time())."""
+        if not self.enabled:
+            return True
+        with self._condition:
+            if self._try_acquire(job_id):
+                return True
+        self._set_waiting(job_id, 1)
+        try:
+            with self._condition:
+                while not self._try_acquire(job_id):
+                    if deadline is not None and time.time() >= deadline:
+                        return False
+                    self._condition.wait(timeout=0.5)
+                return True
+        finally:
+            self._set_waiting(job_id, -1)
+
+    async def acquire_async(self, job_id, deadline=None):
+        """Versión async de acquire (sin bloquear el event loop de cada reporte)."""
+        if not self.enabled or self.try_acquire(job_id):
+            return True
+        self._set_waiting(job_id, 1)
+        try:
+            while not self.try_acquire(job_id):
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                await asyncio.sleep(0.1)
+            return True
+        finally:
+            self._set_waiting(job_id, -1)
+
+    def release(self, job_id):
+        if not self.enabled:
+            return
+        with self._condition:
+            if self._held.get(job_id, 0) > 0:
+                self._held[job_id] -= 1
+            self._condition.notify_all()
+
+    def lease(self, job_id):
+        """Registra un reporte y devuelve el objeto que usan los motores para pedir lugar."""
+        self.register(job_id)
+        return BudgetLease(self, job_id)
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "in_flight": sum(self._held.values()),
+                "jobs": len(self._held),
+                "fair_share": self._fair_share() if self.enabled else None,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "peak_in_flight": self.peak_in_flight,
+            }
+
+
+class BudgetLease:
+    """Parte del presupuesto global de un reporte (ver ActorRunBudget.lease)."""
+
+    def __init__(self, budget, job_id):
+        self.budget = budget
+        self.job_id = job_id
+
+    def acquire(self, deadline=None):
+        return self.budget.acquire(self.job_id, deadline)
+
+    async def acquire_async(self, deadline=None):
+        return await self.budget.acquire_async(self.job_id, deadline)
+
+    def try_acquire(self):
+        return self.budget.try_acquire(self.job_id)
+
+    def release(self):
+        self.budget.release(self.job_id)
+
+    def close(self):
+        self.budget.unregister(self.job_id)
+
+
+# Presupuesto de ejecuciones en vuelo compartido por todos los reportes del proceso
+actor_run_budget = ActorRunBudget()
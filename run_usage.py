@@ -0,0 +1,77 @@
+"""
+Contabilidad de consumo de Apify por reporte.
+
+Los motores del scraper registran en un RunUsage cada ejecución del actor que lanzan (incluidas
+las especulativas y las abortadas), los reintentos y lo leído de cada dataset. Los compute units,
+el costo en USD y la duración salen del objeto de la ejecución que devuelve la API de Apify
+(`stats.computeUnits`, `usageTotalUsd`, `stats.runTimeSecs`). Apify puede terminar de actualizar
+el costo unos segundos después de que la ejecución termina, así que los valores son aproximados.
+"""
+import threading
+
+
+class RunUsage:
+    """Acumula el consumo de las ejecuciones del actor de un reporte (seguro entre threads)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.compute_units = 0.0
+        self.usage_usd = 0.0
+        self.run_seconds = 0.0
+        self.retries = 0
+        self.retries_by_kind = {}
+        self.runs_by_status = {}
+        self.dataset_items = 0
+        self.dataset_bytes = 0
+
+    def record_run(self, run):
+        """Registra una ejecución terminada o abortada (el dict de la API de Apify)."""
+        if not run:
+            return
+        stats = run.get("stats") or {}
+        run_seconds = stats.get("runTimeSecs")
+        if run_seconds is None and stats.get("durationMillis") is not None:
+            run_seconds = stats["durationMillis"] / 1000
+        status = run.get("status") or "UNKNOWN"
+        with self._lock:
+            self.runs += 1
+            self.compute_units += float(stats.get("computeUnits") or 0)
+            self.usage_usd += float(run.get("usageTotalUsd") or 0)
+            self.run_seconds += float(run_seconds or 0)
+            self.runs_by_status[status] = self.runs_by_status.get(status, 0) + 1
+
+    def record_retry(self, kind):
+        """Registra un reintento y su causa (ver circuit_breaker.classify_error)."""
+        with self._lock:
+            self.retries += 1
+            self.retries_by_kind[kind] = self.retries_by_kind.get(kind, 0) + 1
+
+    def record_dataset(self, items, size_bytes):
+        with self._lock:
+            self.dataset_items += len(items)
+            self.dataset_bytes += size_bytes
+
+    def get_summary(self, hotel_nights=None, cached_nights=0):
+        """
+        Resumen para guardar con el reporte. Con hotel_nights (hoteles x noches del reporte)
+        agrega el costo por hotel-noche, contando también las servidas desde cache/checkpoints.
+        """
+        with self._lock:
+            summary = {
+                "runs": self.runs,
+                "computeUnits": round(self.compute_units, 4),
+                "usageUsd": round(self.usage_usd, 4),
+                "runSeconds": round(self.run_seconds, 1),
+                "retries": self.retries,
+                "retriesByKind": dict(self.retries_by_kind),
+                "runsByStatus": dict(self.runs_by_status),
+                "datasetItems": self.dataset_items,
+                "datasetBytes": self.dataset_bytes,
+            }
+        if hotel_nights:
+            summary["hotelNights"] = hotel_nights
+            summary["cachedNights"] = cached_nights
+            summary["usdPerHotelNight"] = round(summary["usageUsd"] / hotel_nights, 6)
+            summary["computeUnitsPerHotelNight"] = round(summary["computeUnits"] / hotel_nights, 6)
+        return summary
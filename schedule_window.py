@@ -0,0 +1,92 @@
+"""
+Ventana escalonada para los reportes programados.
+
+Cada grupo programado guarda su próximo arranque en next_run_at (ver group_scheduler). El
+arranque cae en los días de schedule_run_weekdays, dentro de la ventana SCHEDULER_WINDOW_START -
+SCHEDULER_WINDOW_END en la hora local del grupo (schedule_timezone, por defecto SCHEDULER_TIMEZONE).
+
+Dentro de la ventana, cada grupo arranca en una posición fija derivada de un hash de su setId (la
+misma todos los días), así los grupos quedan repartidos y la carga de ejecuciones del actor es
+pareja. La posición deja margen para que el reporte termine antes del fin de la ventana según su
+costo estimado (días x hoteles).
+"""
+import hashlib
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from job_pool import SCRAPER_ETA_SECONDS_PER_COST
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_STAGGER_ENABLED = os.environ.get("SCHEDULER_STAGGER_ENABLED", "true").lower() == "true"
+SCHEDULER_TIMEZONE = os.environ.get("SCHEDULER_TIMEZONE", "America/Argentina/Buenos_Aires")
+SCHEDULER_WINDOW_START = os.environ.get("SCHEDULER_WINDOW_START", "00:00")
+SCHEDULER_WINDOW_END = os.environ.get("SCHEDULER_WINDOW_END", "06:00")
+# Segundos por hotel-noche para estimar cuánto tarda un reporte (margen al final de la ventana)
+SCHEDULER_SECONDS_PER_COST = float(os.environ.get("SCHEDULER_SECONDS_PER_COST", str(SCRAPER_ETA_SECONDS_PER_COST)))
+
+
+def _parse_time(value):
+    hours, _, minutes = value.partition(":")
+    return int(hours), int(minutes or 0)
+
+
+def group_timezone(name=None):
+    """ZoneInfo del grupo; si el nombre no es válido, la zona por defecto (SCHEDULER_TIMEZONE)."""
+    try:
+        return ZoneInfo(name or SCHEDULER_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"[Scheduler] Zona horaria inválida {name!r}: se usa {SCHEDULER_TIMEZONE}")
+        return ZoneInfo(SCHEDULER_TIMEZONE)
+
+
+def is_valid_timezone(name):
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def _window_offset(set_id, cost):
+    """Segundos desde el inicio de la ventana en que arranca el grupo."""
+    if not SCHEDULER_STAGGER_ENABLED:
+        return 0.0
+    start_h, start_m = _parse_time(SCHEDULER_WINDOW_START)
+    end_h, end_m = _parse_time(SCHEDULER_WINDOW_END)
+    length = ((end_h * 60 + end_m) - (start_h * 60 + start_m)) % (24 * 60) * 60 or 24 * 3600
+    usable = length - max(1.0, float(cost or 1)) * SCHEDULER_SECONDS_PER_COST
+    if usable <= 0:
+        return 0.0
+    fraction = int(hashlib.sha1(str(set_id).encode("utf-8")).hexdigest()[:12], 16) / float(16 ** 12)
+    return usable * fraction
+
+
+def next_run_at(set_id, run_weekdays, tz_name=None, cost=1, after=None):
+    """
+    Próximo arranque (datetime UTC) estrictamente posterior a `after` en uno de run_weekdays
+    (0=Lunes, 6=Domingo, en la hora local del grupo), o None si no hay días.
+    """
+    if not run_weekdays:
+        return None
+    tz = group_timezone(tz_name)
+    after = (after or datetime.now(timezone.utc)).astimezone(tz)
+    start_h, start_m = _parse_time(SCHEDULER_WINDOW_START)
+    offset = timedelta(seconds=int(_window_offset(set_id, cost)))
+    for days_ahead in range(8):
+        day = after.date() + timedelta(days=days_ahead)
+        if day.weekday() not in run_weekdays:
+            continue
+        # La hora local se arma con la zona del día (respeta cambios de horario)
+        run_at = datetime(day.year, day.month, day.day, start_h, start_m, tzinfo=tz) + offset
+        if run_at > after:
+            return run_at.astimezone(timezone.utc)
+    return None
+
+
+def local_run_date(run_at, tz_name=None):
+    """Fecha local (YYYY-MM-DD) del arranque, para el id determinista del reporte."""
+    return run_at.astimezone(group_timezone(tz_name)).strftime("%Y-%m-%d")
+
@@ -0,0 +1,289 @@
+"""
+Planificador de scraping entre reportes (coalescing).
+
+Cuando el scheduler encola muchos reportes a la vez, varios comparten hoteles competidores y
+fechas. El planificador mira los reportes 'queued' creados dentro de SCRAPER_COALESCE_WINDOW_SECONDS,
+arma la unión de cotizaciones (hotel canónico, check-in, noches, moneda de scraping) y, si hay al
+menos SCRAPER_COALESCE_MIN_SHARED cotizaciones que piden dos o más reportes:
+
+1. Toma (con lease) los reportes que necesitan alguna cotización compartida, hasta la capacidad
+   libre del pool. Los reportes interactivos no entran en lotes: van directo a la cola justa.
+2. Scrapea cada cotización compartida una sola vez (prefetch).
+3. Reparte los resultados: cada reporte recibe las cotizaciones del prefetch en
+   scrape_booking_data(prefetched_quotes=...) y solo scrapea las propias.
+
+Por cada lote informa cotizaciones pedidas, únicas y compartidas y el dedup ratio
+(1 - únicas / pedidas).
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from hotel_registry import canonical_url
+from job_pool import job_lane
+from quote_cache import make_key, quote_cache
+from run_usage import RunUsage
+import fx_rates
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_COALESCING_ENABLED = os.environ.get("SCRAPER_COALESCING_ENABLED", "true").lower() == "true"
+SCRAPER_COALESCE_WINDOW_SECONDS = float(os.environ.get("SCRAPER_COALESCE_WINDOW_SECONDS", "300"))
+SCRAPER_COALESCE_MIN_SHARED = int(os.environ.get("SCRAPER_COALESCE_MIN_SHARED", "2"))
+SCRAPER_COALESCE_MAX_JOBS = int(os.environ.get("SCRAPER_COALESCE_MAX_JOBS", "50"))
+# Tiempo máximo del prefetch de un lote: lo que no llegue lo scrapea cada reporte
+SCRAPER_COALESCE_PREFETCH_MINUTES = float(os.environ.get("SCRAPER_COALESCE_PREFETCH_MINUTES", "20"))
+
+
+def job_quote_keys(job):
+    """
+    Cotizaciones que necesita un reporte de la cola: dict clave -> URL, con la clave del cache
+    (hotel canónico, check-in, noches, moneda en la que se scrapea).
+    """
+    data = job["data"]
+    days = int(data.get("days", data.get("daysToScrape", 7)) or 1)
+    nights = int(data.get("nights", 1) or 1)
+    fx_plan = fx_rates.plan_conversion(data.get("currency", "USD"), data.get("exactPrices", False))
+    currency = fx_plan["baseCurrency"] if fx_plan else data.get("currency", "USD")
+    start_date = data.get("start_date", data.get("startDate"))
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d") if start_date else datetime.now()
+    except ValueError:
+        start = datetime.now()
+    keys = {}
+    for url in job["hotelUrls"]:
+        for i in range(days):
+            checkin = (start + timedelta(days=i)).strftime("%Y-%m-%d")
+            keys.setdefault(make_key(url, checkin, nights, currency), url)
+    return keys
+
+
+def prefetch_groups(keys):
+    """
+    Agrupa cotizaciones (dict clave -> URL) en llamadas a scrape_booking_data: por hotel, noches y
+    moneda se buscan tramos de fechas consecutivas, y los hoteles con el mismo tramo van juntos.
+    Devuelve [{"hotelUrls", "startDate", "days", "nights", "currency"}].
+    """
+    dates_by_hotel = {}
+    for (hotel, checkin, nights, currency), url in keys.items():
+        entry = dates_by_hotel.setdefault((hotel, nights, currency), {"url": url, "dates": set()})
+        entry["dates"].add(checkin)
+    groups = {}
+    for (hotel, nights, currency), entry in dates_by_hotel.items():
+        dates = sorted(datetime.strptime(d, "%Y-%m-%d") for d in entry["dates"])
+        run_start = previous = dates[0]
+        for date in dates[1:] + [None]:
+            if date is not None and date - previous == timedelta(days=1):
+                previous = date
+                continue
+            span = (run_start.strftime("%Y-%m-%d"), (previous - run_start).days + 1, nights, currency)
+            groups.setdefault(span, []).append(canonical_url(entry["url"]))
+            if date is not None:
+                run_start = previous = date
+    return [
+        {"hotelUrls": sorted(urls), "startDate": start, "days": days, "nights": nights, "currency": currency}
+        for (start, days, nights, currency), urls in sorted(groups.items())
+    ]
+
+
+def plan_batch(jobs, use_cache=True):
+    """
+    Arma el plan de un lote de reportes. Las cotizaciones frescas del cache en memoria no cuentan
+    como compartidas (ningún reporte las scrapea); el nivel persistente lo consulta el prefetch,
+    fuera del dispatcher. Devuelve el resumen del lote con:
+    requestedQuotes, uniqueQuotes, sharedQuotes, dedupRatio, prefetch (grupos) y sharingJobs
+    (ids de los reportes que necesitan alguna cotización compartida).
+    """
+    needed_by = {}  # clave -> [id de reporte, ...]
+    urls = {}
+    requested = 0
+    keys_by_job = {}
+    for job in jobs:
+        keys = job_quote_keys(job)
+        keys_by_job[job["id"]] = keys
+        requested += len(keys)
+        for key, url in keys.items():
+            needed_by.setdefault(key, []).append(job["id"])
+            urls.setdefault(key, url)
+    shared = {}
+    for key, job_ids in needed_by.items():
+        if len(job_ids) < 2:
+            continue
+        hotel, checkin, nights, currency = key
+        if use_cache and quote_cache.peek(urls[key], checkin, nights, currency) is not None:
+            continue
+        shared[key] = urls[key]
+    sharing_jobs = [job["id"] for job in jobs if any(key in shared for key in keys_by_job[job["id"]])]
+    unique = len(needed_by)
+    return {
+        "jobs": len(jobs),
+        "requestedQuotes": requested,
+        "uniqueQuotes": unique,
+        "sharedQuotes": len(shared),
+        "dedupRatio": round(1 - unique / requested, 4) if requested else 0.0,
+        "prefetch": prefetch_groups(shared) if shared else [],
+        "sharingJobs": sharing_jobs,
+    }
+
+
+def prefetch_group(group, usage=None, budget=None, deadline=None):
+    """
+    Scrapea un grupo del plan (ver prefetch_groups) y devuelve {clave: (price, rating, reviews)}
+    con el precio total de la estadía, igual que el cache. Las noches que quedaron sin scrapear
+    por el deadline no se reparten (cada reporte las vuelve a pedir).
+    """
+    from apify_scraper import scrape_booking_data
+
+    nights, currency = group["nights"], group["currency"]
+    quotes = {}
+
+    def collect(completed, total, snapshot, new_quotes):
+        for _, url, checkin, price, rating, reviews in new_quotes:
+            quotes[make_key(url, checkin, nights, currency)] = (price, rating, reviews)
+
+    _, hotel_metadata = scrape_booking_data(
+        group["hotelUrls"], group["days"], nights, currency, group["startDate"],
+        progress_callback=collect, deadline=deadline, usage=usage, budget=budget
+    )
+    for url, metadata in hotel_metadata.items():
+        for checkin in metadata.get("missing_dates") or []:
+            quotes.pop(make_key(url, checkin, nights, currency), None)
+    return quotes
+
+
+class ScrapeCoalescer:
+    """
+    Planifica lotes de la cola y ejecuta sus prefetch en segundo plano.
+
+    claim(job) toma el reporte para este worker (devuelve False si otro lo tomó).
+    prefetch(group, batch_id, usage, deadline) scrapea un grupo (ver prefetch_group) y devuelve
+    {clave: (price, rating, reviews)}.
+    on_ready(jobs) recibe los reportes del lote con job["prefetched"] cuando termina el prefetch.
+    """
+
+    def __init__(self, claim, prefetch, on_ready, enabled=SCRAPER_COALESCING_ENABLED,
+                 window_seconds=SCRAPER_COALESCE_WINDOW_SECONDS, min_shared=SCRAPER_COALESCE_MIN_SHARED,
+                 max_jobs=SCRAPER_COALESCE_MAX_JOBS):
+        self.claim = claim
+        self.prefetch = prefetch
+        self.on_ready = on_ready
+        self.enabled = enabled
+        self.window_seconds = window_seconds
+        self.min_shared = min_shared
+        self.max_jobs = max_jobs
+        self._seen = set()
+        self._held = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.active_batches = 0
+        self.batches = deque(maxlen=20)
+        self.totals = {"batches": 0, "requestedQuotes": 0, "uniqueQuotes": 0, "prefetchedQuotes": 0}
+
+    def _created_at(self, job):
+        created_at = job["data"].get("createdAt")
+        return created_at.timestamp() if hasattr(created_at, "timestamp") else time.time()
+
+    def plan(self, jobs, capacity=None):
+        """
+        Planifica los reportes 'queued' si llegaron nuevos. Devuelve los ids de los reportes que
+        quedaron tomados por un lote (no hay que despacharlos hasta que termine su prefetch).
+        capacity limita los reportes tomados entre todos los lotes en curso (slots del pool).
+        """
+        if not self.enabled or not jobs:
+            return set()
+        # Los interactivos no esperan un prefetch: los despacha la cola justa en su carril
+        jobs = [job for job in jobs if job_lane(job["data"]) != "interactive"]
+        with self._lock:
+            jobs = [job for job in jobs if job["id"] not in self._held]
+            room = self.max_jobs if capacity is None else capacity - len(self._held)
+            current_ids = {job["id"] for job in jobs}
+            new_ids = current_ids - self._seen
+            # Solo se recuerdan los que siguen en la cola (un reporte reencolado se vuelve a planificar)
+            self._seen = current_ids
+        if not new_ids or len(jobs) < 2 or room <= 0:
+            return set()
+        # Lote: los reportes creados dentro de la ventana del más reciente
+        newest = max(self._created_at(job) for job in jobs)
+        batch_jobs = [job for job in jobs if newest - self._created_at(job) <= self.window_seconds][:self.max_jobs]
+        if len(batch_jobs) < 2:
+            return set()
+        plan = plan_batch(batch_jobs)
+        batch_id = f"lote-{next(self._ids)}"
+        summary = {k: v for k, v in plan.items() if k not in ("prefetch", "sharingJobs")}
+        summary.update({"batchId": batch_id, "createdAt": datetime.now().isoformat(), "prefetchGroups": len(plan["prefetch"])})
+        logger.info(f"[Coalescing] {batch_id}: {plan['jobs']} reportes, {plan['requestedQuotes']} cotizaciones pedidas, "
+                    f"{plan['uniqueQuotes']} únicas, {plan['sharedQuotes']} compartidas (dedup ratio {plan['dedupRatio']:.2f})")
+        with self._lock:
+            self.totals["batches"] += 1
+            self.totals["requestedQuotes"] += plan["requestedQuotes"]
+            self.totals["uniqueQuotes"] += plan["uniqueQuotes"]
+            self.batches.append(summary)
+        if plan["sharedQuotes"] < self.min_shared:
+            return set()
+
+        # El resto de las cotizaciones compartidas les llega por el cache cuando termina el prefetch
+        sharing = set(plan["sharingJobs"])
+        held = []
+        for job in batch_jobs:
+            if len(held) >= room:
+                break
+            if job["id"] in sharing and self.claim(job):
+                held.append(job)
+        if not held:
+            return set()
+        summary["heldJobs"] = len(held)
+        with self._lock:
+            self.active_batches += 1
+            self._held.update(job["id"] for job in held)
+        threading.Thread(target=self._run_prefetch, args=(batch_id, plan, held, summary), daemon=True,
+                         name=f"coalescing-{batch_id}").start()
+        return {job["id"] for job in held}
+
+    def _run_prefetch(self, batch_id, plan, held, summary):
+        started = time.time()
+        deadline = started + SCRAPER_COALESCE_PREFETCH_MINUTES * 60
+        usage = RunUsage()
+        quotes = {}
+        for group in plan["prefetch"]:
+            try:
+                quotes.update(self.prefetch(group, batch_id, usage, deadline))
+            except Exception as e:
+                logger.error(f"[Coalescing] Error en el prefetch de {batch_id} ({len(group['hotelUrls'])} hoteles desde {group['startDate']}): {e}")
+        summary["prefetchedQuotes"] = len(quotes)
+        summary["prefetchSeconds"] = round(time.time() - started, 1)
+        summary["usage"] = usage.get_summary(hotel_nights=len(quotes))
+        logger.info(f"[Coalescing] {batch_id}: prefetch de {len(quotes)} cotizaciones en {summary['prefetchSeconds']}s, "
+                    f"liberando {len(held)} reportes")
+        coalescing = {k: summary.get(k) for k in ("batchId", "jobs", "requestedQuotes", "uniqueQuotes", "sharedQuotes", "dedupRatio")}
+        for job in held:
+            job["prefetched"] = quotes
+            job["coalescing"] = coalescing
+        try:
+            self.on_ready(held)
+        finally:
+            with self._lock:
+                self.totals["prefetchedQuotes"] += len(quotes)
+                self.active_batches -= 1
+                self._held.difference_update(job["id"] for job in held)
+
+    def holds(self, job_id):
+        """True si el reporte está tomado por un lote que todavía hace su prefetch."""
+        with self._lock:
+            return job_id in self._held
+
+    def get_stats(self):
+        with self._lock:
+            totals = dict(self.totals)
+            requested = totals["requestedQuotes"]
+            totals["dedupRatio"] = round(1 - totals["uniqueQuotes"] / requested, 4) if requested else 0.0
+            return {
+                "enabled": self.enabled,
+                "activeBatches": self.active_batches,
+                "heldJobs": len(self._held),
+                "totals": totals,
+                "recentBatches": list(self.batches),
+            }
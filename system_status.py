@@ -0,0 +1,123 @@
+"""
+Estado del sistema de reportes para /test-scheduled-tasks (y para el monitoreo que lo consulta).
+
+Los totales salen de consultas de agregación de Firestore (count / avg): Firestore cuenta en el
+índice y no devuelve los documentos, así el costo no crece con la cantidad de usuarios, grupos o
+reportes. El resultado se cachea SYSTEM_STATUS_CACHE_SECONDS para que consultarlo seguido no
+multiplique las lecturas.
+
+Los usuarios con grupos programados se cuentan por la marca users/{uid}.hasScheduledGroups, que
+app.refresh_user_schedule_flag mantiene al cambiar el schedule de un grupo.
+
+Salud de la cola:
+    - reportes por status (queued, pending, completed, failed)
+    - antigüedad del reporte encolado más viejo (índice compuesto status + createdAt, el mismo de
+      la cola)
+    - espera promedio en la cola de los reportes tomados en la última SYSTEM_STATUS_WAIT_WINDOW_SECONDS
+      (avg de queueWaitSeconds, que claim_job guarda al tomar el reporte; requiere el índice
+      compuesto claimedAt + queueWaitSeconds)
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_STATUS_CACHE_SECONDS = float(os.environ.get("SYSTEM_STATUS_CACHE_SECONDS", "30"))
+SYSTEM_STATUS_WAIT_WINDOW_SECONDS = float(os.environ.get("SYSTEM_STATUS_WAIT_WINDOW_SECONDS", "3600"))
+
+REPORT_STATUSES = ("queued", "pending", "completed", "failed")
+
+
+def aggregate_value(aggregation_query):
+    """Valor de una consulta de agregación con un solo resultado (None si no hay documentos)."""
+    for results in aggregation_query.get():
+        for result in results:
+            return result.value
+    return None
+
+
+def count(query):
+    return int(aggregate_value(query.count(alias="total")) or 0)
+
+
+class SystemStatus:
+    """Totales del sistema cacheados; collect() arma el resultado con consultas de agregación."""
+
+    def __init__(self, db, collection="scraping_reports", cache_seconds=SYSTEM_STATUS_CACHE_SECONDS):
+        self.db = db
+        self.collection = collection
+        self.cache_seconds = cache_seconds
+        self._lock = threading.Lock()
+        self._cached = None
+        self._cached_at = 0.0
+
+    def _reports(self):
+        return self.db.collection(self.collection)
+
+    def jobs_by_status(self):
+        return {status: count(self._reports().where("status", "==", status)) for status in REPORT_STATUSES}
+
+    def scheduled_groups(self):
+        """(grupos programados, usuarios con grupos programados)."""
+        total = count(self.db.collection_group("grupos").where("schedule_enabled", "==", True))
+        # Las agregaciones no cuentan distintos: cada usuario lleva la marca hasScheduledGroups
+        users = count(self.db.collection("users").where("hasScheduledGroups", "==", True))
+        return total, users
+
+    def oldest_queued_seconds(self):
+        query = (
+            self._reports()
+            .where("status", "==", "queued")
+            .order_by("createdAt")
+            .select(["createdAt"])
+            .limit(1)
+        )
+        for doc in query.stream():
+            created_at = (doc.to_dict() or {}).get("createdAt")
+            if created_at is not None:
+                # Los datetimes se guardan sin zona (datetime.now()) y vuelven en UTC con tzinfo
+                return max(0.0, (datetime.now() - created_at.replace(tzinfo=None)).total_seconds())
+        return None
+
+    def average_queue_wait_seconds(self):
+        since = datetime.now() - timedelta(seconds=SYSTEM_STATUS_WAIT_WINDOW_SECONDS)
+        query = self._reports().where("claimedAt", ">=", since)
+        try:
+            average = aggregate_value(query.avg("queueWaitSeconds", alias="wait"))
+        except AttributeError:
+            # google-cloud-firestore sin avg (anterior a 2.15)
+            return None
+        return round(average, 1) if average is not None else None
+
+    def collect(self):
+        by_status = self.jobs_by_status()
+        total_groups, users = self.scheduled_groups()
+        oldest = self.oldest_queued_seconds()
+        wait = self.average_queue_wait_seconds()
+        return {
+            "users_with_scheduled_groups": users,
+            "total_scheduled_groups": total_groups,
+            "queued_tasks": by_status["queued"],
+            "pending_tasks": by_status["pending"],
+            "jobs_by_status": by_status,
+            "oldest_queued_seconds": round(oldest, 1) if oldest is not None else None,
+            "average_queue_wait_seconds": wait,
+            "queue_wait_window_seconds": SYSTEM_STATUS_WAIT_WINDOW_SECONDS,
+        }
+
+    def get(self, refresh=False):
+        """Estado cacheado; con refresh (o vencido el cache) se vuelve a consultar Firestore."""
+        with self._lock:
+            age = time.time() - self._cached_at
+            if refresh or self._cached is None or age >= self.cache_seconds:
+                started = time.time()
+                self._cached = self.collect()
+                self._cached_at = time.time()
+                age = 0.0
+                logger.info(f"[SystemStatus] Estado recalculado en {self._cached_at - started:.2f}s")
+            status = dict(self._cached)
+        status["cache_age_seconds"] = round(age, 1)
+        return status
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Worker de la cola de reportes, separado del proceso web.
+
+Toma los reportes 'queued' de scraping_reports y los procesa con el pool de app.py (slots en
+paralelo, presupuesto de ejecuciones del actor, leases). El web solo encola, así cada capa se
+escala por separado (línea worker: del Procfile).
+
+También corre el scheduler de grupos programados (group_scheduler): solo el worker que tiene el
+liderazgo encola los grupos vencidos, sin depender de un cron externo.
+
+Al recibir SIGTERM deja de tomar reportes y espera hasta SCRAPER_WORKER_SHUTDOWN_SECONDS a los
+que están en curso. Pasado ese tiempo el proceso termina con os._exit (los threads del pool no son
+daemon y el intérprete esperaría a que terminen): los reportes cortados dejan de renovar su lease,
+vuelven a la cola cuando vence y se reanudan desde sus checkpoints.
+
+Uso:
+    python worker.py
+    python worker.py --slots 4 --budget 80 --engine asyncio
+"""
+
+import argparse
+import logging
+import os
+import signal
+
+SCRAPER_WORKER_SHUTDOWN_SECONDS = float(os.environ.get("SCRAPER_WORKER_SHUTDOWN_SECONDS", "25"))
+
+logger = logging.getLogger("worker")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de la cola de reportes del scraper")
+    parser.add_argument("--slots", type=int, help="Reportes en paralelo (SCRAPER_WORKER_SLOTS)")
+    parser.add_argument("--budget", type=int, help="Ejecuciones del actor en vuelo (SCRAPER_ACTOR_RUN_BUDGET)")
+    parser.add_argument("--engine", choices=["asyncio", "threads"], help="Motor del scraper (SCRAPER_ENGINE)")
+    args = parser.parse_args()
+
+    # La configuración se lee al importar los módulos: fijarla antes de importar app
+    if args.slots is not None:
+        os.environ["SCRAPER_WORKER_SLOTS"] = str(args.slots)
+    if args.budget is not None:
+        os.environ["SCRAPER_ACTOR_RUN_BUDGET"] = str(args.budget)
+    if args.engine:
+        os.environ["SCRAPER_ENGINE"] = args.engine
+
+    import app
+
+    def handle_signal(signum, frame):
+        logger.info(f"[Worker] Señal {signum} recibida: terminando (no se toman reportes nuevos)")
+        app.stop_queue_worker()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    logger.info(f"[Worker] Iniciando worker {app.WORKER_ID} con {app.scraper_pool.slots} slots")
+    scheduler_thread = app.group_scheduler.start()
+    app.cola_procesadora_scraping()
+
+    running = app.scraper_pool.running_count()
+    if running:
+        logger.info(f"[Worker] Esperando hasta {SCRAPER_WORKER_SHUTDOWN_SECONDS:.0f}s a {running} reportes en curso")
+    finished = app.scraper_pool.wait_idle(SCRAPER_WORKER_SHUTDOWN_SECONDS)
+    app.queue_listener.close()
+    # El scheduler libera el liderazgo al salir de su bucle
+    scheduler_thread.join(timeout=5)
+    if not finished:
+        logger.warning(f"[Worker] {app.scraper_pool.running_count()} reportes sin terminar: vuelven a la cola al vencer su lease")
+        app.scraper_pool.shutdown()
+        logging.shutdown()
+        # Sin esto el intérprete espera a los threads del pool (no daemon) hasta que terminen
+        os._exit(1)
+    logger.info("[Worker] Worker detenido")
+
+
+if __name__ == "__main__":
+    main()